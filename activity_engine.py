@@ -0,0 +1,498 @@
+import asyncio
+import datetime
+
+import api_metrics
+import bungie_client
+import config
+import pgcr_cache
+import score_engine
+
+
+# Number of members whose activity is refreshed concurrently. Can be overridden from config.py.
+ACTIVITY_UPDATE_WORKERS = getattr(config, 'ACTIVITY_UPDATE_WORKERS', 8)
+
+
+class ActivityEngine:
+    """
+    Pulls members' Destiny activity from Bungie and folds it into their records.
+
+    Shared by the bot (see cogs/background_tasks.py) and the headless stat_updater.py, so both update a member the
+    same way. It never saves anything itself: callers decide when a record is written back.
+    """
+
+    def __init__(self, bungie, pgcr_cache, roster_index, history_cache=None):
+        """
+        Args:
+            bungie (bungie_client.BungieClient): client used for every Bungie call.
+            pgcr_cache (pgcr_cache.PgcrCache): cache of post game carnage reports.
+            roster_index (roster_index.RosterIndex): the cached clan rosters, to tell clan members apart.
+            history_cache (history_cache.HistoryCache): local copy of characters' activity histories; without one
+                                                        every refresh pages the history back to the oldest day.
+        """
+        self.bungie = bungie
+        self.pgcr_cache = pgcr_cache
+        self.roster_index = roster_index
+        self.history_cache = history_cache
+
+    ####################################################################################################################
+    # Member Updates
+
+    async def update_members(self, users, concurrency=ACTIVITY_UPDATE_WORKERS, discord_stats=None, since=None,
+                             on_member_done=None):
+        """
+        Update several members, a bounded number at a time.
+
+        A failure for one member is reported and skipped so it doesn't stall the rest of the batch; on_member_done
+        is called for every member either way.
+
+        Args:
+            users (list): user records, updated in place.
+            concurrency (int): members updated at once.
+            discord_stats (dict): clan-wide discord chat tallies keyed by discord ID; None leaves the chat counters
+                                  as they are.
+            since (datetime.datetime): pull every day from this one on again, even if it is on record.
+            on_member_done (function): called with each user record once it has been updated.
+
+        Returns: None.
+
+        """
+        # Hand the users out to a bounded pool of workers
+        pending_users = iter(users)
+
+        await asyncio.gather(*[self._update_worker(pending_users, discord_stats, since, on_member_done)
+                               for _ in range(concurrency)])
+
+    async def _update_worker(self, pending_users, discord_stats, since, on_member_done):
+        for user_data in pending_users:
+            try:
+                await self.update_member(user_data, discord_stats, since)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                print("[!] >>> BACKGROUND: Unable to update stats for {}: {}: {}".format(user_data['bungie_name'],
+                                                                                          ex.__class__.__name__, ex))
+
+            if on_member_done is not None:
+                on_member_done(user_data)
+
+    async def update_member(self, user_data, discord_stats=None, since=None):
+        """
+        Refresh the discord and bungie stats of a single registered user. The score is left to the caller.
+
+        Args:
+            user_data (dict): the user's record, updated in place.
+            discord_stats (dict): clan-wide discord chat tallies keyed by discord ID; None leaves the chat counters
+                                  as they are.
+            since (datetime.datetime): pull every day from this one on again, even if it is on record.
+
+        Returns (list): "%Y-%m-%d" of the days pulled from Bungie.
+        """
+        print("[*] >>> BACKGROUND: Updating to {}'s stats...".format(user_data['bungie_name']))
+
+        if discord_stats is not None:
+            self.apply_discord_stats(discord_stats, user_data)
+
+        # Pull every missing day in a single pass over the user's activity history
+        missing_days = self.missing_days(user_data, since)
+
+        bungie_stats = {}
+        if len(missing_days) > 0:
+            print(">>> STATS FOR: {} to {}".format(missing_days[0].strftime("%Y-%m-%d"),
+                                                   missing_days[-1].strftime("%Y-%m-%d")))
+
+            try:
+                bungie_stats = await self.get_user_bungie_activity_stats(user_data['bungie_id'], missing_days,
+                                                                         user_data)
+            except bungie_client.BungieApiError as ex:
+                # Leave the days out so the next run picks them up again
+                print("[!] >>> BACKGROUND: Unable to pull stats for {}: {}".format(user_data['bungie_name'], ex))
+
+        self.merge_bungie_stats(user_data, bungie_stats)
+
+        print("[*] >>> BACKGROUND: Update to {}'s stats complete.".format(user_data['bungie_name']))
+
+        return sorted(bungie_stats.keys())
+
+    @staticmethod
+    def apply_discord_stats(discord_stats, user_data):
+        """
+        Pick a user's discord stats out of the clan-wide tallies.
+
+        Returns: None.
+
+        """
+        user_discord_stats = discord_stats.get(str(user_data['discord_id']),
+                                               {'chat_events': 0, 'characters_typed': 0, 'vc_minutes': 0})
+
+        user_data['chat_events'] = user_discord_stats['chat_events']
+        user_data['characters_typed'] = user_discord_stats['characters_typed']
+        user_data['vc_minutes'] = user_discord_stats['vc_minutes']
+
+    @staticmethod
+    def report_days():
+        """
+        The days kept on record: the statistics period, or the longest score window if that is longer (we don't pull
+        current day).
+
+        Returns (list): datetime objects, oldest first.
+        """
+        today_utc = datetime.datetime.utcnow()
+        reporting_period = (today_utc - datetime.timedelta(days=score_engine.kept_days()))
+
+        report_days = []
+        iter_date = reporting_period
+
+        while iter_date < today_utc:
+            report_days.append(iter_date)
+            iter_date = iter_date + datetime.timedelta(days=1)
+
+        return report_days
+
+    def missing_days(self, user_data, since=None):
+        """
+        The days kept on record the user has no stats for yet.
+
+        Args:
+            user_data (dict): the user's record.
+            since (datetime.datetime): count every day from this one on as missing.
+
+        Returns (list): datetime objects, oldest first.
+        """
+        today_report = datetime.datetime.utcnow().strftime("%Y-%m-%d")
+        since_report = since.strftime("%Y-%m-%d") if since is not None else today_report
+
+        return [report_day for report_day in self.report_days()
+                if report_day.strftime("%Y-%m-%d") not in user_data['game_activity'].keys() or
+                report_day.strftime("%Y-%m-%d") >= since_report]
+
+    def merge_bungie_stats(self, user_data, bungie_stats):
+        """
+        Fold freshly pulled days into the user's record, dropping days that are no longer kept.
+
+        Returns: None.
+
+        """
+        daily_bungie_stats = {}
+
+        for report_day in [report_day.strftime("%Y-%m-%d") for report_day in self.report_days()]:
+            if report_day in bungie_stats.keys():
+                daily_bungie_stats.update({report_day: bungie_stats[report_day]})
+            elif report_day in user_data['game_activity'].keys():
+                daily_bungie_stats.update({report_day: user_data['game_activity'][report_day]})
+
+        # Update the data in the user's record.
+        user_data['game_activity'] = daily_bungie_stats
+
+    # End of Member Updates
+    ####################################################################################################################
+
+    ####################################################################################################################
+    # Bungie Stats
+
+    async def resolve_destiny_profile(self, bungie_id, user_data=None, refresh=False):
+        """
+        Find a user's membership type and character IDs.
+
+        The answer is kept on the user record (membership_type, character_ids and profile_resolved_at) and reused
+        for PROFILE_CACHE_TTL_DAYS, so steady-state runs don't have to probe every platform with get_profile.
+
+        Args:
+            bungie_id (str): Destiny membership ID of the user.
+            user_data (dict): the user's record, if they are registered.
+            refresh (bool): ignore the cached answer and ask Bungie again.
+
+        Returns (tuple): (membership type, list of character IDs); (None, []) for a private or unknown profile.
+
+        Raises:
+            BungieApiError: Bungie answered with an error other than a private profile or no account on a platform.
+        """
+        if user_data is not None and not refresh and user_data.get('membership_type') is not None:
+            resolved_at = datetime.datetime.strptime(user_data['profile_resolved_at'], "%Y-%m-%d %H:%M:%S")
+            if datetime.datetime.utcnow() - resolved_at < datetime.timedelta(days=bungie_client.PROFILE_CACHE_TTL_DAYS):
+                return user_data['membership_type'], user_data['character_ids']
+
+        profile_types = [3, 2, 1, 5]
+
+        for profile_type in profile_types:
+            profile_data = await self.bungie.get_profile(profile_type, bungie_id, components=['100'])
+            self.debug_api_call(profile_data)
+
+            if str(profile_data['ErrorCode']) == "1":
+                character_ids = profile_data['Response']['profile']['data']['characterIds']
+
+                if user_data is not None:
+                    user_data['membership_type'] = profile_type
+                    user_data['character_ids'] = character_ids
+                    user_data['profile_resolved_at'] = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+                return profile_type, character_ids
+
+            # Anything but a private profile or no account on this platform (e.g. SystemDisabled) says nothing about
+            # the user, so don't let it pass for a profile with no characters
+            if str(profile_data['ErrorCode']) != "1665" and \
+                    profile_data['ErrorCode'] not in bungie_client.PLATFORM_ERROR_CODES:
+                raise bungie_client.BungieApiError("GetProfile failed with ErrorCode {} ({})".format(
+                    profile_data['ErrorCode'], profile_data.get('ErrorStatus')))
+
+        # Private (1665) or unknown profile, nothing to count
+        return None, []
+
+    async def get_user_bungie_activity_stats(self, bungie_id, days_to_pull, user_data=None):
+        """
+        Pull a user's Destiny activity stats for each of the given days.
+
+        Each character's activity history is paged newest first, with the largest page Bungie allows, until it is
+        past the oldest requested day or back at what the history cache already holds. Every activity on a requested
+        day is then bucketed into that day's totals.
+
+        Args:
+            bungie_id (str): Destiny membership ID of the user.
+            days_to_pull (list): datetime objects for the days to pull stats for.
+            user_data (dict): the user's record, if they are registered, to cache their profile on.
+
+        Returns (dict):
+                        "%Y-%m-%d" -> {'seconds_played': .., 'clan_members_played_with': ..,
+                                       'unique_clan_members_played_with': ..}
+
+        Raises:
+            BungieApiError: a Bungie call failed, or the profile was still rejected after resolving it again; none of
+                            the days should be recorded.
+        """
+        wanted_days = set(day_to_pull.strftime("%Y-%m-%d") for day_to_pull in days_to_pull)
+        if len(wanted_days) == 0:
+            return {}
+
+        oldest_day = min(wanted_days)
+
+        # A cached profile can go stale (e.g. a platform move or a deleted character); if Bungie says so, resolve it
+        # again and start over
+        for attempt in range(2):
+            member_type, character_ids = await self.resolve_destiny_profile(bungie_id, user_data, refresh=attempt > 0)
+
+            stat_results, platform_error = await self._pull_character_histories(
+                bungie_id, member_type, character_ids, wanted_days, oldest_day)
+
+            if not platform_error:
+                break
+        else:
+            raise bungie_client.BungieApiError("Bungie still rejects the profile of {} after resolving it again".format(
+                bungie_id))
+
+        return stat_results
+
+    async def _pull_character_histories(self, bungie_id, member_type, character_ids, wanted_days, oldest_day):
+        """
+        Bring each character's activity history up to date and total up the wanted days.
+
+        Returns (tuple): (stats per day as returned by get_user_bungie_activity_stats, True if Bungie rejected the
+                         membership type or a character)
+        """
+        seconds_played = {stat_day: 0 for stat_day in wanted_days}
+        clan_members_played_with = {stat_day: 0 for stat_day in wanted_days}
+        unique_clan_members_played_with = {stat_day: set() for stat_day in wanted_days}
+
+        platform_error = False
+
+        for character_id in character_ids:
+            character_activities, platform_error = await self._sync_character_history(
+                bungie_id, member_type, character_id, oldest_day)
+
+            if platform_error:
+                break
+
+            for instance_id, period, activity_seconds in character_activities:
+                activity_day = period[:10]
+                if activity_day not in wanted_days:
+                    continue
+
+                # Calculate seconds played
+                seconds_played[activity_day] += activity_seconds
+
+                # See who they played with in that activity
+                activity_clan_players = await self.get_activity_clan_members(bungie_id, instance_id)
+                unique_clan_members_played_with[activity_day].update(activity_clan_players)
+
+                # Cap at 2.9 to not landslipe PvPers or Iron Banner participants out of control
+                if len(activity_clan_players) > 2:
+                    clan_members_played_with[activity_day] += 2.9
+                else:
+                    clan_members_played_with[activity_day] += len(activity_clan_players)
+
+        stat_results = {}
+        for stat_day in wanted_days:
+            stat_results.update(
+                {
+                    stat_day: {
+                        "seconds_played": seconds_played[stat_day],
+                        "clan_members_played_with": clan_members_played_with[stat_day],
+                        "unique_clan_members_played_with": len(unique_clan_members_played_with[stat_day])
+                    }
+                }
+            )
+
+        return stat_results, platform_error
+
+    async def _sync_character_history(self, bungie_id, member_type, character_id, oldest_day):
+        """
+        A character's activities from oldest_day on.
+
+        History is paged newest first. With a history cache, paging stops at the character's watermark (the newest
+        activity already on file), or at oldest_day if that comes first, and the rest comes from the cache, so a
+        character who played less than a page of activities since their last refresh costs one request however long the
+        window. Without a watermark, or when the cache doesn't reach back to oldest_day, the history is paged back to
+        oldest_day and cached.
+
+        Returns (tuple): ((instance_id, period, seconds_played) tuples, newest first, True if Bungie rejected the
+                         membership type or the character)
+
+        Raises:
+            BungieApiError: a history page failed; the watermark and the cached history are left as they were.
+        """
+        watermark = None
+        if self.history_cache is not None:
+            watermark = self.history_cache.watermark(character_id)
+
+            # The cache only stands in for the older pages if it reaches back far enough
+            if watermark is not None and watermark['covered_from'] > oldest_day:
+                watermark = None
+
+        fetched_activities = []
+        newest_activity = None
+        covered_from = watermark['covered_from'] if watermark is not None else oldest_day
+        pull_more_reports = True
+        report_page = 0
+
+        while pull_more_reports:
+            history_report = await self.bungie.get_activity_history(
+                member_type, bungie_id, character_id, count=bungie_client.ACTIVITY_HISTORY_PAGE_SIZE, mode=None,
+                page=report_page)
+            self.debug_api_call(history_report)
+
+            # See if their profile is set to private
+            if str(history_report['ErrorCode']) == "1665":
+                return [], False
+
+            if history_report['ErrorCode'] in bungie_client.PLATFORM_ERROR_CODES:
+                return [], True
+
+            # Any other error (e.g. SystemDisabled) fails the walk before anything is cached, so the days stay missing
+            if str(history_report['ErrorCode']) != "1":
+                raise bungie_client.BungieApiError("GetActivityHistory failed with ErrorCode {} ({})".format(
+                    history_report['ErrorCode'], history_report.get('ErrorStatus')))
+
+            # If we don't get any activities, we're done
+            if 'activities' not in history_report.get('Response', {}).keys():
+                break
+
+            # Increment the page count if we loop back
+            report_page += 1
+            character_activities = history_report['Response']['activities']
+
+            for character_activity in character_activities:
+                instance_id = str(character_activity['activityDetails']['instanceId'])
+                period = character_activity['period']
+
+                if newest_activity is None:
+                    newest_activity = (instance_id, period)
+
+                # History is newest first, so from here on it is either cached or outside the window
+                if watermark is not None and (instance_id == watermark['instance_id'] or
+                                              period < watermark['period']):
+                    pull_more_reports = False
+                    break
+
+                # Past the window (before getting back to any watermark), so the copy is complete from oldest_day on
+                if period[:10] < oldest_day:
+                    covered_from = oldest_day
+                    pull_more_reports = False
+                    break
+
+                fetched_activities.append(
+                    (instance_id, period, character_activity['values']['timePlayedSeconds']['basic']['value']))
+
+            # A short page is the last one
+            if len(character_activities) < bungie_client.ACTIVITY_HISTORY_PAGE_SIZE:
+                pull_more_reports = False
+
+        if self.history_cache is None:
+            return fetched_activities, False
+
+        keep_from = min(oldest_day, self.report_days()[0].strftime("%Y-%m-%d"))
+
+        # Only written once the walk is complete, so an interrupted one never leaves a gap behind the watermark
+        self.history_cache.record(character_id, fetched_activities, newest_activity, covered_from, keep_from)
+
+        return self.history_cache.activities(character_id, oldest_day), False
+
+    async def get_activity_clan_members(self, bungie_id, instance_id):
+        """Looks up which of a user's fireteam members in an activity were in our clans.
+
+            Returns (list): membership IDs of the clan members (other than the user) in the activity.
+
+            Raises:
+                BungieApiError: the carnage report couldn't be fetched, so the fireteam is unknown.
+        """
+        participants = self.pgcr_cache.get(instance_id)
+
+        if participants is None:
+            activity_info = await self.bungie.get_post_game_carnage_report(instance_id)
+            self.debug_api_call(activity_info)
+
+            # An error report has no entries; counting it as a solo activity would record a zero for good
+            if str(activity_info['ErrorCode']) != "1":
+                raise bungie_client.BungieApiError("GetPostGameCarnageReport {} failed with ErrorCode {} ({})".format(
+                    instance_id, activity_info['ErrorCode'], activity_info.get('ErrorStatus')))
+
+            participants = pgcr_cache.PgcrCache.participants_from_report(activity_info)
+            self.pgcr_cache.put(instance_id, participants)
+
+        activity_clan_players = []
+
+        for player_id, is_public, display_name in participants:
+
+            # Make sure it isn't the player getting stats pulled on
+            if player_id != str(bungie_id):
+
+                # Deal with fireteam members who may have private profile settings
+                if is_public:
+                    player_name = display_name
+                else:
+                    player_name = "<PRIVATE>"
+
+                print("\t\t\tLOOKUP: {} : {}".format(player_name, player_id))
+                # Find out if the players were in our clans
+                clan_search_results = self.check_if_clan_member(bungie_id=player_id)
+
+                if clan_search_results['is_member']:
+                    activity_clan_players.append(player_id)
+
+        return activity_clan_players
+
+    def check_if_clan_member(self, bungie_id=None, profile_name=None):
+        """Checks the cached roster if member is in the clans.
+
+            Returns (dict):
+                            return_results['bungie_id'] = member['id']
+                            return_results['bungie_name'] = member['name']
+                            return_results['is_member'] = True
+        """
+        return self.roster_index.lookup(bungie_id=bungie_id, profile_name=profile_name)
+
+    def debug_api_call(self, api_response):
+        if not api_metrics.BUNGIE_DEBUG_PRINTS:
+            return
+
+        # if api_response['ErrorCode'] != 1:
+        time_now = datetime.datetime.utcnow()
+        print("{}: ErrorCode: {}, ThrottleSeconds: {}, Message: {}, MessageData: {}".format(time_now,
+                                                                                            api_response['ErrorCode'],
+                                                                                            api_response[
+                                                                                                'ThrottleSeconds'],
+                                                                                            api_response['Message'],
+                                                                                            api_response[
+                                                                                                'MessageData']))
+        #if 'Response' in api_response.keys():
+            #print("\t\tRESPONSE: {}".format(api_response['Response']))
+
+    # End of Bungie Stats
+    ####################################################################################################################
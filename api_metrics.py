@@ -0,0 +1,183 @@
+import bisect
+
+from aiohttp import web
+
+import config
+
+
+# Print every Bungie response the way the bot always has. Off by default, the metrics below cover it.
+BUNGIE_DEBUG_PRINTS = getattr(config, 'BUNGIE_DEBUG_PRINTS', False)
+
+# Local port the Prometheus text endpoint is served on, None to not serve it. Can be overridden from config.py.
+API_METRICS_HOST = getattr(config, 'API_METRICS_HOST', '127.0.0.1')
+API_METRICS_PORT = getattr(config, 'API_METRICS_PORT', None)
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+class EndpointMetrics:
+    """
+    Counters for a single Bungie endpoint.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.error_codes = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.retries = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.max_throttle_seconds = 0.0
+
+    def latency_quantile(self, quantile):
+        """
+        Estimate a latency quantile from the histogram.
+
+        Returns (float): upper bound of the bucket the quantile falls in, None if there were no requests. Requests
+                         past the last bucket are reported as infinity.
+        """
+        if self.requests == 0:
+            return None
+
+        target = quantile * self.requests
+        seen = 0
+        for bucket, bucket_count in enumerate(self.latency_buckets):
+            seen += bucket_count
+            if seen >= target:
+                return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else float('inf')
+
+        return float('inf')
+
+
+class ApiMetrics:
+    """
+    Per-endpoint Bungie API request counts, latency histograms, error codes, retries and ThrottleSeconds.
+
+    Recording is a few dictionary and list updates, cheap enough to do on every request.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+
+    def _endpoint(self, endpoint):
+        endpoint_metrics = self.endpoints.get(endpoint)
+        if endpoint_metrics is None:
+            endpoint_metrics = self.endpoints[endpoint] = EndpointMetrics()
+
+        return endpoint_metrics
+
+    def observe(self, endpoint, latency, error_code):
+        """
+        Record one request.
+
+        Args:
+            endpoint (str): name of the endpoint.
+            latency (float): seconds the request took.
+            error_code (str): Bungie ErrorCode of the response, or the exception name if there was no response.
+
+        Returns: None.
+
+        """
+        endpoint_metrics = self._endpoint(endpoint)
+
+        endpoint_metrics.requests += 1
+        endpoint_metrics.error_codes[str(error_code)] = endpoint_metrics.error_codes.get(str(error_code), 0) + 1
+        endpoint_metrics.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        endpoint_metrics.latency_sum += latency
+
+    def observe_throttle(self, endpoint, throttle_seconds):
+        endpoint_metrics = self._endpoint(endpoint)
+
+        endpoint_metrics.throttled += 1
+        endpoint_metrics.throttle_seconds += throttle_seconds
+        endpoint_metrics.max_throttle_seconds = max(endpoint_metrics.max_throttle_seconds, throttle_seconds)
+
+    def observe_retry(self, endpoint):
+        self._endpoint(endpoint).retries += 1
+
+    def observe_coalesced(self, endpoint):
+        """Record a call answered by an identical one already in flight, saving a request."""
+        self._endpoint(endpoint).coalesced += 1
+
+    def observe_failure(self, endpoint):
+        self._endpoint(endpoint).failures += 1
+
+    def render_prometheus(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns (str): the metrics page.
+        """
+        lines = []
+
+        def metric(name, metric_type, help_text, samples, sample_name=None):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(label, label_value) for label, label_value in labels)
+                lines.append("{}{{{}}} {}".format(sample_name or name, label_text, value))
+
+        endpoints = sorted(self.endpoints.items())
+
+        metric("bungie_requests_total", "counter", "Bungie API requests by endpoint and ErrorCode.",
+               [((('endpoint', endpoint), ('error_code', error_code)), count)
+                for endpoint, endpoint_metrics in endpoints
+                for error_code, count in sorted(endpoint_metrics.error_codes.items())])
+
+        latency_samples = []
+        for endpoint, endpoint_metrics in endpoints:
+            cumulative = 0
+            for bucket, bucket_count in enumerate(endpoint_metrics.latency_buckets):
+                cumulative += bucket_count
+                upper_bound = str(LATENCY_BUCKETS[bucket]) if bucket < len(LATENCY_BUCKETS) else "+Inf"
+                latency_samples.append(((('endpoint', endpoint), ('le', upper_bound)), cumulative))
+        metric("bungie_request_duration_seconds", "histogram", "Bungie API request latency.", latency_samples,
+               sample_name="bungie_request_duration_seconds_bucket")
+        lines.extend('bungie_request_duration_seconds_sum{{endpoint="{}"}} {}'.format(
+            endpoint, endpoint_metrics.latency_sum) for endpoint, endpoint_metrics in endpoints)
+        lines.extend('bungie_request_duration_seconds_count{{endpoint="{}"}} {}'.format(
+            endpoint, endpoint_metrics.requests) for endpoint, endpoint_metrics in endpoints)
+
+        metric("bungie_retries_total", "counter", "Bungie API calls retried after an error or throttle.",
+               [((('endpoint', endpoint),), endpoint_metrics.retries) for endpoint, endpoint_metrics in endpoints])
+        metric("bungie_coalesced_requests_total", "counter",
+               "Bungie API calls answered by an identical call already in flight, i.e. requests saved.",
+               [((('endpoint', endpoint),), endpoint_metrics.coalesced) for endpoint, endpoint_metrics in endpoints])
+        metric("bungie_failures_total", "counter", "Bungie API calls that failed after every retry.",
+               [((('endpoint', endpoint),), endpoint_metrics.failures) for endpoint, endpoint_metrics in endpoints])
+        metric("bungie_throttled_responses_total", "counter", "Bungie API responses asking for a ThrottleSeconds wait.",
+               [((('endpoint', endpoint),), endpoint_metrics.throttled) for endpoint, endpoint_metrics in endpoints])
+        metric("bungie_throttle_seconds_total", "counter", "Sum of the ThrottleSeconds Bungie asked for.",
+               [((('endpoint', endpoint),), endpoint_metrics.throttle_seconds)
+                for endpoint, endpoint_metrics in endpoints])
+
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every BungieClient in the process
+default_metrics = ApiMetrics()
+
+
+async def start_metrics_server(metrics=default_metrics, host=API_METRICS_HOST, port=API_METRICS_PORT):
+    """
+    Serve the Prometheus text endpoint at http://<host>:<port>/metrics.
+
+    Returns (aiohttp.web.AppRunner): call cleanup() on it to stop serving.
+    """
+    async def metrics_page(request):
+        return web.Response(text=metrics.render_prometheus(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_page)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    print("[*] Serving Bungie API metrics on http://{}:{}/metrics".format(host, port))
+
+    return runner
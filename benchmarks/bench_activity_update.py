@@ -0,0 +1,280 @@
+"""
+Benchmark of the activity update against a local Bungie.net stand-in.
+
+Run from the repository root (config.py has to be importable, its API key is never sent anywhere):
+
+    python -m benchmarks.bench_activity_update --members 1000
+    python -m benchmarks.bench_activity_update --members 10000 --latency 0.1 --rate-limit 20 --runs 2
+    python -m benchmarks.bench_activity_update --scenario stats --sample 50
+
+Every run reports wall time, requests made (in total and per registered member), peak memory and how long the
+event loop was stalled. The second and later runs show the incremental cost, with the days already on record
+skipped and the carnage reports served from the cache.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import pydest
+
+import bungie_api
+import bungie_client
+import config
+import history_cache
+import pgcr_cache
+import roster_index
+import score_engine
+import stat_updater
+import storage
+
+from benchmarks.bungie_stub import BungieStub, SyntheticClan
+
+# Event loop lag above this many seconds is counted as a stall
+STALL_THRESHOLD = 0.05
+
+
+class LoopWatcher:
+    """
+    Measures how late the event loop wakes up a task that sleeps for a fixed interval; anything past the interval
+    is time the loop was busy running something else without yielding.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _watch(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._watch())
+
+    async def stop(self):
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    def summary(self):
+        stalls = [lag for lag in self.lags if lag > STALL_THRESHOLD]
+
+        return {
+            'max_stall_s': round(max(self.lags, default=0.0), 4),
+            'stalls': len(stalls),
+            'stalled_s': round(sum(stalls), 4)
+        }
+
+
+async def measure(name, stub, coroutine_factory, registered_members, trace_memory, quiet):
+    """
+    Run one benchmark phase and collect its numbers.
+
+    Returns (dict): the phase's results.
+    """
+    requests_before = dict(stub.requests)
+    throttled_before = stub.throttled
+
+    watcher = LoopWatcher()
+    watcher.start()
+
+    if trace_memory:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+
+    with open(os.devnull, 'w') as devnull, contextlib.ExitStack() as output:
+        # The updater narrates every member; keep that out of the report
+        if quiet:
+            output.enter_context(contextlib.redirect_stdout(devnull))
+
+        await coroutine_factory()
+
+    wall_time = time.perf_counter() - started
+
+    result = {'phase': name, 'wall_s': round(wall_time, 3)}
+
+    if trace_memory:
+        result['peak_python_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        tracemalloc.stop()
+
+    await watcher.stop()
+
+    requests = {endpoint: count - requests_before.get(endpoint, 0) for endpoint, count in stub.requests.items()
+                if count - requests_before.get(endpoint, 0) > 0}
+    total_requests = sum(requests.values())
+
+    result.update({
+        'requests': total_requests,
+        'requests_per_member': round(total_requests / max(1, registered_members), 2),
+        'requests_per_s': round(total_requests / wall_time, 1) if wall_time > 0 else None,
+        'throttled': stub.throttled - throttled_before,
+        'by_endpoint': requests,
+        # Process-wide high water mark (the stub included); KiB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    })
+    result.update(watcher.summary())
+
+    return result
+
+
+def registered_users(clan, registered):
+    """
+    User records for the registered share of the clan.
+
+    Returns (list): user records.
+    """
+    users = []
+    created_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    for member_index in range(int(clan.members * registered)):
+        membership_id = clan.membership_id(member_index)
+        users.append({
+            'discord_id': str(100000000000000000 + member_index), 'bungie_id': membership_id,
+            'discord_name': clan.display_name(membership_id), 'bungie_name': clan.display_name(membership_id),
+            'clan_id': clan.clan_id, 'clan_name': "Benchmark Clan", 'created_at': created_at,
+            'clan_activity_score': 0, 'chat_events': 0, 'characters_typed': 0, 'vc_minutes': 0, 'game_activity': {}
+        })
+
+    return users
+
+
+async def run_benchmark(args, stub, clan, work_dir):
+    database = storage.BrewDatabase(os.path.join(work_dir, "brewbot.db"))
+    report_cache = pgcr_cache.PgcrCache(os.path.join(work_dir, "pgcr_cache.db"))
+    character_histories = history_cache.HistoryCache(os.path.join(work_dir, "history_cache.db"))
+    bungie = bungie_client.BungieClient("benchmark", rate_limiter=bungie_client.RateLimiter(args.rate_limit,
+                                                                                           args.rate_burst))
+
+    users = registered_users(clan, args.registered)
+    database.save_users(users)
+
+    results = []
+
+    try:
+        # Pull the roster through the same path the bot uses
+        clan_rosters = {}
+
+        async def pull_rosters():
+            clan_rosters.update(await bungie_api.fetch_clan_lists(bungie, [{'clan_id': clan.clan_id}]))
+
+        results.append(await measure("roster", stub, pull_rosters, len(users), args.trace_memory, args.quiet))
+        database.save_clan_roster(clan.clan_id, clan_rosters[clan.clan_id], str(datetime.datetime.utcnow()))
+
+        updater = stat_updater.ActivityUpdater(database, bungie, report_cache, roster_index.RosterIndex(database),
+                                               character_histories)
+
+        for run in range(args.runs):
+            if args.scenario == "stats":
+                today = datetime.datetime.utcnow()
+                days_to_pull = [today - datetime.timedelta(days=day) for day in range(1, args.days + 1)]
+
+                async def pull_stats():
+                    for user_data in users[:args.sample]:
+                        await updater.engine.get_user_bungie_activity_stats(user_data['bungie_id'],
+                                                                            days_to_pull, user_data)
+
+                results.append(await measure("stats #{}".format(run + 1), stub, pull_stats, min(args.sample,
+                                                                                               len(users)),
+                                             args.trace_memory, args.quiet))
+            else:
+                results.append(await measure("update #{}".format(run + 1), stub, updater.clan_activity_update,
+                                             len(users), args.trace_memory, args.quiet))
+
+            results[-1]['pgcr_cache'] = report_cache.stats()
+            results[-1]['history_cache'] = character_histories.stats()
+
+    finally:
+        await bungie.close()
+        report_cache.close()
+        character_histories.close()
+        database.close()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the activity update against a local Bungie stand-in.")
+    parser.add_argument('--scenario', choices=['update', 'stats'], default='update',
+                        help="the whole nightly update, or just get_user_bungie_activity_stats for a sample")
+    parser.add_argument('--members', type=int, default=100, help="members in the synthetic clan")
+    parser.add_argument('--registered', type=float, default=1.0, help="share of the clan registered with the bot")
+    parser.add_argument('--sample', type=int, default=25, help="members pulled by the stats scenario")
+    parser.add_argument('--days', type=int, default=7, help="statistics period in days")
+    parser.add_argument('--score-windows', type=int, nargs='*', default=[],
+                        help="score windows in days; any longer than --days lengthen the window pulled (the bot "
+                             "defaults to 7 30 90)")
+    parser.add_argument('--activities-per-day', type=int, default=3)
+    parser.add_argument('--characters', type=int, default=3)
+    parser.add_argument('--fireteam-size', type=int, default=3)
+    parser.add_argument('--clan-fireteam-ratio', type=float, default=0.5,
+                        help="chance each other fireteam member is from the clan")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--throttle-ratio', type=float, default=0.0,
+                        help="share of requests answered with a throttle error")
+    parser.add_argument('--throttle-seconds', type=int, default=0)
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help="client-side requests per second")
+    parser.add_argument('--rate-burst', type=float, default=1000.0)
+    parser.add_argument('--runs', type=int, default=1, help="back to back runs over the same database and cache")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="track peak Python allocations (slows the run down noticeably)")
+    parser.add_argument('--verbose', dest='quiet', action='store_false', help="keep the updater's own output")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    config.STATISTICS_PERIOD = args.days
+    score_engine.SCORE_WINDOWS = args.score_windows
+
+    # The window actually pulled and reported on
+    args.days = score_engine.kept_days()
+
+    clan = SyntheticClan("9999999", args.members, days=args.days + 1, activities_per_day=args.activities_per_day,
+                         characters=args.characters, fireteam_size=args.fireteam_size,
+                         clan_fireteam_ratio=args.clan_fireteam_ratio, seed=args.seed)
+    stub = BungieStub(clan, latency=args.latency, latency_jitter=args.latency_jitter,
+                      throttle_ratio=args.throttle_ratio, throttle_seconds=args.throttle_seconds)
+
+    base_url = stub.start()
+
+    # Point pydest and bungie_api at the stub
+    pydest.api.DESTINY2_URL = base_url + "/Platform/Destiny2/"
+    pydest.api.GROUP_URL = base_url + "/Platform/GroupV2/"
+    bungie_api.baseurl = pydest.api.DESTINY2_URL
+    bungie_api.baseurl_groupv2 = pydest.api.GROUP_URL
+
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = asyncio.get_event_loop().run_until_complete(run_benchmark(args, stub, clan, work_dir))
+    finally:
+        stub.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("{} members ({:.0%} registered), {} day period, {:.0f}ms latency, {:.0f} req/s client limit".format(
+        args.members, args.registered, args.days, args.latency * 1000, args.rate_limit))
+
+    for result in results:
+        print("\n[{}]".format(result['phase']))
+        for key, value in result.items():
+            if key != 'phase':
+                print("  {:<22} {}".format(key, value))
+
+
+if __name__ == '__main__':
+    main()
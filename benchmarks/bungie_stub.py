@@ -0,0 +1,326 @@
+"""
+Local stand-in for the parts of the Bungie.net API the activity update uses.
+
+Serves GetProfile, GetActivityHistory, GetPostGameCarnageReport and GetMembersOfGroup for a synthetic clan, with
+configurable latency and throttling. The clan is never materialized: every profile, history page and carnage report
+is derived on request from the member's index and a seed, so a 10,000 member clan costs no more memory than a 100
+member one, and the same activity always reports the same fireteam.
+"""
+
+import asyncio
+import datetime
+import random
+import socket
+import threading
+
+from aiohttp import web
+
+# Membership IDs of the synthetic members are FIRST_MEMBERSHIP_ID + member index
+FIRST_MEMBERSHIP_ID = 4611686018400000000
+
+# Fireteam members who are not in the clan get IDs from here up
+FIRST_OUTSIDER_ID = 4611686018500000000
+
+# Members returned per GetMembersOfGroup page
+MEMBERS_PAGE_SIZE = 100
+
+
+class SyntheticClan:
+    """
+    Deterministic description of a clan and everything its members played.
+
+    Each member hosts activities_per_day activities on each of the last days days, split over their characters. An
+    activity's fireteam is the host plus fireteam_size - 1 seats, each filled from the clan with probability
+    clan_fireteam_ratio and from outside it otherwise. Clan seat n goes to the member n places after the host, and
+    the activity is in that member's history too, so clanmates who played together pull the same carnage report.
+    """
+
+    def __init__(self, clan_id, members, days=30, activities_per_day=3, characters=3, fireteam_size=3,
+                 clan_fireteam_ratio=0.5, private_ratio=0.05, seed=0, today=None):
+        self.clan_id = str(clan_id)
+        self.members = members
+        self.days = days
+        self.activities_per_day = activities_per_day
+        self.characters = characters
+        self.fireteam_size = fireteam_size
+        self.clan_fireteam_ratio = clan_fireteam_ratio
+        self.private_ratio = private_ratio
+        self.seed = seed
+
+        if today is None:
+            today = datetime.datetime.utcnow()
+        self.today = today.replace(hour=12, minute=0, second=0, microsecond=0)
+
+    def membership_id(self, member_index):
+        return str(FIRST_MEMBERSHIP_ID + member_index)
+
+    def member_index(self, membership_id):
+        member_index = int(membership_id) - FIRST_MEMBERSHIP_ID
+        if 0 <= member_index < self.members:
+            return member_index
+
+        return None
+
+    def display_name(self, membership_id):
+        return "Guardian{}".format(int(membership_id) % 1000000)
+
+    def character_id(self, member_index, character):
+        return str(2305843009300000000 + member_index * 10 + character)
+
+    def is_private(self, member_index):
+        return random.Random(self.seed * 7919 + member_index).random() < self.private_ratio
+
+    def activities(self, member_index, character):
+        """
+        The character's activity history, newest first: the activities they hosted and the ones they had a clan
+        seat in.
+
+        Returns (list): (instance_id, period, seconds_played) tuples.
+        """
+        history = []
+
+        for day in range(self.days):
+            for activity in range(self.activities_per_day):
+                period = self.today - datetime.timedelta(days=day, minutes=activity * 45)
+
+                if activity % self.characters == character:
+                    instance_id = self._instance_id(member_index, day, activity)
+                    history.append((str(instance_id), period, self._seconds_played(instance_id)))
+
+                for seat in range(1, self._seats()):
+                    instance_id = self._instance_id((member_index - seat) % self.members, day, activity)
+
+                    if (instance_id + seat) % self.characters == character and self._clan_seat(instance_id, seat):
+                        history.append((str(instance_id), period, self._seconds_played(instance_id)))
+
+        history.sort(key=lambda history_entry: (history_entry[1], int(history_entry[0])), reverse=True)
+
+        return history
+
+    def fireteam(self, instance_id):
+        """
+        Everyone in an activity.
+
+        Returns (list): membership IDs, the member who hosted the activity first.
+        """
+        instance_id = int(instance_id)
+        host_index = (instance_id - 1) // (self.days * self.activities_per_day)
+        rng = random.Random(self.seed * 104729 + instance_id)
+
+        fireteam = [self.membership_id(host_index)]
+        for seat in range(1, self.fireteam_size):
+            if seat < self._seats() and self._clan_seat(instance_id, seat):
+                fireteam.append(self.membership_id((host_index + seat) % self.members))
+            else:
+                fireteam.append(str(FIRST_OUTSIDER_ID + rng.randrange(1000000)))
+
+        return fireteam
+
+    def _instance_id(self, host_index, day, activity):
+        # Instance IDs encode who hosted what when, so the carnage report can be rebuilt from them
+        return ((host_index * self.days + day) * self.activities_per_day + activity) + 1
+
+    @staticmethod
+    def _seconds_played(instance_id):
+        return 600 + (instance_id * 37) % 2400
+
+    def _seats(self):
+        # Seats past the clan size would wrap around to the host or someone already seated
+        return min(self.fireteam_size, self.members)
+
+    def _clan_seat(self, instance_id, seat):
+        return random.Random((self.seed * 104729 + instance_id) * self.fireteam_size + seat).random() < \
+            self.clan_fireteam_ratio
+
+
+class BungieStub:
+    """
+    aiohttp application serving a SyntheticClan, counting every request it answers.
+    """
+
+    def __init__(self, clan, latency=0.05, latency_jitter=0.02, throttle_ratio=0.0, throttle_seconds=0):
+        """
+        Args:
+            clan (SyntheticClan): the clan to serve.
+            latency (float): seconds every response is delayed by.
+            latency_jitter (float): up to this many extra seconds are added at random.
+            throttle_ratio (float): share of requests answered with a throttle error (ErrorCode 36) instead.
+            throttle_seconds (int): ThrottleSeconds sent with those errors.
+        """
+        self.clan = clan
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_ratio = throttle_ratio
+        self.throttle_seconds = throttle_seconds
+
+        self.requests = {}
+        self.throttled = 0
+
+        self.app = web.Application()
+        self.app.router.add_get('/Platform/Destiny2/{membership_type}/Profile/{membership_id}/', self.get_profile)
+        self.app.router.add_get('/Platform/Destiny2/{membership_type}/Account/{membership_id}/Character/'
+                                '{character_id}/Stats/Activities/', self.get_activity_history)
+        self.app.router.add_get('/Platform/Destiny2/Stats/PostGameCarnageReport/{instance_id}/',
+                                self.get_post_game_carnage_report)
+        self.app.router.add_get('/Platform/GroupV2/{group_id}/Members/', self.get_members_of_group)
+
+        self._runner = None
+        self._loop = None
+        self._thread = None
+        self.port = None
+
+    ####################################################################################################################
+    # Server lifecycle
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serve from a background thread with its own event loop, so the stub's own work doesn't show up as stalls
+        of the loop being measured.
+
+        Returns (str): base URL of the stub, e.g. http://127.0.0.1:12345
+        """
+        if port == 0:
+            with socket.socket() as probe:
+                probe.bind((host, 0))
+                port = probe.getsockname()[1]
+
+        self.port = port
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+
+            self._runner = web.AppRunner(self.app, access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+
+            self._loop.run_until_complete(web.TCPSite(self._runner, host, port).start())
+
+            started.set()
+            self._loop.run_forever()
+
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=serve, name="bungie-stub", daemon=True)
+        self._thread.start()
+        started.wait()
+
+        return "http://{}:{}".format(host, self.port)
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    ####################################################################################################################
+    # Request helpers
+
+    async def _respond(self, endpoint, response):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+        await asyncio.sleep(self.latency + random.uniform(0, self.latency_jitter))
+
+        if self.throttle_ratio > 0 and random.random() < self.throttle_ratio:
+            self.throttled += 1
+            return self._envelope(None, error_code=36, error_status="ThrottleLimitExceededMomentarily",
+                                  throttle_seconds=self.throttle_seconds)
+
+        return response
+
+    @staticmethod
+    def _envelope(response, error_code=1, error_status="Success", throttle_seconds=0):
+        envelope = {
+            'ErrorCode': error_code,
+            'ThrottleSeconds': throttle_seconds,
+            'ErrorStatus': error_status,
+            'Message': "Ok" if error_code == 1 else error_status,
+            'MessageData': {}
+        }
+        if response is not None:
+            envelope['Response'] = response
+
+        return web.json_response(envelope)
+
+    ####################################################################################################################
+    # Endpoints
+
+    async def get_profile(self, request):
+        member_index = self.clan.member_index(request.match_info['membership_id'])
+
+        # Every synthetic member is on Steam
+        if member_index is None or request.match_info['membership_type'] != "3":
+            return await self._respond('GetProfile', self._envelope(
+                None, error_code=1601, error_status="DestinyAccountNotFound"))
+
+        membership_id = self.clan.membership_id(member_index)
+        return await self._respond('GetProfile', self._envelope({
+            'profile': {'data': {
+                'userInfo': {'membershipType': 3, 'membershipId': membership_id,
+                             'displayName': self.clan.display_name(membership_id)},
+                'characterIds': [self.clan.character_id(member_index, character)
+                                 for character in range(self.clan.characters)]
+            }}
+        }))
+
+    async def get_activity_history(self, request):
+        member_index = self.clan.member_index(request.match_info['membership_id'])
+        if member_index is None:
+            return await self._respond('GetActivityHistory', self._envelope(
+                None, error_code=1601, error_status="DestinyAccountNotFound"))
+
+        if self.clan.is_private(member_index):
+            return await self._respond('GetActivityHistory', self._envelope(
+                None, error_code=1665, error_status="DestinyPrivacyRestriction"))
+
+        character = int(request.match_info['character_id']) % 10
+        count = int(request.query.get('count', 1))
+        page = int(request.query.get('page', 0))
+
+        history = self.clan.activities(member_index, character)[page * count:(page + 1) * count]
+
+        # Bungie leaves 'activities' out entirely once the history runs dry
+        if len(history) == 0:
+            return await self._respond('GetActivityHistory', self._envelope({}))
+
+        return await self._respond('GetActivityHistory', self._envelope({
+            'activities': [{
+                'period': period.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'activityDetails': {'instanceId': instance_id, 'mode': 5},
+                'values': {'timePlayedSeconds': {'basic': {'value': seconds_played}}}
+            } for instance_id, period, seconds_played in history]
+        }))
+
+    async def get_post_game_carnage_report(self, request):
+        instance_id = request.match_info['instance_id']
+
+        entries = []
+        for membership_id in self.clan.fireteam(instance_id):
+            member_index = self.clan.member_index(membership_id)
+            is_public = member_index is None or not self.clan.is_private(member_index)
+
+            entries.append({'player': {'destinyUserInfo': {
+                'membershipType': 3, 'membershipId': membership_id, 'isPublic': is_public,
+                'displayName': self.clan.display_name(membership_id)}}})
+
+        return await self._respond('GetPostGameCarnageReport', self._envelope({
+            'activityDetails': {'instanceId': instance_id}, 'entries': entries
+        }))
+
+    async def get_members_of_group(self, request):
+        page = int(request.query.get('currentPage', 1))
+        first_member = (page - 1) * MEMBERS_PAGE_SIZE
+        last_member = min(self.clan.members, first_member + MEMBERS_PAGE_SIZE)
+
+        results = []
+        for member_index in range(first_member, last_member):
+            membership_id = self.clan.membership_id(member_index)
+            results.append({
+                'groupId': self.clan.clan_id,
+                'joinDate': '2019-01-01T00:00:00Z',
+                'destinyUserInfo': {'membershipType': 3, 'membershipId': membership_id,
+                                    'displayName': self.clan.display_name(membership_id)}
+            })
+
+        return await self._respond('GetMembersOfGroup', self._envelope({
+            'results': results, 'totalResults': self.clan.members, 'hasMore': last_member < self.clan.members
+        }))
@@ -1,7 +1,19 @@
+import asyncio
+
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
+import activity_engine
+import api_metrics
+import bungie_client
+import chat_tracker
 import config
+import history_cache
+import job_queue
+import pgcr_cache
+import ranking_index
+import roster_index
+import user_cache
 
 
 class BrewBot(discord.ext.commands.Bot):
@@ -13,11 +25,48 @@ class BrewBot(discord.ext.commands.Bot):
         Instantiate an instance of BrewBot.
 
         Args:
-            db_session (db_session_maker): SQLAlchemy database session for BrewBot to utilize.
+            db_session (storage.BrewDatabase): database for BrewBot to utilize.
         """
         super().__init__(command_prefix=config.BOT_COMMAND_PREFIX)
         self.db_session = db_session
 
+        # Every user record, held in memory and written back in batches
+        self.user_cache = user_cache.UserCache(self.db_session)
+
+        # Leaderboard of activity scores, moved along as scores change
+        self.ranking_index = ranking_index.RankingIndex(self.user_cache.all())
+
+        # Shared, connection pooled Bungie client used by every cog
+        self.bungie = bungie_client.BungieClient(config.BUNGIE_API_KEY)
+
+        # On-disk cache of post game carnage reports, which never change once an activity is over
+        self.pgcr_cache = pgcr_cache.PgcrCache(config.BOT_BASEDIR + "pgcr_cache.db")
+
+        # On-disk copy of each character's activity history, so a refresh only pages back to what it already has
+        self.history_cache = history_cache.HistoryCache(config.BOT_BASEDIR + "history_cache.db")
+
+        # In-memory index of the cached clan rosters for membership checks
+        self.roster_index = roster_index.RosterIndex(self.db_session)
+
+        # Pulls and merges members' Destiny activity, shared with the headless stat_updater.py
+        self.activity_engine = activity_engine.ActivityEngine(self.bungie, self.pgcr_cache, self.roster_index,
+                                                              self.history_cache)
+
+        # Incremental discord chat counters, kept up to date as messages arrive
+        self.chat_tracker = chat_tracker.ChatTracker(config.BOT_BASEDIR + "chat_activity.json")
+
+        # Queue the nightly Bungie update is handed to when it runs in worker processes
+        if job_queue.ACTIVITY_UPDATE_MODE == 'queue':
+            self.activity_jobs = job_queue.ActivityJobQueue()
+        else:
+            self.activity_jobs = None
+
+        # Rolling refresh of member activity, set up by the background tasks when ACTIVITY_UPDATE_MODE is 'rolling'
+        self.refresh_scheduler = None
+
+        # Prometheus endpoint for the Bungie API metrics, started with the bot if a port is configured
+        self.metrics_server = None
+
         # Load the bot's modules
         for bot_module in config.BOT_MODULES:
             self.load_extension(bot_module)
@@ -30,6 +79,10 @@ class BrewBot(discord.ext.commands.Bot):
             message (discord.Message): the message triggering the event
 
         """
+        # Only do Ace's Brew Discord
+        if message.guild is not None and message.guild.id == 534781834924523520:
+            self.chat_tracker.record_message(message)
+
         await super().process_commands(message)
         #print(str(message.guild) + " : " + str(message.channel) + " : " + str(message.author))
         #
@@ -40,6 +93,48 @@ class BrewBot(discord.ext.commands.Bot):
         """
         print("Bot is ready.")
 
+    async def start(self, *args, **kwargs):
+        """
+        Start the metrics endpoint (if configured) alongside the bot.
+        """
+        if api_metrics.API_METRICS_PORT is not None and self.metrics_server is None:
+            self.metrics_server = await api_metrics.start_metrics_server(self.bungie.metrics)
+
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        """
+        Shut the bot down, writing back any changed user records and chat counters and releasing the shared Bungie
+        connection pool and the PGCR and history caches first.
+
+        The extensions are unloaded first, and their background loops waited on until they have stopped, so nothing
+        is still updating users or using the caches while they are written back and closed.
+        """
+        loop_tasks = [cog_loop.get_task() for cog in self.cogs.values() for cog_loop in vars(type(cog)).values()
+                      if isinstance(cog_loop, tasks.Loop) and cog_loop.get_task() is not None]
+
+        # Unloading runs each cog's cog_unload, which cancels its loops
+        for extension in list(self.extensions.keys()):
+            self.unload_extension(extension)
+
+        await asyncio.gather(*loop_tasks, return_exceptions=True)
+
+        await self.user_cache.flush()
+        self.db_session.clear_bot_heartbeat()
+        self.chat_tracker.save()
+        await self.bungie.close()
+        self.pgcr_cache.close()
+        self.history_cache.close()
+
+        if self.activity_jobs is not None:
+            self.activity_jobs.close()
+
+        if self.metrics_server is not None:
+            await self.metrics_server.cleanup()
+            self.metrics_server = None
+
+        await super().close()
+
     def run(self):
         """
         Execution function to launch the bot.
@@ -1,5 +1,7 @@
+import asyncio
 import requests
 import json
+import bungie_client
 import config
 
 
@@ -20,6 +22,21 @@ def destiny2_api_public(url, api_key):
     return ResponseSummary(response)
 
 
+class JsonResponse:
+    """
+    Minimal stand-in for a requests response, wrapping JSON that has already been fetched (e.g. by the pooled
+    bungie_client.BungieClient) so it can be summarized by ResponseSummary.
+    """
+
+    def __init__(self, url, result, status_code=200):
+        self.url = url
+        self.status_code = status_code
+        self._result = result
+
+    def json(self):
+        return self._result
+
+
 class ResponseSummary:
     """
     Object contains all the important information about the request sent to bungie.
@@ -65,33 +82,85 @@ class ResponseSummary:
                disp_status + disp_error_code + disp_error_status + disp_exception
 
 
-def get_members_of_group_url(group_id):
-    """Pull all members of a clan. Note clans can only have 100 members max.
+def get_members_of_group_url(group_id, page=1):
+    """Pull a page of members of a clan.
         https://bungie-net.github.io/multi/operation_get_GroupV2-GetMembersOfGroup.html"""
-    return baseurl_groupv2 + group_id + '/Members/?currentPage=1'
+    return baseurl_groupv2 + str(group_id) + '/Members/?currentPage=' + str(page)
+
+
+def clan_list_entry(member):
+    """Roster entry for a GetMembersOfGroup result: a dict with name, id and join date."""
+    # don't use bungienetuserinfo some don't have
+    return {
+        'name': member['destinyUserInfo']['displayName'],
+        'id': member['destinyUserInfo']['membershipId'],
+        'date_joined': member['joinDate']
+    }
 
 
 def generate_clan_list(clan_id):
     """Using output of GetMembersOfGroup, create list of member info for clan members:
-        each is a dict with username. id, join date. Filters out people not on original
-        user's membership type."""
-    # Filter out people not on psn
-    membership_type = 3
+        each is a dict with username. id, join date."""
+    clan_members_data = []  # dictionary with name: user_name, id: id, and join date
+
+    page = 1
+    while True:
+        clan_members_url = get_members_of_group_url(clan_id, page)
+        clan_members_summary = destiny2_api_public(clan_members_url, my_api_key)
+
+        for member in clan_members_summary.data['results']:
+            clan_members_data.append(clan_list_entry(member))
 
-    clan_members_data = []  # dictionary with name: user_name, id: id, and membership_type
+        if not clan_members_summary.data.get('hasMore'):
+            break
+        page += 1
+
+    return clan_members_data
 
-    clan_members_url = get_members_of_group_url(clan_id)
-    clan_members_summary = destiny2_api_public(clan_members_url, my_api_key)
-    # Check out some results
-    member_data = clan_members_summary.data['results']  # full data list
 
-    for member in member_data:
-        # print(member['destinyUserInfo']['displayName'])  #don't use bungienetuserinfo some don't have
+async def fetch_clan_list(bungie, clan_id):
+    """Async generate_clan_list, fetched over the bot's pooled, rate limited Bungie client.
 
-        clan_member = {}
-        clan_member['name'] = member['destinyUserInfo']['displayName']
-        clan_member['id'] = member['destinyUserInfo']['membershipId']
-        clan_member['date_joined'] = member['joinDate']
-        clan_members_data.append(clan_member)
+        Follows the hasMore flag through every page of the roster. Failures are reported through ResponseSummary as
+        usual.
+
+        Returns (list): roster entries, or None if any page could not be fetched.
+    """
+    clan_members_data = []
+
+    page = 1
+    while True:
+        clan_members_url = get_members_of_group_url(clan_id, page)
+
+        try:
+            result = await bungie.get_members_of_group(clan_id, page=page)
+        except bungie_client.BungieApiError as ex:
+            print('Request failed for url: {0}.\n{1}'.format(clan_members_url, ex))
+            return None
+
+        clan_members_summary = ResponseSummary(JsonResponse(clan_members_url, result))
+        if clan_members_summary.data is None:
+            return None
+
+        for member in clan_members_summary.data['results']:
+            clan_members_data.append(clan_list_entry(member))
+
+        if not clan_members_summary.data.get('hasMore'):
+            break
+        page += 1
 
     return clan_members_data
+
+
+async def fetch_clan_lists(bungie, clans):
+    """Fetch the rosters of several clans concurrently.
+
+        Args:
+            bungie (bungie_client.BungieClient): the bot's Bungie client.
+            clans (list): clan entries as in config.BREW_CLANS.
+
+        Returns (dict): clan ID -> roster entries, or None for a clan whose roster could not be fetched.
+    """
+    clan_lists = await asyncio.gather(*[fetch_clan_list(bungie, clan['clan_id']) for clan in clans])
+
+    return {clan['clan_id']: clan_list for clan, clan_list in zip(clans, clan_lists)}
@@ -0,0 +1,301 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+import pydest
+
+import api_metrics
+import config
+
+
+# Connection pool tuning. Any of these can be overridden from config.py.
+BUNGIE_MAX_CONNECTIONS = getattr(config, 'BUNGIE_MAX_CONNECTIONS', 20)
+BUNGIE_KEEPALIVE_TIMEOUT = getattr(config, 'BUNGIE_KEEPALIVE_TIMEOUT', 60)
+BUNGIE_REQUEST_TIMEOUT = getattr(config, 'BUNGIE_REQUEST_TIMEOUT', 30)
+
+# Request budget and retry policy. Bungie allows roughly 25 requests per second per API key.
+BUNGIE_RATE_LIMIT = getattr(config, 'BUNGIE_RATE_LIMIT', 20)
+BUNGIE_RATE_BURST = getattr(config, 'BUNGIE_RATE_BURST', 25)
+BUNGIE_MAX_RETRIES = getattr(config, 'BUNGIE_MAX_RETRIES', 5)
+BUNGIE_BACKOFF_BASE = getattr(config, 'BUNGIE_BACKOFF_BASE', 1.0)
+BUNGIE_BACKOFF_MAX = getattr(config, 'BUNGIE_BACKOFF_MAX', 60.0)
+
+# Largest page GetActivityHistory will return
+ACTIVITY_HISTORY_PAGE_SIZE = 250
+
+# ThrottleLimitExceeded, ...Minutes, ...Momentarily, ...Seconds and PerEndpointRequestThrottleExceeded
+THROTTLE_ERROR_CODES = {35, 36, 37, 38, 51}
+
+# DestinyAccountNotFound and DestinyCharacterNotFound: a cached membership type or character list has gone stale
+PLATFORM_ERROR_CODES = {1601, 1620}
+
+# Days a user's resolved membership type and character IDs are reused before asking Bungie again
+PROFILE_CACHE_TTL_DAYS = getattr(config, 'PROFILE_CACHE_TTL_DAYS', 7)
+
+
+class BungieApiError(Exception):
+    """Raised when a Bungie.net call still fails after every retry has been used up."""
+    pass
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every Bungie call in the process.
+
+    Callers reserve a token synchronously and then sleep (without blocking the event loop) until it is theirs, so
+    waiting requests are served in order. Bungie's ThrottleSeconds hints pause the whole bucket.
+    """
+
+    def __init__(self, rate=BUNGIE_RATE_LIMIT, burst=BUNGIE_RATE_BURST):
+        """
+        Args:
+            rate (float): tokens added per second.
+            burst (int): maximum number of tokens the bucket can hold.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+
+    def _reserve(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+        # Going negative queues the caller behind everyone already waiting
+        self._tokens -= 1
+        delay = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+        return max(delay, self._paused_until - now)
+
+    async def acquire(self):
+        """
+        Wait until a request may be sent.
+
+        Returns: None.
+
+        """
+        delay = self._reserve()
+
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # A throttle hint may have arrived while we were waiting
+            delay = self._paused_until - time.monotonic()
+
+    def pause(self, seconds):
+        """
+        Hold every caller for the given number of seconds, e.g. when Bungie answers with ThrottleSeconds.
+
+        Args:
+            seconds (float): how long to stop sending requests for.
+
+        Returns: None.
+
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + float(seconds))
+
+
+# Process-wide bucket used by every client unless one is given explicitly
+default_rate_limiter = RateLimiter()
+
+
+class BungieClient:
+    """
+    Long-lived, connection pooled client for the Bungie.net API.
+
+    One instance is owned by the bot and shared by every cog, so all Bungie calls reuse the same aiohttp session
+    (and its keep-alive connections) instead of paying a new TCP and TLS handshake per request.
+    """
+
+    def __init__(self, api_key, max_connections=BUNGIE_MAX_CONNECTIONS, keepalive_timeout=BUNGIE_KEEPALIVE_TIMEOUT,
+                 request_timeout=BUNGIE_REQUEST_TIMEOUT, rate_limiter=None, max_retries=BUNGIE_MAX_RETRIES,
+                 metrics=None):
+        """
+        Instantiate a Bungie client. The underlying session is created lazily on the first call so that it is bound
+        to the running event loop.
+
+        Args:
+            api_key (str): Bungie.net API key.
+            max_connections (int): maximum number of simultaneous connections kept in the pool.
+            keepalive_timeout (int): seconds an idle connection is kept open for reuse.
+            request_timeout (int): total seconds allowed for a single request.
+            rate_limiter (RateLimiter): bucket to draw request tokens from. Defaults to the process-wide one.
+            max_retries (int): how many times a failed or throttled call is retried before giving up.
+            metrics (api_metrics.ApiMetrics): where every request is recorded. Defaults to the process-wide one.
+        """
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.rate_limiter = rate_limiter if rate_limiter is not None else default_rate_limiter
+        self.max_retries = max_retries
+        self.metrics = metrics if metrics is not None else api_metrics.default_metrics
+
+        self._session = None
+        self._api = None
+
+        # (endpoint, args) -> future of the call currently on its way to Bungie
+        self._in_flight = {}
+
+    def _ensure_session(self):
+        """
+        Create the pooled session (and the pydest API bound to it) if there is no live one.
+
+        Returns: None.
+
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+            self._api = pydest.api.API(self.api_key, self._session)
+
+    @property
+    def session(self):
+        """
+        The pooled aiohttp session, (re)created on demand.
+
+        Returns: aiohttp.ClientSession
+
+        """
+        self._ensure_session()
+        return self._session
+
+    @property
+    def api(self):
+        """
+        pydest API bound to the pooled session.
+
+        Returns: pydest.api.API
+
+        """
+        self._ensure_session()
+        return self._api
+
+    @staticmethod
+    def _backoff(attempt):
+        """Exponential backoff with full jitter for the given (zero based) attempt."""
+        return random.uniform(0, min(BUNGIE_BACKOFF_MAX, BUNGIE_BACKOFF_BASE * (2 ** attempt)))
+
+    @staticmethod
+    def _request_key(endpoint, args, kwargs):
+        def freeze(value):
+            if isinstance(value, (list, tuple)):
+                return tuple(freeze(item) for item in value)
+            return str(value)
+
+        return endpoint, freeze(args), tuple(sorted((name, freeze(value)) for name, value in kwargs.items()))
+
+    async def _request(self, endpoint, *args, **kwargs):
+        """
+        Send a call, sharing the response with any identical call that is already in flight.
+
+        Concurrent callers asking for the same thing (e.g. the carnage report of an activity two members played
+        together) wait on one future and one network call. The response dict is shared between them, so callers
+        must treat it as read-only.
+
+        Returns: json (dict) as returned by Bungie.
+
+        Raises:
+            BungieApiError: the call still failed after max_retries retries.
+        """
+        request_key = self._request_key(endpoint, args, kwargs)
+
+        in_flight = self._in_flight.get(request_key)
+        if in_flight is not None:
+            self.metrics.observe_coalesced(endpoint)
+        else:
+            in_flight = asyncio.ensure_future(self._send(endpoint, *args, **kwargs))
+            self._in_flight[request_key] = in_flight
+            in_flight.add_done_callback(lambda done: self._request_done(request_key, done))
+
+        # Shielded so that one caller being cancelled doesn't cancel the call for everyone else waiting on it
+        return await asyncio.shield(in_flight)
+
+    def _request_done(self, request_key, done):
+        if self._in_flight.get(request_key) is done:
+            del self._in_flight[request_key]
+
+        # Mark any error as retrieved, the callers (if there are any left) have already been handed it
+        if not done.cancelled():
+            done.exception()
+
+    async def _send(self, endpoint, *args, **kwargs):
+        """
+        Send a call through the rate limiter, retrying transport errors and throttled responses.
+
+        Args:
+            endpoint (str): name of the pydest API method to call.
+
+        Returns: json (dict) as returned by Bungie.
+
+        Raises:
+            BungieApiError: the call still failed after max_retries retries.
+        """
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+
+            started = time.monotonic()
+
+            try:
+                response = await getattr(self.api, endpoint)(*args, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError, pydest.PydestException, ValueError) as ex:
+                self.metrics.observe(endpoint, time.monotonic() - started, ex.__class__.__name__)
+
+                last_error = "{}: {}".format(ex.__class__.__name__, ex)
+                delay = self._backoff(attempt)
+            else:
+                self.metrics.observe(endpoint, time.monotonic() - started, response.get('ErrorCode'))
+
+                throttle_seconds = response.get('ThrottleSeconds') or 0
+                if throttle_seconds > 0:
+                    self.metrics.observe_throttle(endpoint, throttle_seconds)
+                    self.rate_limiter.pause(throttle_seconds)
+
+                if response.get('ErrorCode') not in THROTTLE_ERROR_CODES:
+                    return response
+
+                last_error = "ErrorCode {} ({})".format(response.get('ErrorCode'), response.get('ErrorStatus'))
+                delay = max(throttle_seconds, self._backoff(attempt))
+
+            if attempt < self.max_retries:
+                self.metrics.observe_retry(endpoint)
+                print("[!] Bungie {} failed with {}, retrying in {:.1f}s...".format(endpoint, last_error, delay))
+                await asyncio.sleep(delay)
+
+        self.metrics.observe_failure(endpoint)
+        raise BungieApiError("{} failed after {} retries: {}".format(endpoint, self.max_retries, last_error))
+
+    async def get_profile(self, membership_type, membership_id, components):
+        return await self._request('get_profile', membership_type, membership_id, components)
+
+    async def get_activity_history(self, membership_type, membership_id, character_id, count=1, mode=None, page=0):
+        return await self._request('get_activity_history', membership_type, membership_id, character_id,
+                                   count=count, mode=mode, page=page)
+
+    async def get_post_game_carnage_report(self, activity_id):
+        return await self._request('get_post_game_carnage_report', activity_id)
+
+    async def get_groups_for_member(self, membership_type, membership_id):
+        return await self._request('get_groups_for_member', membership_type, membership_id)
+
+    async def get_members_of_group(self, group_id, page=1):
+        return await self._request('get_members_of_group', group_id, page=page)
+
+    async def close(self):
+        """
+        Close the pooled session and release all of its connections.
+
+        Returns: None.
+
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+        self._session = None
+        self._api = None
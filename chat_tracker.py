@@ -0,0 +1,213 @@
+import json
+import os
+
+
+class ChatTracker:
+    """
+    Incremental per-user Discord chat counters.
+
+    Messages are counted into per-user daily buckets as they arrive, and every channel remembers the last message it
+    has counted so that after downtime only the messages since that checkpoint have to be read back from Discord.
+    The nightly activity update then just drops the expired days and sums the buckets.
+
+    Until a channel's catch-up after startup is done, live messages in it are counted but don't move its checkpoint,
+    so the catch-up still reads the whole gap from the checkpoint restored at startup. A channel whose catch-up fails
+    keeps its checkpoint where the catch-up stopped and stops counting live messages, so the next startup's catch-up
+    reads (and counts) them once.
+    """
+
+    def __init__(self, state_path):
+        """
+        Load the tracker state from disk, if there is any.
+
+        Args:
+            state_path (str): JSON file the checkpoints and daily buckets are persisted to.
+        """
+        self.state_path = state_path
+
+        # channel ID (str) -> ID of the newest message counted in that channel
+        self.checkpoints = {}
+
+        # discord ID (str) -> "%Y-%m-%d" -> [chat_events, characters_typed]
+        self.daily_chat = {}
+
+        self.dirty = False
+
+        # Message IDs counted while the catch-up is pending, so a message seen both live and in the history isn't
+        # counted twice
+        self._catching_up = True
+        self._recent_message_ids = set()
+
+        # Channels whose catch-up is done, and channel ID -> newest live message counted in a channel still waiting
+        # for its catch-up
+        self._caught_up_channels = set()
+        self._held_checkpoints = {}
+
+        # Channels whose catch-up failed, left for the next startup
+        self._failed_channels = set()
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return
+
+        self.checkpoints = state.get('checkpoints', {})
+        self.daily_chat = state.get('daily_chat', {})
+
+    def save(self):
+        """
+        Write the tracker state to disk if anything changed since the last save.
+
+        Returns: None.
+
+        """
+        if not self.dirty:
+            return
+
+        # Write to a temporary file first so a crash can't leave a torn state file behind
+        with open(self.state_path + ".tmp", 'w') as state_file:
+            json.dump({'checkpoints': self.checkpoints, 'daily_chat': self.daily_chat}, state_file)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+        self.dirty = False
+
+    def checkpoint(self, channel_id):
+        """
+        ID of the newest message counted in a channel.
+
+        Returns: int, or None if nothing has been counted in the channel yet.
+        """
+        return self.checkpoints.get(str(channel_id))
+
+    def end_channel_catch_up(self, channel_id):
+        """
+        Mark a channel's catch-up as done, letting live messages move its checkpoint again.
+
+        Returns: None.
+
+        """
+        channel_id = str(channel_id)
+        self._caught_up_channels.add(channel_id)
+        self._release_checkpoint(channel_id)
+
+    def fail_channel_catch_up(self, channel_id):
+        """
+        Mark a channel's catch-up as failed: its checkpoint stays where the catch-up stopped and its live messages
+        are no longer counted, leaving the rest of the gap to the next startup's catch-up.
+
+        Returns: None.
+
+        """
+        channel_id = str(channel_id)
+        self._failed_channels.add(channel_id)
+        self._held_checkpoints.pop(channel_id, None)
+
+    def end_catch_up(self):
+        """
+        Mark the catch-up after startup as done for every channel that hasn't failed it.
+
+        Returns: None.
+
+        """
+        for channel_id in list(self._held_checkpoints.keys()):
+            self._release_checkpoint(channel_id)
+
+        self._catching_up = False
+        self._recent_message_ids = set()
+        self._caught_up_channels = set()
+
+    def _release_checkpoint(self, channel_id):
+        held_checkpoint = self._held_checkpoints.pop(channel_id, None)
+
+        if held_checkpoint is not None and held_checkpoint > self.checkpoints.get(channel_id, 0):
+            self.checkpoints[channel_id] = held_checkpoint
+            self.dirty = True
+
+    def record_message(self, message, live=True):
+        """
+        Count a message into its author's bucket for the day it was sent and advance its channel's checkpoint.
+
+        Args:
+            message (discord.Message): the message to count.
+            live (bool): False for messages read back from the channel history by the catch-up.
+
+        Returns (bool): False if the message had already been counted, or is left to the next catch-up.
+        """
+        if live and str(message.channel.id) in self._failed_channels:
+            return False
+
+        if self._catching_up:
+            if message.id in self._recent_message_ids:
+                return False
+            self._recent_message_ids.add(message.id)
+
+        chat_day = message.created_at.strftime("%Y-%m-%d")
+        day_bucket = self.daily_chat.setdefault(str(message.author.id), {}).setdefault(chat_day, [0, 0])
+        day_bucket[0] += 1
+        day_bucket[1] += len(message.content)
+
+        channel_id = str(message.channel.id)
+        if live and self._catching_up and channel_id not in self._caught_up_channels:
+            # Hold it back, or the catch-up would start past the messages missed while offline
+            if message.id > self._held_checkpoints.get(channel_id, 0):
+                self._held_checkpoints[channel_id] = message.id
+        elif message.id > self.checkpoints.get(channel_id, 0):
+            self.checkpoints[channel_id] = message.id
+
+        self.dirty = True
+
+        return True
+
+    def prune(self, oldest_day):
+        """
+        Drop every bucket older than the given day.
+
+        Args:
+            oldest_day (str): "%Y-%m-%d" of the oldest day to keep.
+
+        Returns: None.
+
+        """
+        for discord_id in list(self.daily_chat.keys()):
+            user_days = self.daily_chat[discord_id]
+
+            for chat_day in [chat_day for chat_day in user_days.keys() if chat_day < oldest_day]:
+                del user_days[chat_day]
+                self.dirty = True
+
+            if len(user_days) == 0:
+                del self.daily_chat[discord_id]
+
+    def totals(self, oldest_day):
+        """
+        Sum every user's buckets from a day on.
+
+        Args:
+            oldest_day (str): "%Y-%m-%d" of the oldest day to count.
+
+        Returns (dict): discord ID (str) -> {'chat_events': .., 'characters_typed': .., 'vc_minutes': ..}
+        """
+        return {discord_id: self.user_totals(discord_id, oldest_day) for discord_id in self.daily_chat.keys()}
+
+    def user_totals(self, discord_id, oldest_day):
+        """
+        Sum one user's buckets from a day on.
+
+        Args:
+            discord_id (str): the user.
+            oldest_day (str): "%Y-%m-%d" of the oldest day to count.
+
+        Returns (dict): {'chat_events': .., 'characters_typed': .., 'vc_minutes': ..}
+        """
+        period_buckets = [day_bucket for chat_day, day_bucket in self.daily_chat.get(str(discord_id), {}).items()
+                          if chat_day >= oldest_day]
+
+        return {
+            'chat_events': sum(day_bucket[0] for day_bucket in period_buckets),
+            'characters_typed': sum(day_bucket[1] for day_bucket in period_buckets),
+            'vc_minutes': 0
+        }
@@ -1,25 +1,59 @@
+import asyncio
 import datetime
 import discord
-import json
-import os
+import activity_engine
 import bungie_api
 from discord.ext import commands, tasks
 import cogs.clan_activity
+import job_queue
+import refresh_scheduler
+import score_engine
+import user_cache
 
 import config
 
+# Hours between nightly activity runs
+ACTIVITY_UPDATE_HOURS = 24
+
+
 class BackgroundTasks(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+        # (run_id, discord_id) of members whose update is waiting on the next user record flush
+        self._completed_members = []
+
+        # Set once the chat counters have caught up on the messages missed while offline
+        self._discord_caught_up = asyncio.Event()
+
+        self.discord_catch_up.start()
         self.clan_roster_update.start()
         self.clan_activity_update.start()
         self.clan_discord_name_update.start()
+        self.chat_activity_save.start()
+        self.user_cache_flush.start()
+
+        if self.bot.activity_jobs is not None:
+            self.activity_job_results.start()
+
+        if job_queue.ACTIVITY_UPDATE_MODE == 'rolling':
+            self.bot.refresh_scheduler = refresh_scheduler.RefreshScheduler(self._refresh_member)
+            for user_data in self.bot.user_cache.all():
+                self.bot.refresh_scheduler.track(user_data['discord_id'], self._refreshed_at(user_data))
+
+            self.activity_refresh.start()
 
     def cog_unload(self):
+        self.discord_catch_up.cancel()
         self.clan_roster_update.cancel()
         self.clan_activity_update.cancel()
         self.clan_discord_name_update.cancel()
+        self.chat_activity_save.cancel()
+        self.user_cache_flush.cancel()
+        self.activity_job_results.cancel()
+        self.activity_refresh.cancel()
+        self.bot.refresh_scheduler = None
+        self.bot.chat_tracker.save()
 
     ####################################################################################################################
     # Clan Roster Updater
@@ -27,15 +61,29 @@ class BackgroundTasks(commands.Cog):
     @tasks.loop(hours=1)
     async def clan_roster_update(self):
         print("[*] >>> BACKGROUND: Updating clan rosters per background task...")
+        clan_rosters = await bungie_api.fetch_clan_lists(self.bot.bungie, config.BREW_CLANS)
+
         for clan in config.BREW_CLANS:
-            clan_members = bungie_api.generate_clan_list(clan['clan_id'])
+            clan_members = clan_rosters[clan['clan_id']]
+
+            # Keep the last good roster rather than saving a partial one
+            if clan_members is None:
+                print("[!] >>> BACKGROUND: Unable to pull the roster for {}, keeping the cached one.".format(
+                    clan['clan_name']))
+                continue
+
+            # Only touch the database and the index if the roster actually changed
+            joined, left, changed = self.bot.roster_index.diff_clan(clan['clan_id'], clan_members)
+            if not changed:
+                continue
 
-            clan_data = {}
-            clan_data.update({'last_updated': str(datetime.datetime.utcnow())})
-            clan_data.update({'members': clan_members})
+            print("[*] >>> BACKGROUND: {}: {} joined, {} left.".format(clan['clan_name'], len(joined), len(left)))
 
-            with open(config.BOT_BASEDIR + "clans/" + str(clan['clan_id']) + ".json", 'w+') as clan_data_file:
-                json.dump(clan_data, clan_data_file)
+            await self.bot.loop.run_in_executor(None, self.bot.db_session.save_clan_roster, clan['clan_id'],
+                                                clan_members, str(datetime.datetime.utcnow()), joined, left)
+
+            # Swap the fresh roster into the membership index
+            self.bot.roster_index.update_clan(clan['clan_id'], clan_members)
 
         print("[*] >>> BACKGROUND: Clan rosters updated!")
 
@@ -50,129 +98,378 @@ class BackgroundTasks(commands.Cog):
     ####################################################################################################################
     # Clan Discord Name Updater
 
-    @tasks.loop(hours=1)
+    # Runs once at startup to pick up any renames missed while the bot was offline; from then on the member events
+    # below keep the names current
+    @tasks.loop(count=1)
     async def clan_discord_name_update(self):
-        print("[*] >>> BACKGROUND: Updating clan's discord names in DB...")
-
-        for user_file in os.listdir(config.BOT_DB):
-            if user_file.endswith(".json"):
-                with open(config.BOT_DB + user_file) as user_file_data:
-                    user_data = json.load(user_file_data)
-                           
-                for guild in self.bot.guilds:
-                    # Only do Ace's Brew Discord
-                    if guild.id == 534781834924523520:
-                        for member in guild.members:
-                            if str(member.id) == str(user_data['discord_id']):
-                                if member.nick is not None:
-                                    user_data['discord_name'] = str(member.nick)
-                                else:
-                                    user_data['discord_name'] = str(member.display_name)
-
-                                with open(config.BOT_DB + user_file, 'w') as user_write_file:
-                                    json.dump(user_data, user_write_file)
-
-        print("[*] >>> BACKGROUND: Discord names updated!")
+        print("[*] >>> BACKGROUND: Reconciling clan's discord names in DB...")
+
+        renamed_members = 0
+
+        for guild in self.bot.guilds:
+            # Only do Ace's Brew Discord
+            if guild.id == 534781834924523520:
+                for user_data in self.bot.user_cache.all():
+                    member = guild.get_member(int(user_data['discord_id']))
+
+                    if member is not None and self._sync_discord_name(member):
+                        renamed_members += 1
+
+        print("[*] >>> BACKGROUND: Discord names reconciled, {} changed!".format(renamed_members))
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        self._sync_discord_name(after)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self._sync_discord_name(member)
+
+    def _sync_discord_name(self, member):
+        """
+        Copy a member's current discord name onto their record, if they are registered and it has changed.
+
+        Args:
+            member (discord.Member): the member to sync.
+
+        Returns (bool): True if the record was changed.
+        """
+        # Only do Ace's Brew Discord
+        if member.guild.id != 534781834924523520:
+            return False
+
+        user_data = self.bot.user_cache.get(member.id)
+        if user_data is None:
+            return False
+
+        if member.nick is not None:
+            discord_name = str(member.nick)
+        else:
+            discord_name = str(member.display_name)
+
+        if user_data['discord_name'] == discord_name:
+            return False
+
+        user_data['discord_name'] = discord_name
+        self.bot.user_cache.mark_dirty(user_data)
+
+        return True
 
     @clan_discord_name_update.before_loop
     async def before_discord_clan_update(self):
         print("Waiting to start clan discord name updater until bot is ready...")
         await self.bot.wait_until_ready()
 
-    # End of Clan Roster Updater
+    # End of Clan Discord Name Updater
+    ####################################################################################################################
+
+    ####################################################################################################################
+    # Discord Catch Up
+
+    @tasks.loop(count=1)
+    async def discord_catch_up(self):
+        activity_manager = cogs.clan_activity.ClanActivity(self.bot)
+
+        # Straight after startup, before live traffic has piled up on top of the gap
+        try:
+            missed_messages = await activity_manager.catch_up_discord_activity()
+            print("[*] >>> BACKGROUND: Counted {} missed discord messages.".format(missed_messages))
+
+            self.bot.chat_tracker.save()
+        finally:
+            self._discord_caught_up.set()
+
+    @discord_catch_up.before_loop
+    async def before_discord_catch_up(self):
+        await self.bot.wait_until_ready()
+
+    # End of Discord Catch Up
+    ####################################################################################################################
+
+    ####################################################################################################################
+    # Chat Activity Saver
+
+    @tasks.loop(minutes=5)
+    async def chat_activity_save(self):
+        self.bot.chat_tracker.save()
+
+    # End of Chat Activity Saver
+    ####################################################################################################################
+
+    ####################################################################################################################
+    # User Record Flusher
+
+    @tasks.loop(seconds=user_cache.USER_CACHE_FLUSH_INTERVAL)
+    async def user_cache_flush(self):
+        await self._flush_user_records()
+
+        # Tells stat_updater.py not to write user records behind the cache's back
+        await self.bot.loop.run_in_executor(None, self.bot.db_session.touch_bot_heartbeat, self._timestamp())
+
+    async def _flush_user_records(self):
+        """
+        Write back changed user records, then checkpoint the activity run members they cover.
+
+        Members are only marked done once their records are in the database, so a restart never skips someone whose
+        update was lost with the cache.
+
+        Returns: None.
+
+        """
+        completed_members, self._completed_members = self._completed_members, []
+
+        try:
+            await self.bot.user_cache.flush()
+        except Exception:
+            self._completed_members = completed_members + self._completed_members
+            raise
+
+        if len(completed_members) > 0:
+            await self.bot.loop.run_in_executor(None, self.bot.db_session.complete_activity_run_members,
+                                                completed_members, self._timestamp())
+
+    @staticmethod
+    def _timestamp():
+        return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    @staticmethod
+    def _statistics_period_start():
+        reporting_period = datetime.datetime.utcnow() - datetime.timedelta(days=(int(config.STATISTICS_PERIOD)))
+        return reporting_period.strftime("%Y-%m-%d")
+
+    # End of User Record Flusher
+    ####################################################################################################################
+
+    ####################################################################################################################
+    # Activity Job Results
+
+    @tasks.loop(seconds=job_queue.ACTIVITY_JOB_POLL_INTERVAL)
+    async def activity_job_results(self):
+        finished_jobs = await self.bot.loop.run_in_executor(None, self.bot.activity_jobs.finished)
+        if len(finished_jobs) == 0:
+            return
+
+        updated_users = []
+
+        for finished_job in finished_jobs:
+            user_data = self.bot.user_cache.get(finished_job['discord_id'])
+
+            # They may have left since the job was queued
+            if user_data is None:
+                continue
+
+            job_result = finished_job['result']
+            self.bot.activity_engine.merge_bungie_stats(user_data, job_result['game_activity'])
+            for profile_field in ('membership_type', 'character_ids', 'profile_resolved_at'):
+                user_data[profile_field] = job_result.get(profile_field)
+
+            updated_users.append(user_data)
+
+        # Scores only depend on the member's own stats, so only the members with new results need rescoring
+        score_engine.score_users(updated_users, self.bot.chat_tracker.daily_chat)
+        for user_data in updated_users:
+            self.bot.user_cache.mark_dirty(user_data)
+            self.bot.ranking_index.update(user_data)
+
+        await self.bot.loop.run_in_executor(None, self.bot.activity_jobs.acknowledge,
+                                            [finished_job['job_id'] for finished_job in finished_jobs])
+
+        job_progress = await self.bot.loop.run_in_executor(None, self.bot.activity_jobs.progress)
+        print("[*] >>> BACKGROUND: Applied {} activity job results, queue: {}".format(len(finished_jobs),
+                                                                                     job_progress))
+
+    @activity_job_results.before_loop
+    async def before_activity_job_results(self):
+        await self.bot.wait_until_ready()
+
+    # End of Activity Job Results
+    ####################################################################################################################
+
+    ####################################################################################################################
+    # Rolling Activity Refresh
+
+    @tasks.loop(count=1)
+    async def activity_refresh(self):
+        print("[*] >>> BACKGROUND: Refreshing {} members over {} hours, stalest first.".format(
+            self.bot.refresh_scheduler.size(), refresh_scheduler.ACTIVITY_REFRESH_PERIOD / 3600))
+
+        await self.bot.refresh_scheduler.run()
+
+    @activity_refresh.before_loop
+    async def before_activity_refresh(self):
+        await self.bot.wait_until_ready()
+
+    async def _refresh_member(self, discord_id):
+        """
+        Refresh one member's discord and bungie stats and move them on the leaderboard, for the refresh scheduler.
+
+        Returns (bool): False if they are no longer registered.
+        """
+        user_data = self.bot.user_cache.get(discord_id)
+        if user_data is None:
+            return False
+
+        # Only this member's chat buckets; summing everyone's per refresh would make a rotation quadratic
+        discord_stats = {str(user_data['discord_id']): self.bot.chat_tracker.user_totals(
+            user_data['discord_id'], self._statistics_period_start())}
+        await self.bot.activity_engine.update_member(user_data, discord_stats)
+
+        user_data['activity_refreshed_at'] = self._timestamp()
+        score_engine.score_users([user_data], self.bot.chat_tracker.daily_chat)
+        self.bot.user_cache.mark_dirty(user_data)
+        self.bot.ranking_index.update(user_data)
+
+        return True
+
+    @staticmethod
+    def _refreshed_at(user_data):
+        """
+        When the member was last refreshed by the rolling refresh.
+
+        Returns (float): time.time() of the refresh, 0 if they never were.
+        """
+        if user_data.get('activity_refreshed_at') is None:
+            return 0.0
+
+        return datetime.datetime.strptime(user_data['activity_refreshed_at'], "%Y-%m-%d %H:%M:%S").replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+    # End of Rolling Activity Refresh
     ####################################################################################################################
 
     ####################################################################################################################
     # Clan Activity Updater
 
-    @tasks.loop(hours=24)
+    @tasks.loop(hours=ACTIVITY_UPDATE_HOURS)
     async def clan_activity_update(self):
         print("[*] >>> Updating clan activity scores per background task...")
-        activity_manager = cogs.clan_activity.ClanActivity(self.bot)
 
-        for user_file in os.listdir(config.BOT_DB):
-            if user_file.endswith(".json"):
-                with open(config.BOT_DB + user_file) as user_file_data:
-                    user_data = json.load(user_file_data)
+        # A run resumed at startup waits for the chat counters to catch up first; then drop the expired days
+        await self._discord_caught_up.wait()
+
+        kept_from = datetime.datetime.utcnow() - datetime.timedelta(days=score_engine.kept_days())
+        self.bot.chat_tracker.prune(kept_from.strftime("%Y-%m-%d"))
+        self.bot.chat_tracker.save()
 
-                print("[*] >>> BACKGROUND: Updating to {}'s stats...".format(user_data['bungie_name']))
+        discord_stats = self.bot.chat_tracker.totals(self._statistics_period_start())
+        users = self.bot.user_cache.all()
 
-                # Calculate discord stats
-                discord_stats = await activity_manager.get_user_discord_activity_stats(user_data['discord_id'])
+        # The refresh scheduler takes care of the Bungie side through the day; just bring the discord side up to date
+        if self.bot.refresh_scheduler is not None:
+            for user_data in users:
+                self.bot.activity_engine.apply_discord_stats(discord_stats, user_data)
 
-                # Update the data in the user's record
-                user_data['chat_events'] = discord_stats['chat_events']
-                user_data['characters_typed'] = discord_stats['characters_typed']
-                user_data['vc_minutes'] = discord_stats['vc_minutes']
+            score_engine.score_users(users, self.bot.chat_tracker.daily_chat)
+            for user_data in users:
+                self.bot.user_cache.mark_dirty(user_data)
+                self.bot.ranking_index.update(user_data)
 
-                # Calculate bungie stats
-                daily_bungie_stats = {}
+            print("[*] >>> Updating clan activity scores updated in background complete!")
+            return
 
-                today_utc = datetime.datetime.utcnow()
-                today_report = today_utc.strftime("%Y-%m-%d")
-                reporting_period = (today_utc - datetime.timedelta(days=(int(config.STATISTICS_PERIOD))))
+        # Pick up where a restart left off, or start a new run over everyone
+        activity_run = await self.bot.loop.run_in_executor(
+            None, self.bot.db_session.open_activity_run, cogs.clan_activity.ACTIVITY_RUN_SOURCE,
+            [user_data['discord_id'] for user_data in users], self._timestamp())
 
-                iter_date = reporting_period
+        # Leave the Bungie side to the worker processes if there are any; the job queue is their checkpoint
+        if self.bot.activity_jobs is not None:
+            await self._enqueue_activity_jobs(discord_stats, users)
+            await self.bot.loop.run_in_executor(None, self.bot.db_session.finish_activity_run,
+                                                activity_run['run_id'], self._timestamp())
+            return
 
-                while iter_date < today_utc:
-                    print(">>> STATS FOR: {}".format(iter_date))
+        pending_ids = await self.bot.loop.run_in_executor(None, self.bot.db_session.get_activity_run_pending,
+                                                          activity_run['run_id'])
 
-                    # See if we have stats already for that date (we don't pull current day))
-                    if iter_date.strftime("%Y-%m-%d") in user_data['game_activity'].keys() and iter_date.strftime("%Y-%m-%d") != today_report:
-                        daily_bungie_stats.update(
-                            {
-                                iter_date.strftime("%Y-%m-%d"): user_data['game_activity'][iter_date.strftime("%Y-%m-%d")]
-                            }
-                        )
+        # Anyone who left since the run started is skipped
+        run_users = [self.bot.user_cache.get(discord_id) for discord_id in pending_ids]
+        run_users = [user_data for user_data in run_users if user_data is not None]
 
-                    # If we don't, get them
-                    else:
-                        bungie_stats = await activity_manager.get_user_bungie_activity_stats(user_data['bungie_id'], iter_date)
+        if activity_run['resumed']:
+            print("[*] >>> BACKGROUND: Resuming activity run {} from {}, {}/{} members done.".format(
+                activity_run['run_id'], activity_run['started_at'], activity_run['completed'], activity_run['total']))
 
-                        daily_bungie_stats.update(
-                            {
-                                iter_date.strftime("%Y-%m-%d"): {
-                                    "seconds_played": bungie_stats['seconds_played'],
-                                    "unique_clan_members_played_with": bungie_stats['unique_clan_members_played_with'],
-                                    "clan_members_played_with": bungie_stats['clan_members_played_with']
-                                }
-                            }
-                        )
+        await self.bot.activity_engine.update_members(
+            run_users, activity_engine.ACTIVITY_UPDATE_WORKERS, discord_stats,
+            on_member_done=lambda user_data: self._member_updated(activity_run['run_id'], user_data))
 
-                    iter_date = iter_date + datetime.timedelta(days=1)
+        # Score everyone in one pass
+        score_engine.score_users(users, self.bot.chat_tracker.daily_chat)
+        for user_data in users:
+            self.bot.user_cache.mark_dirty(user_data)
+            self.bot.ranking_index.update(user_data)
 
-                # Update the data in the user's record.
-                user_data['game_activity'] = daily_bungie_stats
+        await self._flush_user_records()
+        await self.bot.loop.run_in_executor(None, self.bot.db_session.finish_activity_run, activity_run['run_id'],
+                                            self._timestamp())
 
+        print("[*] >>> Updating clan activity scores updated in background complete!")
+        print("[*] >>> PGCR cache: {}".format(self.bot.pgcr_cache.stats()))
 
-                total_seconds_played = 0
-                total_unique_members_played_with = 0
-                total_clan_members_played_with = 0
+    def _member_updated(self, run_id, user_data):
+        """
+        Queue a member's record for write-back and checkpoint them as done once it is written.
 
-                for stat_day, stat_values in user_data['game_activity'].items():
-                    total_seconds_played += user_data['game_activity'][stat_day]['seconds_played']
-                    total_unique_members_played_with += user_data['game_activity'][stat_day]['unique_clan_members_played_with']
-                    total_clan_members_played_with += user_data['game_activity'][stat_day]['clan_members_played_with']
+        Returns: None.
 
-                bonus_multiplier = total_clan_members_played_with + total_unique_members_played_with
-                activity_score = total_seconds_played + (user_data['chat_events'] * 60) + \
-                                               (user_data['characters_typed'] * 3) * bonus_multiplier
+        """
+        self.bot.user_cache.mark_dirty(user_data)
+        self._completed_members.append((run_id, str(user_data['discord_id'])))
 
-                user_data['clan_activity_score'] = activity_score
+    async def _enqueue_activity_jobs(self, discord_stats, users):
+        """
+        Hand every member's Bungie update to the worker processes instead of running it here.
 
-                with open(config.BOT_DB + user_file, 'w') as user_file_data:
-                    json.dump(user_data, user_file_data)
+        Their discord stats are updated straight away; the Bungie results are applied by activity_job_results as the
+        workers finish them.
 
-                print("[*] >>> BACKGROUND: Update to {}'s stats complete.".format(user_data['bungie_name']))
+        Returns: None.
 
-        print("[*] >>> Updating clan activity scores updated in background complete!")
+        """
+        jobs = []
+
+        for user_data in users:
+            self.bot.activity_engine.apply_discord_stats(discord_stats, user_data)
+            self.bot.user_cache.mark_dirty(user_data)
 
+            missing_days = self.bot.activity_engine.missing_days(user_data)
+            if len(missing_days) == 0:
+                continue
+
+            jobs.append((user_data['discord_id'], {
+                'bungie_id': user_data['bungie_id'],
+                'bungie_name': user_data['bungie_name'],
+                'days': [missing_day.strftime("%Y-%m-%d") for missing_day in missing_days],
+                'membership_type': user_data.get('membership_type'),
+                'character_ids': user_data.get('character_ids'),
+                'profile_resolved_at': user_data.get('profile_resolved_at')
+            }))
+
+        queued_jobs = await self.bot.loop.run_in_executor(None, self.bot.activity_jobs.enqueue, jobs)
+
+        print("[*] >>> BACKGROUND: Queued {} activity jobs for the workers.".format(queued_jobs))
 
     @clan_activity_update.before_loop
     async def before_clan_activity_update(self):
         print("Waiting to start clan activity updater until bot is ready...")
         await self.bot.wait_until_ready()
 
+        # Keep the nightly cadence across restarts: an unfinished run resumes straight away, otherwise wait out
+        # whatever is left of the interval since the last run started
+        activity_run = await self.bot.loop.run_in_executor(None, self.bot.db_session.get_activity_run,
+                                                           cogs.clan_activity.ACTIVITY_RUN_SOURCE)
+
+        if activity_run is not None and activity_run['finished_at'] is not None:
+            next_run = (datetime.datetime.strptime(activity_run['started_at'], "%Y-%m-%d %H:%M:%S") +
+                        datetime.timedelta(hours=ACTIVITY_UPDATE_HOURS))
+            wait_seconds = (next_run - datetime.datetime.utcnow()).total_seconds()
+
+            if wait_seconds > 0:
+                print("[*] >>> BACKGROUND: Last activity run started {}, next one at {}.".format(
+                    activity_run['started_at'], next_run.strftime("%Y-%m-%d %H:%M:%S")))
+                await asyncio.sleep(wait_seconds)
+
     # End of Clan Roster Updater
     ####################################################################################################################
 
@@ -1,13 +1,21 @@
+import asyncio
 import datetime
 from dateutil import tz
-import os
-import json
 from discord.ext import commands
 import discord
-import pydest
-import time
+import api_metrics
+import score_engine
 import config
 
+# Number of text channels whose history is read at the same time when catching up
+DISCORD_HISTORY_CONCURRENCY = getattr(config, 'DISCORD_HISTORY_CONCURRENCY', 4)
+
+# Leaderboard entries shown per embed
+LEADERBOARD_PAGE_SIZE = getattr(config, 'LEADERBOARD_PAGE_SIZE', 20)
+
+# Name the bot's nightly activity runs are checkpointed under
+ACTIVITY_RUN_SOURCE = 'bot'
+
 
 def is_authorized():
     """
@@ -48,264 +56,259 @@ class ClanActivity(commands.Cog):
             # If we are just looking up the author's stats
             print(ctx.message.mentions)
             if len(ctx.message.mentions) == 0:
-                try:
-                    with open(config.BOT_DB + str(ctx.author.id) + ".json") as user_data_file:
-                        user_data = json.load(user_data_file)
-
-                        report_message = self._print_activity_report(user_data)
-                        await ctx.send(embed=report_message)
+                user_data = self.bot.user_cache.get(ctx.author.id)
 
-                except FileNotFoundError:
+                if user_data is None:
                     await ctx.send("You do not appear to be registered with me.")
                     return
 
+                await self._refresh_for_report(user_data)
+                report_message = self._print_activity_report(user_data)
+                await ctx.send(embed=report_message)
+
             # Else, we need to find the user they are looking for
             else:
                 for mention in ctx.message.mentions:
-                    try:
-                        with open(config.BOT_DB + str(mention.id) + ".json") as user_data_file:
-                            user_data = json.load(user_data_file)
-
-                            report_message = self._print_activity_report(user_data)
-                            await ctx.send(embed=report_message)
+                    user_data = self.bot.user_cache.get(mention.id)
 
-                    except FileNotFoundError:
+                    if user_data is None:
                         await ctx.send(
                             "Unable to find stats for {} among my registered members. Please verify the name and "
                             "search again.".format(
                                 mention.mention))
                         return
 
-    async def get_user_discord_activity_stats(self, discord_id):
-        stat_results = {}
-        chat_events = 0
-        characters_typed = 0
+                    await self._refresh_for_report(user_data)
+                    report_message = self._print_activity_report(user_data)
+                    await ctx.send(embed=report_message)
+
+    async def _refresh_for_report(self, user_data):
+        """
+        With the rolling refresh running, bring a member's stats up to date ahead of their turn before reporting them.
+
+        A failed refresh is reported and the stats on record are shown instead.
+
+        Returns: None.
+
+        """
+        if self.bot.refresh_scheduler is None:
+            return
+
+        try:
+            # Shielded so a cancelled command doesn't cancel the refresh for anyone else waiting on it
+            await asyncio.shield(self.bot.refresh_scheduler.request(user_data['discord_id']))
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            print("[!] Unable to refresh {} for their activity report: {}: {}".format(
+                user_data['bungie_name'], ex.__class__.__name__, ex))
+
+    @commands.command()
+    @is_authorized()
+    async def leaderboard(self, ctx, *args):
+        """Show the clan activity leaderboard.
+
+            `$leaderboard` shows the top 10 across all clans.
+            `$leaderboard [clan] [n]` shows the top n of a clan; a negative n shows the bottom n instead.
+            If your clan name is more than 1 word, put quotation marks around it.
+        """
+        clan = None
+        count = 10
+
+        for arg in args:
+            try:
+                count = int(arg)
+                continue
+            except ValueError:
+                pass
+
+            clan = next((brew_clan for brew_clan in config.BREW_CLANS
+                         if str(arg).casefold() == str(brew_clan['clan_name']).casefold()), None)
+            if clan is None:
+                await ctx.send("I don't know a clan called {}.".format(arg))
+                return
+
+        clan_id = clan['clan_id'] if clan is not None else None
+        board_name = clan['clan_name'] if clan is not None else "All Clans"
+
+        if count < 0:
+            board_entries = self.bot.ranking_index.bottom(-count, clan_id)
+            title = "Clan Activity Leaderboard - {} (bottom {})".format(board_name, len(board_entries))
+        else:
+            board_entries = self.bot.ranking_index.top(count, clan_id)
+            title = "Clan Activity Leaderboard - {} (top {})".format(board_name, len(board_entries))
+
+        if len(board_entries) == 0:
+            await ctx.send("Nobody is ranked there yet.")
+            return
+
+        author_rank = self.bot.ranking_index.rank(ctx.author.id, clan_id)
+
+        for page_start in range(0, len(board_entries), LEADERBOARD_PAGE_SIZE):
+            board_lines = []
+
+            for rank, discord_id, score in board_entries[page_start:page_start + LEADERBOARD_PAGE_SIZE]:
+                user_data = self.bot.user_cache.get(discord_id)
+                board_lines.append("**{}.** {} - {:,}".format(rank, user_data['bungie_name'], int(score)))
+
+            embed = discord.Embed(title=title, description="\n".join(board_lines))
+            if author_rank is not None:
+                embed.set_footer(text="You are ranked #{} of {}.".format(
+                    author_rank, self.bot.ranking_index.size(clan_id)))
+
+            await ctx.send(embed=embed)
+
+    @commands.command()
+    @is_authorized()
+    async def apistats(self, ctx):
+        """Show Bungie API request statistics.
+        """
+        embed = discord.Embed(title="Bungie API Stats", description="Requests since the bot started.")
+
+        for endpoint, endpoint_metrics in sorted(self.bot.bungie.metrics.endpoints.items()):
+            error_codes = ", ".join("{}: {}".format(error_code, count)
+                                    for error_code, count in sorted(endpoint_metrics.error_codes.items()))
+
+            embed.add_field(name=endpoint, value=(
+                "Requests: {:,}\n"
+                "Latency: avg {:.0f}ms, p50 <= {}, p95 <= {}\n"
+                "ErrorCodes: {}\n"
+                "Retries: {:,}, failures: {:,}\n"
+                "Saved by sharing in-flight calls: {:,}\n"
+                "Throttled: {:,} ({:.0f}s total, {:.0f}s max)").format(
+                endpoint_metrics.requests,
+                1000 * endpoint_metrics.latency_sum / max(1, endpoint_metrics.requests),
+                self._format_latency(endpoint_metrics.latency_quantile(0.5)),
+                self._format_latency(endpoint_metrics.latency_quantile(0.95)),
+                error_codes or "none", endpoint_metrics.retries, endpoint_metrics.failures,
+                endpoint_metrics.coalesced,
+                endpoint_metrics.throttled, endpoint_metrics.throttle_seconds,
+                endpoint_metrics.max_throttle_seconds), inline=False)
+
+        if len(embed.fields) == 0:
+            await ctx.send("No Bungie API requests yet.")
+            return
+
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @is_authorized()
+    async def activityrun(self, ctx):
+        """Show how far along the nightly activity run is.
+        """
+        activity_run = await self.bot.loop.run_in_executor(None, self.bot.db_session.get_activity_run,
+                                                           ACTIVITY_RUN_SOURCE)
+        if activity_run is None:
+            await ctx.send("No activity run yet.")
+            return
+
+        if activity_run['finished_at'] is None:
+            status = "In progress"
+        else:
+            status = "Finished {} UTC".format(activity_run['finished_at'])
+
+        embed = discord.Embed(title="Activity Run #{}".format(activity_run['run_id']), description=status)
+        embed.add_field(name="Started", value="{} UTC".format(activity_run['started_at']))
+
+        if activity_run['total'] > 0:
+            embed.add_field(name="Members Done", value="{:,}/{:,} ({:.0%})".format(
+                activity_run['completed'], activity_run['total'], activity_run['completed'] / activity_run['total']))
+
+        # In queue mode the work is tracked by the job queue instead
+        if self.bot.activity_jobs is not None:
+            job_progress = await self.bot.loop.run_in_executor(None, self.bot.activity_jobs.progress)
+            embed.add_field(name="Activity Jobs", value=", ".join(
+                "{}: {:,}".format(job_status, count) for job_status, count in sorted(job_progress.items())) or "none")
+
+        await ctx.send(embed=embed)
+
+    @staticmethod
+    def _format_latency(latency):
+        if latency is None:
+            return "n/a"
+        if latency == float('inf'):
+            return "{:.0f}s+".format(api_metrics.LATENCY_BUCKETS[-1])
+
+        return "{:.0f}ms".format(latency * 1000)
+
+    async def catch_up_discord_activity(self):
+        """
+        Top up the chat counters with any messages the bot missed while it was offline.
+
+        Each text channel is read from its checkpoint onwards (or from the oldest day kept on record if the channel
+        has no checkpoint or it is older than that), a few channels at a time. discord.py paces the history
+        requests to Discord's rate limits. Live messages don't move a channel's checkpoint until its catch-up is done
+        (see ChatTracker), so this is meant to run once, right after startup. A channel that can't be read is left
+        for the next startup's catch-up.
+
+        Returns (int): number of messages that had been missed.
+        """
         today = datetime.datetime.utcnow()
+        days_before = score_engine.kept_days()
+        reporting_period = today - datetime.timedelta(days_before)
+        period_start = discord.utils.time_snowflake(reporting_period, high=True)
+
+        channel_slots = asyncio.Semaphore(DISCORD_HISTORY_CONCURRENCY)
+        channels = []
 
         for guild in self.bot.guilds:
             # Only do Ace's Brew Discord
             if guild.id == 534781834924523520:
-                for channel in guild.text_channels:
-                    days_before = config.STATISTICS_PERIOD
-                    reporting_period = today - datetime.timedelta(days_before)
-
-                    async for message in channel.history(limit=None, after=reporting_period):
-                        if str(message.author.id) == str(discord_id):
-                            chat_events += 1
-                            characters_typed += len(message.content)
-
-        stat_results.update({'characters_typed': int(characters_typed)})
-        stat_results.update({'chat_events': int(chat_events)})
-        stat_results.update({'vc_minutes': 0})
-
-        return stat_results
-
-    async def get_user_bungie_activity_stats(self, bungie_id, day_to_pull):
-            stat_results = {}
-            today_utc = datetime.datetime.utcnow()
-            days_before = config.STATISTICS_PERIOD
-
-            profile_types = [3, 2, 1, 5]
-            member_type = None
-
-            for profile_type in profile_types:
-                while True:
-                    try:
-                        destiny = pydest.Pydest(config.BUNGIE_API_KEY)
-
-                        profile_data = await destiny.api.get_profile(profile_type, bungie_id, components=['100'])
-                        await self.debug_api_call(profile_data)
-
-                        await destiny.close()
-                    except:
-                       time.sleep(2)
-                       await destiny.close()
-                       print("Trying call again...")
-                       continue 
-
-                    break
-
-                if str(profile_data['ErrorCode']) == "1":
-
-                    member_type = profile_type
-
-                    character_ids = profile_data['Response']['profile']['data']['characterIds']
-
-                    seconds_played = 0
-                    clan_members_played_with = 0
-                    unique_clan_members_played_with = set()
-                    for character_id in character_ids:
-                        pull_more_reports = True
-                        report_page = 0
-
-                        while pull_more_reports:
-                            # Pull the first 25 activities for the characters
-                            while True:
-                                try:
-                                    destiny = pydest.Pydest(config.BUNGIE_API_KEY)
-
-                                    history_report = await destiny.api.get_activity_history(member_type, bungie_id, character_id, count=25, mode=None, page=report_page)
-                                    await self.debug_api_call(history_report)
-
-                                    await destiny.close()
-
-                                except:
-                                   time.sleep(2)
-                                   await destiny.close()
-                                   print("Trying call again...")
-                                   continue 
-
-                                break
-
-                            # See if their profile is set to private
-                            if str(history_report['ErrorCode']) == "1665":
-                                pull_more_reports = False
-                                stat_results.update({"seconds_played": 0})
-                                stat_results.update({"clan_members_played_with": 0})
-                                stat_results.update({"unique_clan_members_played_with": 0})
-                                break
-
-                            # If we don't get a response, we're done
-                            if len(history_report['Response']) == 0:
-                                pull_more_reports = False
-                                break
-
-                            # See if it has any activities in it
-                            if 'activities' not in history_report['Response'].keys():
-                                break
-
-                            # Increment the page count if we loop back
-                            report_page += 1
-                            character_activities = history_report['Response']['activities']
-
-                            for character_activity in character_activities:
-                                activity_time = datetime.datetime.strptime(character_activity['period'],
-                                                                        '%Y-%m-%dT%H:%M:%SZ')
-
-                                # If the activity is within the reporting period; process it
-                                if activity_time.date() == day_to_pull.date():
-                                    # Calculate seconds played
-                                    seconds_played += character_activity['values']['timePlayedSeconds']['basic']['value']
-                                    
-                                    while True:
-                                        try:
-                                            destiny = pydest.Pydest(config.BUNGIE_API_KEY)
-
-                                            activity_info = await destiny.api.get_post_game_carnage_report(character_activity['activityDetails']['instanceId'])
-                                            await self.debug_api_call(activity_info)
-
-                                            await destiny.close()
-                                        except:
-                                            time.sleep(2)
-                                            await destiny.close()
-                                            print("Trying call again...")
-                                            continue
-                                    
-                                        break
-
-                                    if len(history_report['Response']) == 0:
-                                        pull_more_reports = False
-                                        break
-
-                                    # See who they played with in that activity
-                                    activity_players = activity_info['Response']['entries']
-                                    activity_clan_player_count = 0
-
-                                    for activity_player in activity_players:
-
-                                        # Make sure it isn't the player getting stats pulled on
-                                        if str(activity_player['player']['destinyUserInfo']['membershipId']) != str(
-                                                bungie_id):
-
-                                            # Deal with fireteam members who may have private profile settings
-                                            if str(activity_player['player']['destinyUserInfo']['isPublic']) == "True":
-                                                player_name = activity_player['player']['destinyUserInfo']['displayName']
-                                            else:
-                                                player_name = "<PRIVATE>"
-
-                                            player_id = activity_player['player']['destinyUserInfo']['membershipId']
-                                            print("\t\t\tLOOKUP: {} : {}".format(player_name, player_id))
-                                            # Find out if the players were in our clans
-                                            clan_search_results = await self.check_if_clan_member(bungie_id=player_id)
-
-                                            if clan_search_results['is_member']:
-                                                activity_clan_player_count += 1
-                                                unique_clan_members_played_with.add(player_id)
-
-                                    # Cap at 2.9 to not landslipe PvPers or Iron Banner participants out of control
-                                    if activity_clan_player_count > 2:
-                                        clan_members_played_with += 2.9
-                                    else:
-                                        clan_members_played_with += activity_clan_player_count
-
-                                elif activity_time.date() < day_to_pull.date():
-                                    pull_more_reports = False
-                                    break
-
-                    stat_results.update({"seconds_played": seconds_played})
-                    stat_results.update({"clan_members_played_with": clan_members_played_with})
-                    stat_results.update({"unique_clan_members_played_with": len(unique_clan_members_played_with)})
-
-                    break
-            
-                # If we get 1665 (private profile)
-                elif str(profile_data['ErrorCode']) == "1665":
-                    stat_results.update({"seconds_played": '0'})
-                    stat_results.update({"clan_members_played_with": '0'})
-                    stat_results.update({"unique_clan_members_played_with": '0'})
-                
-                # If we get some other error code
-                else:
-                    stat_results.update({"seconds_played": '0'})
-                    stat_results.update({"clan_members_played_with": '0'})
-                    stat_results.update({"unique_clan_members_played_with": '0'})
-
-            return stat_results
-
-    async def check_if_clan_member(self, bungie_id=None, profile_name=None):
-        """Checks the cached roster if member is in the clans.
-
-            Returns (dict):
-                            return_results['bungie_id'] = member['id']
-                            return_results['bungie_name'] = member['name']
-                            return_results['is_member'] = True
+                channels.extend(guild.text_channels)
+
+        # Let every scan finish before ending the catch-up, one failing must not cut the others short
+        scan_results = await asyncio.gather(*[self._catch_up_channel(channel, period_start, channel_slots)
+                                              for channel in channels], return_exceptions=True)
+
+        missed_messages = 0
+        for channel, scan_result in zip(channels, scan_results):
+            if isinstance(scan_result, Exception):
+                print("[!] Unable to catch up #{}, leaving it for the next startup: {}".format(channel, scan_result))
+                self.bot.chat_tracker.fail_channel_catch_up(channel.id)
+            else:
+                missed_messages += scan_result
+
+        self.bot.chat_tracker.end_catch_up()
+
+        return missed_messages
+
+    async def _catch_up_channel(self, channel, period_start, channel_slots):
         """
-        return_results = {}
-        return_results['is_member'] = False
-
-        for clan_roster in os.listdir("clans/"):
-            with open(config.BOT_BASEDIR + "clans/" + clan_roster) as clan_data_file:
-                clan_data = json.load(clan_data_file)
-
-            for member in clan_data['members']:
-                if bungie_id is not None:
-                    if str(member['id']) == str(bungie_id):
-                        return_results['bungie_id'] = member['id']
-                        return_results['bungie_name'] = member['name']
-                        return_results['is_member'] = True
-                        break
-
-                if profile_name is not None:
-                    if str(member['name']).lower() == str(profile_name).lower():
-                        return_results['bungie_id'] = member['id']
-                        return_results['bungie_name'] = member['name']
-                        return_results['is_member'] = True
-                        break
-            
-            # If we've found them, we don't need to keep searching
-            if return_results['is_member']:
-                break
-
-        return return_results
+        Count one channel's messages since its checkpoint.
 
-    def _print_activity_report(self, user_data):
-        total_seconds_played = 0
-        total_unique_members_played_with = 0
+        Args:
+            channel (discord.TextChannel): channel to read.
+            period_start (int): snowflake of the start of the statistics period.
+            channel_slots (asyncio.Semaphore): limits how many channels are read at once.
+
+        Returns (int): number of messages counted.
+
+        Raises:
+            discord.HTTPException: the history couldn't be read; the channel's catch-up is not done.
+        """
+        missed_messages = 0
+
+        async with channel_slots:
+            checkpoint = max(self.bot.chat_tracker.checkpoint(channel.id) or 0, period_start)
 
-        for stat_day, stat_values in user_data['game_activity'].items():
-            total_seconds_played += user_data['game_activity'][stat_day]['seconds_played']
-            total_unique_members_played_with += user_data['game_activity'][stat_day][
-                'unique_clan_members_played_with']
+            try:
+                async for message in channel.history(limit=None, after=discord.Object(id=checkpoint),
+                                                     oldest_first=True):
+                    if self.bot.chat_tracker.record_message(message, live=False):
+                        missed_messages += 1
+
+            except discord.Forbidden:
+                print("[!] Unable to read the history of #{}, skipping it.".format(channel))
+
+            # Only now is the whole gap counted; on any other error the held checkpoint is left alone
+            self.bot.chat_tracker.end_channel_catch_up(channel.id)
+
+        return missed_messages
+
+    def _print_activity_report(self, user_data):
+        activity_totals = score_engine.activity_totals(user_data)
+        total_seconds_played = int(activity_totals['seconds_played'])
+        total_unique_members_played_with = int(activity_totals['unique_clan_members_played_with'])
 
         # Determine color-based thresholds
         GREEN = 0x00ff00
@@ -340,20 +343,10 @@ class ClanActivity(commands.Cog):
         embed.add_field(name="Clan Activity Status", value=clan_activity_status,
                         inline=True)
 
-        return embed
+        if user_data.get('activity_refreshed_at') is not None:
+            embed.set_footer(text="Updated {} UTC".format(user_data['activity_refreshed_at']))
 
-    async def debug_api_call(self, api_response):
-        # if api_response['ErrorCode'] != 1:
-        time_now = datetime.datetime.utcnow()
-        print("{}: ErrorCode: {}, ThrottleSeconds: {}, Message: {}, MessageData: {}".format(time_now,
-                                                                                            api_response['ErrorCode'],
-                                                                                            api_response[
-                                                                                                'ThrottleSeconds'],
-                                                                                            api_response['Message'],
-                                                                                            api_response[
-                                                                                                'MessageData']))
-        #if 'Response' in api_response.keys():
-            #print("\t\tRESPONSE: {}".format(api_response['Response']))
+        return embed
 
 
 # Cog extension entry point
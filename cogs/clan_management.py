@@ -1,9 +1,8 @@
-import os
+import asyncio
 import discord
 from discord.ext import commands
 import json
 import csv
-import pydest
 import datetime
 import random
 import config
@@ -53,68 +52,74 @@ class ClanManagement(commands.Cog):
         """
 
         with ctx.typing():
+            await ctx.send("Generating reports for {}...".format(
+                ", ".join(clan['clan_name'] for clan in config.BREW_CLANS)))
 
-            for clan in config.BREW_CLANS:
-                await ctx.send("Generating report for {}...".format(clan['clan_name']))
+            # Everyone in Ace's Brew Discord
+            guild_member_ids = set()
+            for guild in self.bot.guilds:
+                if str(guild.id) == "534781834924523520":
+                    guild_member_ids.update(str(member.id) for member in guild.members)
 
-                # Open the initial report file and write the header
-                report_file_name = str(clan['clan_name']).replace(" ", "_").replace("'", "") + ".csv"
+            # Sort the registered users into their clans in one pass
+            clan_users = {str(clan['clan_id']): [] for clan in config.BREW_CLANS}
+            for user_data in self.bot.user_cache.all():
+                if str(user_data.get('clan_id')) in clan_users:
+                    clan_users[str(user_data['clan_id'])].append(user_data)
 
-                with open(config.BOT_BASEDIR + "reports/" + report_file_name, 'w+') as csv_report:
-                    csv_writer = csv.writer(csv_report)
-                    csv_writer.writerow(
-                        ['steam_name', 'discord_name', 'registered?', 'in_clan?', 'in_discord?', 'activity_score'])
+            report_files = []
+            report_writes = []
 
-                    registered_users = []
+            for clan in config.BREW_CLANS:
+                report_file_name = str(clan['clan_name']).replace(" ", "_").replace("'", "") + ".csv"
+                report_file = config.BOT_BASEDIR + "reports/" + report_file_name
 
-                    # Iterate the registered users
-                    for registered_user in os.listdir(config.BOT_DB):
-                        if registered_user.endswith('.json'):
-                            with open(config.BOT_DB + registered_user) as user_data_file:
-                                user_data = json.load(user_data_file)
+                report_rows = self._clan_report_rows(clan, clan_users[str(clan['clan_id'])], guild_member_ids)
 
-                            # If they are in the current clan we care about
-                            if user_data['clan_id'] == clan['clan_id']:
-                                steam_name = user_data['bungie_name']
-                                discord_name = user_data['discord_name']
-                                is_registered = True
+                report_files.append(report_file)
+                report_writes.append(
+                    self.bot.loop.run_in_executor(None, self._write_clan_report, report_file, report_rows))
 
-                                clan_search_results = await self.check_if_clan_member(bungie_id=user_data['bungie_id'])
-                                is_in_clan = clan_search_results['is_member']
+            # Write every clan's CSV at once, off the event loop
+            await asyncio.gather(*report_writes)
 
-                                activity_score = user_data['clan_activity_score']
+            # Upload the files to discord
+            for report_file in report_files:
+                await ctx.send(file=discord.File(report_file))
 
-                                is_in_discord = False
-                                for guild in self.bot.guilds:
-                                    # Only do Ace's Brew Discord
-                                    if str(guild.id) == "534781834924523520":
-                                        for member in guild.members:
-                                            if str(member.id) == str(user_data['discord_id']):
-                                                is_in_discord = True
+    def _clan_report_rows(self, clan, registered_users, guild_member_ids):
+        """
+        Build a clan's report: its registered users first, then everyone on its roster who hasn't registered.
 
-                                csv_writer.writerow(
-                                    [steam_name, discord_name, is_registered, is_in_clan, is_in_discord, int(activity_score)])
+        Args:
+            clan (dict): entry of config.BREW_CLANS.
+            registered_users (list): user records of the clan's registered users.
+            guild_member_ids (set): discord IDs (str) of everyone in the Discord.
 
-                                registered_users.append(user_data)
+        Returns (list): CSV rows, header included.
+        """
+        report_rows = [['steam_name', 'discord_name', 'registered?', 'in_clan?', 'in_discord?', 'activity_score']]
+
+        registered_ids = set()
 
-                    # Iterate the roster for all the unregistered folks
-                    with open(config.BOT_BASEDIR + "clans/" + str(clan['clan_id']) + ".json") as clan_data_file:
-                        clan_data = json.load(clan_data_file)
+        for user_data in registered_users:
+            report_rows.append([user_data['bungie_name'], user_data['discord_name'], True,
+                                self.bot.roster_index.is_member(user_data['bungie_id']),
+                                str(user_data['discord_id']) in guild_member_ids,
+                                int(user_data['clan_activity_score'])])
 
-                    for clan_member in clan_data['members']:
+            registered_ids.add(str(user_data['bungie_id']))
 
-                        # See if he was on our registered list
-                        member_registered = False
-                        for registered_user in registered_users:
-                            if clan_member['id'] == registered_user['bungie_id']:
-                                member_registered = True
+        for clan_member in self.bot.roster_index.clan_members(clan['clan_id']):
+            if str(clan_member['id']) not in registered_ids:
+                report_rows.append([clan_member['name'], 'N/A', 'False', 'True', 'N/A', '0'])
 
-                        # If he was, we can ignore this one
-                        if member_registered is False:
-                            csv_writer.writerow([clan_member['name'], 'N/A', 'False', 'True', 'N/A', '0'])
+        return report_rows
 
-                # Upload the file to discord
-                await ctx.send(file=discord.File("reports/" + report_file_name))
+    @staticmethod
+    def _write_clan_report(report_file, report_rows):
+        with open(report_file, 'w+') as csv_report:
+            csv.writer(csv_report).writerows(report_rows)
 
     @commands.command()
     async def roster_count(self, ctx):
@@ -126,9 +131,8 @@ class ClanManagement(commands.Cog):
                                   description="Roster counts across all clans.")
 
             for clan in config.BREW_CLANS:
-                with open(config.BOT_BASEDIR + "clans/" + str(clan['clan_id']) + ".json") as clan_data_file:
-                    clan_data = json.load(clan_data_file)
-                    embed.add_field(name=clan['clan_name'], value=str(len(clan_data['members'])), inline=False)
+                clan_members = self.bot.roster_index.clan_members(clan['clan_id'])
+                embed.add_field(name=clan['clan_name'], value=str(len(clan_members)), inline=False)
 
             await ctx.send(embed=embed)
 
@@ -146,8 +150,6 @@ class ClanManagement(commands.Cog):
             [!] If you're on cross-save and console is your main account, use your console username to register instead.
         """
 
-        destiny = pydest.Pydest(config.BUNGIE_API_KEY)
-
         # Register if discord name matches
         if len(args) == 0:
 
@@ -195,10 +197,10 @@ class ClanManagement(commands.Cog):
             profile_types = [3, 2, 1, 5]
 
             for profile_type in profile_types:
-                profile_data = await destiny.api.get_profile(profile_type, verify_id, components=['100'])
+                profile_data = await self.bot.bungie.get_profile(profile_type, verify_id, components=['100'])
 
                 if profile_data['ErrorCode'] == 1:
-                    player_groups_query = await destiny.api.get_groups_for_member(profile_type, args[1])
+                    player_groups_query = await self.bot.bungie.get_groups_for_member(profile_type, args[1])
 
                     if len(player_groups_query['Response']['results']) > 0:
                         player_clan_id = player_groups_query['Response']['results'][0]['group']['groupId']
@@ -219,19 +221,10 @@ class ClanManagement(commands.Cog):
                     user_data.update({'bungie_id': str(verify_id)})
 
                     # Let's see if they've tried to register before
-                    for user_file in os.listdir(config.BOT_DB):
-                        try:
-                            if user_file.endswith(".json"):
-                                with open(config.BOT_DB + user_file) as current_profile_file:
-                                    current_profile = json.load(current_profile_file)
-
-                                if str(current_profile['discord_id']) == str(user_data['discord_id']) or \
-                                        str(current_profile['bungie_id']) == str(user_data['bungie_id']):
-                                    await ctx.author.send("Profile already registered. Contact an admin.")
-                                    return
-
-                        except FileNotFoundError:
-                            pass
+                    if self.bot.user_cache.find(discord_id=user_data['discord_id'],
+                                                bungie_id=user_data['bungie_id']) is not None:
+                        await ctx.author.send("Profile already registered. Contact an admin.")
+                        return
 
                     user_data.update(
                         {'bungie_name': str(profile_data['Response']['profile']['data']['userInfo']['displayName'])})
@@ -241,6 +234,13 @@ class ClanManagement(commands.Cog):
                         user_data.update({'clan_name': player_clan_name})
                         user_data.update({'clan_id': player_clan_id})
 
+                    # Remember their platform and characters so the activity updates don't have to look them up
+                    user_data.update({'membership_type': profile_type})
+                    user_data.update(
+                        {'character_ids': profile_data['Response']['profile']['data']['characterIds']})
+                    user_data.update(
+                        {'profile_resolved_at': datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")})
+
                     # Set time created
                     user_data.update({'created_at': str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))})
 
@@ -256,15 +256,17 @@ class ClanManagement(commands.Cog):
                     user_data.update({'unique_clan_members_played_with': 0})
                     user_data.update({'clan_members_played_with': 0})
 
-                    with open(config.BOT_DB + str(ctx.author.id) + ".json", 'w+') as user_file:
-                        json.dump(user_data, user_file)
+                    self.bot.user_cache.add(user_data)
+                    self.bot.ranking_index.update(user_data)
+
+                    # Never refreshed, so they go to the front of the rolling refresh
+                    if self.bot.refresh_scheduler is not None:
+                        self.bot.refresh_scheduler.track(user_data['discord_id'])
 
                     await ctx.author.send("You are registered!")
 
                     break
 
-        await destiny.close()
-
     async def check_if_clan_member(self, bungie_id=None, profile_name=None):
         """Checks the cached roster if member is in the clans.
 
@@ -273,31 +275,7 @@ class ClanManagement(commands.Cog):
                             return_results['bungie_name'] = member['name']
                             return_results['is_member'] = True
         """
-        return_results = {}
-        return_results['is_member'] = False
-
-        for clan_roster in os.listdir(config.BOT_BASEDIR + "clans/"):
-            with open(config.BOT_BASEDIR + "clans/" + clan_roster) as clan_data_file:
-                clan_data = json.load(clan_data_file)
-
-            for member in clan_data['members']:
-                if bungie_id is not None:
-                    if str(member['id']) == str(bungie_id):
-                        return_results['bungie_id'] = member['id']
-                        return_results['bungie_name'] = member['name']
-                        return_results['is_member'] = True
-                        break
-                elif profile_name is not None:
-                    if str(member['name']).lower() == str(profile_name).lower():
-                        return_results['bungie_id'] = member['id']
-                        return_results['bungie_name'] = member['name']
-                        return_results['is_member'] = True
-                        break
-
-            if return_results['is_member']:
-                break
-
-        return return_results
+        return self.bot.roster_index.lookup(bungie_id=bungie_id, profile_name=profile_name)
 
 
 # Cog extension entry point
@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+
+
+class HistoryCache:
+    """
+    Local copy of every character's recent activity history, kept up to date from a watermark.
+
+    An activity never changes once it is in a character's history, so each one is fetched from Bungie once. The
+    watermark is the newest activity seen for the character; a refresh only pages get_activity_history until it gets
+    back to the watermark and reads everything older from here. covered_from is the oldest day the copy is complete
+    from, so a request for older days knows to walk the history further back.
+
+    Periods are kept as Bungie sends them ("%Y-%m-%dT%H:%M:%SZ"), which sort in time order.
+    """
+
+    def __init__(self, cache_path):
+        """
+        Open (or create) the cache.
+
+        Args:
+            cache_path (str): path of the SQLite file backing the cache.
+        """
+        self._db = sqlite3.connect(cache_path, check_same_thread=False, timeout=30)
+        self._lock = threading.RLock()
+
+        # The bot and any number of stat_updater workers can share the cache
+        self._db.execute("PRAGMA journal_mode=WAL")
+
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS character_activities ("
+                             "character_id TEXT NOT NULL, "
+                             "instance_id TEXT NOT NULL, "
+                             "period TEXT NOT NULL, "
+                             "seconds_played INTEGER NOT NULL, "
+                             "PRIMARY KEY (character_id, instance_id))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS character_activities_period "
+                             "ON character_activities (character_id, period)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS character_watermarks ("
+                             "character_id TEXT PRIMARY KEY, "
+                             "instance_id TEXT NOT NULL, "
+                             "period TEXT NOT NULL, "
+                             "covered_from TEXT NOT NULL)")
+
+    def watermark(self, character_id):
+        """
+        Where the character's local history ends.
+
+        Returns (dict): {'instance_id', 'period', 'covered_from'}, or None if the character was never synced.
+        """
+        with self._lock:
+            watermark_row = self._db.execute("SELECT instance_id, period, covered_from FROM character_watermarks "
+                                             "WHERE character_id = ?", (str(character_id),)).fetchone()
+
+        if watermark_row is None:
+            return None
+
+        return {'instance_id': watermark_row[0], 'period': watermark_row[1], 'covered_from': watermark_row[2]}
+
+    def record(self, character_id, activities, watermark, covered_from, keep_from):
+        """
+        Store newly fetched activities and move the watermark, dropping activities older than keep_from.
+
+        Args:
+            character_id (str): the character.
+            activities (list): (instance_id, period, seconds_played) tuples fetched since the last watermark.
+            watermark (tuple): (instance_id, period) of the newest activity in the history, or None if it is empty.
+            covered_from (str): "%Y-%m-%d" of the oldest day the local history is now complete from.
+            keep_from (str): "%Y-%m-%d" of the oldest day worth keeping.
+
+        Returns: None.
+
+        """
+        character_id = str(character_id)
+
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO character_activities "
+                                 "(character_id, instance_id, period, seconds_played) VALUES (?, ?, ?, ?)",
+                                 [(character_id, str(instance_id), period, seconds_played)
+                                  for instance_id, period, seconds_played in activities])
+            self._db.execute("DELETE FROM character_activities WHERE character_id = ? AND period < ?",
+                             (character_id, keep_from))
+
+            if watermark is not None:
+                self._db.execute("INSERT OR REPLACE INTO character_watermarks "
+                                 "(character_id, instance_id, period, covered_from) VALUES (?, ?, ?, ?)",
+                                 (character_id, str(watermark[0]), watermark[1], max(covered_from, keep_from)))
+
+    def activities(self, character_id, first_day):
+        """
+        The character's activities from a day on.
+
+        Args:
+            character_id (str): the character.
+            first_day (str): "%Y-%m-%d" of the oldest day wanted.
+
+        Returns (list): (instance_id, period, seconds_played) tuples, newest first.
+        """
+        with self._lock:
+            return self._db.execute("SELECT instance_id, period, seconds_played FROM character_activities "
+                                    "WHERE character_id = ? AND period >= ? ORDER BY period DESC",
+                                    (str(character_id), first_day)).fetchall()
+
+    def stats(self):
+        """
+        Size of the cache.
+
+        Returns (dict): characters synced and activities kept.
+        """
+        with self._lock:
+            return {
+                'characters': self._db.execute("SELECT COUNT(*) FROM character_watermarks").fetchone()[0],
+                'activities': self._db.execute("SELECT COUNT(*) FROM character_activities").fetchone()[0]
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,203 @@
+import json
+import socket
+import sqlite3
+import threading
+import time
+
+import config
+
+
+# Location of the activity job queue. Can be overridden from config.py.
+ACTIVITY_JOB_DB_PATH = getattr(config, 'ACTIVITY_JOB_DB_PATH', config.BOT_BASEDIR + "activity_jobs.db")
+
+# Seconds a claimed job may run before it is assumed its worker died and it is handed out again
+ACTIVITY_JOB_LEASE = getattr(config, 'ACTIVITY_JOB_LEASE', 900)
+
+# 'local' runs the nightly Bungie update inside the bot, 'rolling' spreads it over the day (see refresh_scheduler.py)
+# and 'queue' hands it to stat_updater.py worker processes
+ACTIVITY_UPDATE_MODE = getattr(config, 'ACTIVITY_UPDATE_MODE', 'local')
+
+# Times a job is tried before it is left as failed
+ACTIVITY_JOB_MAX_ATTEMPTS = getattr(config, 'ACTIVITY_JOB_MAX_ATTEMPTS', 3)
+
+# Seconds between checks for new jobs (workers) or finished ones (the bot)
+ACTIVITY_JOB_POLL_INTERVAL = getattr(config, 'ACTIVITY_JOB_POLL_INTERVAL', 30)
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS activity_jobs ("
+    "job_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "discord_id TEXT NOT NULL, "
+    "payload TEXT NOT NULL, "
+    "status TEXT NOT NULL DEFAULT 'pending', "
+    "attempts INTEGER NOT NULL DEFAULT 0, "
+    "worker TEXT, "
+    "enqueued_at REAL NOT NULL, "
+    "claimed_at REAL, "
+    "finished_at REAL, "
+    "result TEXT, "
+    "error TEXT)",
+    "CREATE INDEX IF NOT EXISTS activity_jobs_status ON activity_jobs (status, job_id)",
+    "CREATE INDEX IF NOT EXISTS activity_jobs_discord_id ON activity_jobs (discord_id, status)",
+]
+
+
+def worker_name(worker_number=0):
+    """Name a worker is recorded under, unique across hosts and processes."""
+    return "{}-{}".format(socket.gethostname(), worker_number)
+
+
+class ActivityJobQueue:
+    """
+    Durable queue of per-member activity update jobs, shared through a SQLite file.
+
+    The bot enqueues one job per member; any number of worker processes (see stat_updater.py) claim them, pull the
+    member's Bungie stats and store the result on the job; the bot then applies the results to its user records.
+    That keeps the bot the only writer of user records while the Bungie crunching runs wherever there are workers.
+
+    A job goes pending -> running -> done (or back to pending to be retried, or failed after
+    ACTIVITY_JOB_MAX_ATTEMPTS). A job still running ACTIVITY_JOB_LEASE seconds after it was claimed is assumed to
+    have lost its worker and is handed out again.
+    """
+
+    def __init__(self, db_path=ACTIVITY_JOB_DB_PATH):
+        """
+        Open (or create) the queue.
+
+        Args:
+            db_path (str): path of the SQLite file backing the queue.
+        """
+        self.db_path = db_path
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
+
+        # Several processes read and write the queue at once
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+
+        with self._db:
+            for statement in SCHEMA:
+                self._db.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def enqueue(self, jobs):
+        """
+        Add jobs, skipping any member who already has one waiting or running.
+
+        Args:
+            jobs (list): (discord_id, payload dict) tuples.
+
+        Returns (int): number of jobs added.
+        """
+        now = time.time()
+
+        with self._lock, self._db:
+            added = 0
+            for discord_id, payload in jobs:
+                added += self._db.execute(
+                    "INSERT INTO activity_jobs (discord_id, payload, enqueued_at) SELECT ?, ?, ? "
+                    "WHERE NOT EXISTS (SELECT 1 FROM activity_jobs WHERE discord_id = ? "
+                    "AND status IN ('pending', 'running'))",
+                    (str(discord_id), json.dumps(payload), now, str(discord_id))).rowcount
+
+        return added
+
+    def claim(self, worker):
+        """
+        Hand the oldest waiting job to a worker.
+
+        Args:
+            worker (str): name of the claiming worker.
+
+        Returns (dict): {'job_id', 'discord_id', 'payload', 'attempts'}, or None if there is nothing to do.
+        """
+        now = time.time()
+
+        with self._lock:
+            # Take the write lock up front so two workers can't claim the same job
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("UPDATE activity_jobs SET status = 'failed', error = 'lease expired' "
+                                 "WHERE status = 'running' AND claimed_at < ? AND attempts >= ?",
+                                 (now - ACTIVITY_JOB_LEASE, ACTIVITY_JOB_MAX_ATTEMPTS))
+
+                job_row = self._db.execute(
+                    "SELECT job_id, discord_id, payload, attempts FROM activity_jobs "
+                    "WHERE status = 'pending' OR (status = 'running' AND claimed_at < ?) "
+                    "ORDER BY job_id LIMIT 1", (now - ACTIVITY_JOB_LEASE,)).fetchone()
+
+                if job_row is not None:
+                    self._db.execute("UPDATE activity_jobs SET status = 'running', worker = ?, claimed_at = ?, "
+                                     "attempts = attempts + 1 WHERE job_id = ?", (worker, now, job_row['job_id']))
+
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+
+        if job_row is None:
+            return None
+
+        return {'job_id': job_row['job_id'], 'discord_id': job_row['discord_id'],
+                'payload': json.loads(job_row['payload']), 'attempts': job_row['attempts'] + 1}
+
+    def complete(self, job_id, result):
+        """
+        Store a job's result.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE activity_jobs SET status = 'done', finished_at = ?, result = ?, error = NULL "
+                             "WHERE job_id = ?", (time.time(), json.dumps(result), job_id))
+
+    def fail(self, job_id, error):
+        """
+        Record a failed attempt, putting the job back in line unless it is out of attempts.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE activity_jobs SET status = CASE WHEN attempts >= ? THEN 'failed' "
+                             "ELSE 'pending' END, finished_at = ?, error = ? WHERE job_id = ?",
+                             (ACTIVITY_JOB_MAX_ATTEMPTS, time.time(), str(error), job_id))
+
+    def finished(self, limit=500):
+        """
+        Results of finished jobs that haven't been applied yet.
+
+        Returns (list): {'job_id', 'discord_id', 'result'} dicts, oldest first.
+        """
+        with self._lock:
+            job_rows = self._db.execute("SELECT job_id, discord_id, result FROM activity_jobs WHERE status = 'done' "
+                                        "ORDER BY job_id LIMIT ?", (limit,)).fetchall()
+
+        return [{'job_id': job_row['job_id'], 'discord_id': job_row['discord_id'],
+                 'result': json.loads(job_row['result'])} for job_row in job_rows]
+
+    def acknowledge(self, job_ids):
+        """
+        Drop jobs whose results have been applied.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM activity_jobs WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+
+    def progress(self):
+        """
+        Number of jobs in each state.
+
+        Returns (dict): status -> count.
+        """
+        with self._lock:
+            status_rows = self._db.execute("SELECT status, COUNT(*) FROM activity_jobs GROUP BY status").fetchall()
+
+        return {status_row[0]: status_row[1] for status_row in status_rows}
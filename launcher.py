@@ -1,13 +1,20 @@
 import brewbot
 import config
+import storage
 
 
 def main():
+    # Open the database, importing the old JSON records on first run
+    database = storage.open_database()
+
     # Instantiate the bot
-    bot = brewbot.BrewBot(db_session=None)
+    bot = brewbot.BrewBot(db_session=database)
 
     # Run the bot
-    bot.run()
+    try:
+        bot.run()
+    finally:
+        database.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+import json
+import sqlite3
+import time
+import zlib
+
+import config
+
+
+# Maximum number of post game carnage reports kept on disk before the least recently used are evicted
+PGCR_CACHE_MAX_ENTRIES = getattr(config, 'PGCR_CACHE_MAX_ENTRIES', 100000)
+
+# Cache hits whose recency is held in memory before it is written back in one transaction
+PGCR_CACHE_TOUCH_BATCH = 1000
+
+
+class PgcrCache:
+    """
+    Persistent, size-bounded LRU cache of post game carnage reports keyed by activity instance ID.
+
+    A PGCR never changes once the activity is over, so only the fields we use are kept - each participant's
+    membership ID, public flag and display name - as zlib compressed JSON in a small SQLite file.
+
+    A hit only notes the report's recency in memory; the recency is written back in batches, along with new reports,
+    so lookups never write to disk. The file is shared with the stat_updater workers, so the size bound is checked
+    against the rows actually in it rather than a count kept by this process.
+    """
+
+    def __init__(self, cache_path, max_entries=PGCR_CACHE_MAX_ENTRIES):
+        """
+        Open (or create) the cache.
+
+        Args:
+            cache_path (str): path of the SQLite file backing the cache.
+            max_entries (int): number of reports to keep before evicting the least recently used.
+        """
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = sqlite3.connect(cache_path, timeout=30)
+
+        # The bot and any number of stat_updater workers can share the cache
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+
+        # instance ID -> time.time() of its latest hit, not yet written back
+        self._touched = {}
+
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS pgcr ("
+                             "instance_id TEXT PRIMARY KEY, "
+                             "participants BLOB NOT NULL, "
+                             "last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS pgcr_last_used ON pgcr (last_used)")
+
+        self._entries = self._db.execute("SELECT COUNT(*) FROM pgcr").fetchone()[0]
+
+    @staticmethod
+    def participants_from_report(activity_info):
+        """
+        Reduce a full GetPostGameCarnageReport response to the compact participant list we cache.
+
+        Args:
+            activity_info (dict): PGCR response from Bungie.
+
+        Returns (list): [membership_id, is_public, display_name] for every entry in the report.
+        """
+        participants = []
+
+        for activity_player in activity_info.get('Response', {}).get('entries', []):
+            user_info = activity_player['player']['destinyUserInfo']
+            participants.append([str(user_info['membershipId']),
+                                 str(user_info.get('isPublic')) == "True",
+                                 user_info.get('displayName')])
+
+        return participants
+
+    def get(self, instance_id):
+        """
+        Look up the participants of an activity.
+
+        Args:
+            instance_id (str): activity instance ID.
+
+        Returns (list): the cached participant list, or None if the report isn't cached.
+        """
+        row = self._db.execute("SELECT participants FROM pgcr WHERE instance_id = ?", (str(instance_id),)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touched[str(instance_id)] = time.time()
+
+        if len(self._touched) >= PGCR_CACHE_TOUCH_BATCH:
+            with self._db:
+                self._write_touched()
+
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, instance_id, participants):
+        """
+        Store the participants of an activity, evicting the least recently used reports if the cache is full.
+
+        Args:
+            instance_id (str): activity instance ID.
+            participants (list): compact participant list, see participants_from_report.
+
+        Returns: None.
+
+        """
+        packed = zlib.compress(json.dumps(participants, separators=(',', ':')).encode('utf-8'))
+
+        with self._db:
+            # Reports are immutable, so if it's already there (e.g. fetched twice concurrently) keep the first copy
+            self._db.execute("INSERT OR IGNORE INTO pgcr (instance_id, participants, last_used) VALUES (?, ?, ?)",
+                             (str(instance_id), packed, time.time()))
+
+            # Recency has to be on disk before picking what to evict
+            self._write_touched()
+
+            # Counted inside the write transaction, so reports added by other processes are included
+            self._entries = self._db.execute("SELECT COUNT(*) FROM pgcr").fetchone()[0]
+
+            if self._entries > self.max_entries:
+                excess = self._entries - self.max_entries
+                self._db.execute("DELETE FROM pgcr WHERE instance_id IN "
+                                 "(SELECT instance_id FROM pgcr ORDER BY last_used LIMIT ?)", (excess,))
+                self.evictions += excess
+                self._entries -= excess
+
+    def _write_touched(self):
+        if len(self._touched) == 0:
+            return
+
+        self._db.executemany("UPDATE pgcr SET last_used = ? WHERE instance_id = ?",
+                             [(last_used, instance_id) for instance_id, last_used in self._touched.items()])
+        self._touched = {}
+
+    def stats(self):
+        """
+        Cache effectiveness counters.
+
+        Returns (dict): hits, misses, evictions and the number of reports currently cached.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': self._entries}
+
+    def close(self):
+        with self._db:
+            self._write_touched()
+
+        self._db.close()
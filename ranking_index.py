@@ -0,0 +1,110 @@
+import bisect
+
+
+class RankingIndex:
+    """
+    In-memory leaderboard of clan activity scores.
+
+    Every clan (and the whole community, under clan ID None) keeps a list of (-score, discord_id) keys sorted with
+    bisect, so the list reads best first. A score change moves just that one key, and a member's rank is a binary
+    search.
+    """
+
+    def __init__(self, users=()):
+        """
+        Build the rankings.
+
+        Args:
+            users (iterable): user records to rank.
+        """
+        # clan ID (str) or None -> sorted [(-score, discord_id), ..]
+        self._rankings = {None: []}
+
+        # discord ID (str) -> (key, clan ID) it is currently ranked under
+        self._members = {}
+
+        for user_data in users:
+            self.update(user_data)
+
+    def update(self, user_data):
+        """
+        Add a user to the rankings, or move them if their score or clan changed.
+
+        Returns: None.
+
+        """
+        discord_id = str(user_data['discord_id'])
+        clan_id = str(user_data['clan_id']) if user_data.get('clan_id') is not None else None
+        key = (-float(user_data.get('clan_activity_score') or 0), discord_id)
+
+        if self._members.get(discord_id) == (key, clan_id):
+            return
+
+        self.remove(discord_id)
+
+        bisect.insort(self._rankings[None], key)
+        if clan_id is not None:
+            bisect.insort(self._rankings.setdefault(clan_id, []), key)
+
+        self._members[discord_id] = (key, clan_id)
+
+    def remove(self, discord_id):
+        """
+        Take a user out of the rankings.
+
+        Returns: None.
+
+        """
+        member = self._members.pop(str(discord_id), None)
+        if member is None:
+            return
+
+        key, clan_id = member
+        for ranking in (self._rankings[None], self._rankings.get(clan_id)):
+            if ranking is not None:
+                del ranking[bisect.bisect_left(ranking, key)]
+
+    def size(self, clan_id=None):
+        return len(self._rankings.get(str(clan_id) if clan_id is not None else None, []))
+
+    def top(self, count, clan_id=None, offset=0):
+        """
+        Best scores, best first.
+
+        Args:
+            count (int): how many to return.
+            clan_id (str): clan to rank within, None for everyone.
+            offset (int): how many to skip from the top.
+
+        Returns (list): (rank, discord_id, score) tuples, ranks starting at 1.
+        """
+        ranking = self._rankings.get(str(clan_id) if clan_id is not None else None, [])
+
+        return [(rank + 1, discord_id, -negative_score)
+                for rank, (negative_score, discord_id) in enumerate(ranking[offset:offset + count], start=offset)]
+
+    def bottom(self, count, clan_id=None):
+        """
+        Worst scores, worst first.
+
+        Returns (list): (rank, discord_id, score) tuples.
+        """
+        offset = max(0, self.size(clan_id) - count)
+
+        return list(reversed(self.top(count, clan_id, offset)))
+
+    def rank(self, discord_id, clan_id=None):
+        """
+        A user's position in a ranking.
+
+        Returns (int): rank starting at 1, or None if they aren't ranked there.
+        """
+        member = self._members.get(str(discord_id))
+        if member is None:
+            return None
+
+        key, member_clan_id = member
+        if clan_id is not None and str(clan_id) != member_clan_id:
+            return None
+
+        return bisect.bisect_left(self._rankings[str(clan_id) if clan_id is not None else None], key) + 1
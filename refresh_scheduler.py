@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import time
+
+import config
+
+
+# Seconds within which every member is refreshed once when ACTIVITY_UPDATE_MODE is 'rolling'. Can be overridden
+# from config.py.
+ACTIVITY_REFRESH_PERIOD = getattr(config, 'ACTIVITY_REFRESH_PERIOD', 24 * 60 * 60)
+
+# An on-demand refresh of a member refreshed less than this many seconds ago answers with what is on record
+ACTIVITY_REFRESH_MIN_AGE = getattr(config, 'ACTIVITY_REFRESH_MIN_AGE', 10 * 60)
+
+# On-demand refreshes run at the same time as the rolling one
+ACTIVITY_REFRESH_ON_DEMAND_WORKERS = getattr(config, 'ACTIVITY_REFRESH_ON_DEMAND_WORKERS', 2)
+
+
+class RefreshScheduler:
+    """
+    Refreshes members one at a time, spread evenly over ACTIVITY_REFRESH_PERIOD, stalest first.
+
+    With N members a refresh starts every ACTIVITY_REFRESH_PERIOD / N seconds, so the Bungie load is a steady trickle
+    instead of a nightly burst and every member is refreshed about once a period. On-demand refreshes (see request)
+    skip the line and run next to the rolling one; every request still goes through the shared Bungie rate limiter,
+    so together they stay inside its budget.
+    """
+
+    def __init__(self, refresh, period=ACTIVITY_REFRESH_PERIOD, min_age=ACTIVITY_REFRESH_MIN_AGE,
+                 on_demand_workers=ACTIVITY_REFRESH_ON_DEMAND_WORKERS):
+        """
+        Args:
+            refresh (coroutine function): refresh(discord_id) refreshes one member, returning False if they are no
+                                          longer registered.
+            period (float): seconds within which every member is refreshed once.
+            min_age (float): on-demand refreshes of members refreshed more recently than this are skipped.
+            on_demand_workers (int): on-demand refreshes run at once.
+        """
+        self.refresh = refresh
+        self.period = period
+        self.min_age = min_age
+        self.on_demand_workers = on_demand_workers
+
+        # discord ID -> time.time() of their last refresh; the heap holds (refreshed_at, discord_id) and may carry
+        # outdated entries, which are skipped when they come up
+        self._refreshed_at = {}
+        self._stalest = []
+
+        self._in_flight = {}
+        self._on_demand = asyncio.Queue()
+        self._next_slot = time.time()
+
+    def track(self, discord_id, refreshed_at=0.0):
+        """
+        Add a member to the rotation, or move them to their new place in it.
+
+        Args:
+            discord_id (str): the member.
+            refreshed_at (float): time.time() of their last refresh, 0 if they never were.
+
+        Returns: None.
+
+        """
+        self._refreshed_at[str(discord_id)] = refreshed_at
+        heapq.heappush(self._stalest, (refreshed_at, str(discord_id)))
+
+    def forget(self, discord_id):
+        """Take a member out of the rotation."""
+        self._refreshed_at.pop(str(discord_id), None)
+
+    def size(self):
+        return len(self._refreshed_at)
+
+    def refreshed_at(self, discord_id):
+        return self._refreshed_at.get(str(discord_id))
+
+    def request(self, discord_id):
+        """
+        Ask for a member to be refreshed ahead of the rotation.
+
+        Args:
+            discord_id (str): the member.
+
+        Returns (asyncio.Future): resolves to True once the member has been refreshed, or False straight away if they
+                                  were refreshed in the last ACTIVITY_REFRESH_MIN_AGE seconds.
+        """
+        discord_id = str(discord_id)
+
+        # Already being refreshed, by the rotation or someone else's request
+        in_flight = self._in_flight.get(discord_id)
+        if in_flight is not None:
+            return in_flight
+
+        refreshed = asyncio.get_event_loop().create_future()
+
+        if time.time() - self._refreshed_at.get(discord_id, 0.0) < self.min_age:
+            refreshed.set_result(False)
+            return refreshed
+
+        self._in_flight[discord_id] = refreshed
+        self._on_demand.put_nowait(discord_id)
+
+        return refreshed
+
+    async def run(self):
+        """
+        Run the rotation and the on-demand workers until cancelled.
+
+        Returns: None.
+
+        """
+        await asyncio.gather(self._rotate(), *[self._serve_on_demand() for _ in range(self.on_demand_workers)])
+
+    async def _rotate(self):
+        while True:
+            # Re-spread the slots whenever members come and go
+            interval = self.period / max(1, len(self._refreshed_at))
+
+            wait_seconds = self._next_slot - time.time()
+            if wait_seconds > 0:
+                await asyncio.sleep(min(wait_seconds, interval))
+                continue
+
+            # A backlog (e.g. after downtime) is worked off at the same pace rather than all at once
+            self._next_slot = max(self._next_slot + interval, time.time() - interval)
+
+            discord_id = self._pop_stalest()
+            if discord_id is None:
+                continue
+
+            # Everyone was refreshed recently (e.g. on demand); give the slot back to the budget
+            if time.time() - self._refreshed_at[discord_id] < self.period / 2:
+                heapq.heappush(self._stalest, (self._refreshed_at[discord_id], discord_id))
+                continue
+
+            if discord_id in self._in_flight:
+                continue
+
+            refreshed = asyncio.get_event_loop().create_future()
+            # Nobody may be waiting on a rotation refresh, so don't leave its failure unretrieved
+            refreshed.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self._in_flight[discord_id] = refreshed
+            await self._refresh(discord_id, refreshed)
+
+    async def _serve_on_demand(self):
+        while True:
+            discord_id = await self._on_demand.get()
+            await self._refresh(discord_id, self._in_flight[discord_id])
+
+    def _pop_stalest(self):
+        while len(self._stalest) > 0:
+            refreshed_at, discord_id = heapq.heappop(self._stalest)
+
+            # Skip entries left behind by a later track() or by forget()
+            if self._refreshed_at.get(discord_id) == refreshed_at:
+                return discord_id
+
+        return None
+
+    async def _refresh(self, discord_id, refreshed):
+        try:
+            still_registered = await self.refresh(discord_id)
+        except asyncio.CancelledError:
+            refreshed.cancel()
+            raise
+        except Exception as ex:
+            print("[!] >>> BACKGROUND: Unable to refresh {}: {}: {}".format(discord_id, ex.__class__.__name__, ex))
+            if not refreshed.done():
+                refreshed.set_exception(ex)
+            # Back of the line, so one failing member doesn't hog the rotation
+            self.track(discord_id, time.time())
+        else:
+            if still_registered is False:
+                self.forget(discord_id)
+            else:
+                self.track(discord_id, time.time())
+
+            if not refreshed.done():
+                refreshed.set_result(still_registered is not False)
+        finally:
+            self._in_flight.pop(discord_id, None)
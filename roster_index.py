@@ -0,0 +1,124 @@
+class RosterIndex:
+    """
+    In-memory index of the cached clan rosters.
+
+    Every roster is loaded once into hash maps keyed by membership ID and by case-folded display name, so a
+    membership check is a dictionary lookup with no file I/O. Updates build fresh maps and swap them in with a single
+    assignment, so readers never see a half-built index.
+    """
+
+    def __init__(self, database):
+        """
+        Build the index from the rosters cached in the database.
+
+        Args:
+            database (storage.BrewDatabase): the bot's database.
+        """
+        self.database = database
+
+        self._rosters = {}
+        self._by_id = {}
+        self._by_name = {}
+
+        self.reload()
+
+    def reload(self):
+        """
+        Re-read every cached roster and rebuild the index.
+
+        Returns: None.
+
+        """
+        self._rebuild(self.database.get_clan_rosters())
+
+    def update_clan(self, clan_id, members):
+        """
+        Replace a single clan's roster, e.g. right after it has been refreshed from Bungie.
+
+        Args:
+            clan_id (str): ID of the clan.
+            members (list): roster entries, each a dict with at least 'id' and 'name'.
+
+        Returns: None.
+
+        """
+        rosters = dict(self._rosters)
+        rosters[str(clan_id)] = members
+
+        self._rebuild(rosters)
+
+    def diff_clan(self, clan_id, members):
+        """
+        Compare a freshly pulled roster against the indexed one.
+
+        Args:
+            clan_id (str): ID of the clan.
+            members (list): the fresh roster entries.
+
+        Returns (tuple): (joined, left, changed) where joined and left are lists of roster entries and changed is True
+                         if anything at all differs, renames included.
+        """
+        old_members = {str(member['id']): member for member in self._rosters.get(str(clan_id), [])}
+        new_members = {str(member['id']): member for member in members}
+
+        joined = [member for member_id, member in new_members.items() if member_id not in old_members]
+        left = [member for member_id, member in old_members.items() if member_id not in new_members]
+
+        changed = len(joined) > 0 or len(left) > 0 or str(clan_id) not in self._rosters or any(
+            member['name'] != old_members[member_id]['name'] for member_id, member in new_members.items()
+            if member_id in old_members)
+
+        return joined, left, changed
+
+    def _rebuild(self, rosters):
+        by_id = {}
+        by_name = {}
+
+        for clan_id, members in rosters.items():
+            for member in members:
+                by_id.setdefault(str(member['id']), member)
+                by_name.setdefault(str(member['name']).casefold(), member)
+
+        # Swap everything in at once
+        self._rosters, self._by_id, self._by_name = rosters, by_id, by_name
+
+    def lookup(self, bungie_id=None, profile_name=None):
+        """Checks the cached roster if member is in the clans.
+
+            Returns (dict):
+                            return_results['bungie_id'] = member['id']
+                            return_results['bungie_name'] = member['name']
+                            return_results['is_member'] = True
+        """
+        return_results = {}
+        return_results['is_member'] = False
+
+        member = None
+        if bungie_id is not None:
+            member = self._by_id.get(str(bungie_id))
+        elif profile_name is not None:
+            member = self._by_name.get(str(profile_name).casefold())
+
+        if member is not None:
+            return_results['bungie_id'] = member['id']
+            return_results['bungie_name'] = member['name']
+            return_results['is_member'] = True
+
+        return return_results
+
+    def is_member(self, bungie_id):
+        """
+        Whether the given membership ID is on any of the clan rosters.
+
+        Returns: bool
+
+        """
+        return str(bungie_id) in self._by_id
+
+    def clan_members(self, clan_id):
+        """
+        The cached roster of a single clan.
+
+        Returns (list): roster entries, empty if the clan isn't known.
+        """
+        return self._rosters.get(str(clan_id), [])
@@ -0,0 +1,171 @@
+import datetime
+
+import numpy
+
+import config
+
+
+# Alternative windows (in days) scored alongside the configured STATISTICS_PERIOD. Can be overridden from config.py.
+SCORE_WINDOWS = getattr(config, 'SCORE_WINDOWS', [7, 30, 90])
+
+# Order of the per-day stats in ActivityColumns.game_activity
+GAME_ACTIVITY_STATS = ['seconds_played', 'clan_members_played_with', 'unique_clan_members_played_with']
+
+
+def kept_days():
+    """
+    Days of game activity and chat kept on record: the statistics period, or the longest score window if longer.
+
+    Returns (int): number of days.
+    """
+    return max([int(config.STATISTICS_PERIOD)] + [int(window_days) for window_days in SCORE_WINDOWS])
+
+
+class ActivityColumns:
+    """
+    The per-day activity of a set of users laid out as columns.
+
+    game_activity is a (users, days, stats) array with one column per calendar day, oldest first, and the stats in
+    GAME_ACTIVITY_STATS order; days a user has no record for are zero. The discord chat counters on the records are
+    one entry per user, and daily_chat lays out the ChatTracker buckets the same way as game_activity, for scoring
+    windows other than the statistics period. Every score is then a handful of array operations over the whole clan
+    instead of a dict walk per user.
+    """
+
+    def __init__(self, users, daily_chat=None):
+        """
+        Lay out the given user records.
+
+        Args:
+            users (list): user records.
+            daily_chat (dict): the ChatTracker buckets, discord ID (str) -> "%Y-%m-%d" -> [chat_events,
+                               characters_typed].
+        """
+        self.discord_ids = [str(user_data['discord_id']) for user_data in users]
+
+        self.days = sorted(set(activity_day for user_data in users for activity_day in user_data['game_activity']))
+        day_columns = {activity_day: day_column for day_column, activity_day in enumerate(self.days)}
+
+        self.game_activity = numpy.zeros((len(users), len(self.days), len(GAME_ACTIVITY_STATS)))
+        for user_row, user_data in enumerate(users):
+            for activity_day, day_stats in user_data['game_activity'].items():
+                self.game_activity[user_row, day_columns[activity_day]] = [
+                    day_stats.get(stat, 0) for stat in GAME_ACTIVITY_STATS]
+
+        self.chat_events = numpy.array([user_data.get('chat_events') or 0 for user_data in users], dtype=float)
+        self.characters_typed = numpy.array([user_data.get('characters_typed') or 0 for user_data in users],
+                                            dtype=float)
+
+        if daily_chat is None:
+            daily_chat = {}
+
+        user_chat = [daily_chat.get(discord_id, {}) for discord_id in self.discord_ids]
+        self.chat_days = sorted(set(chat_day for user_days in user_chat for chat_day in user_days))
+        chat_columns = {chat_day: chat_column for chat_column, chat_day in enumerate(self.chat_days)}
+
+        self.daily_chat = numpy.zeros((len(users), len(self.chat_days), 2))
+        for user_row, user_days in enumerate(user_chat):
+            for chat_day, day_bucket in user_days.items():
+                self.daily_chat[user_row, chat_columns[chat_day]] = day_bucket[:2]
+
+    def window_totals(self, window_days=None, today=None):
+        """
+        Sum every user's per-day stats over a trailing window.
+
+        Args:
+            window_days (int): days to sum, ending yesterday (the current day is never pulled). None sums every day.
+            today (datetime.datetime): reference day, defaults to now (UTC).
+
+        Returns (numpy.ndarray): (users, stats) totals in GAME_ACTIVITY_STATS order.
+        """
+        if window_days is None:
+            return self.game_activity.sum(axis=1)
+
+        if today is None:
+            today = datetime.datetime.utcnow()
+
+        first_day = (today - datetime.timedelta(days=int(window_days))).strftime("%Y-%m-%d")
+        last_day = today.strftime("%Y-%m-%d")
+
+        # Days are sorted, so the window is a contiguous slice of columns
+        first_column = numpy.searchsorted(self.days, first_day, side='left')
+        last_column = numpy.searchsorted(self.days, last_day, side='left')
+
+        return self.game_activity[:, first_column:last_column].sum(axis=1)
+
+    def chat_window_totals(self, window_days, today=None):
+        """
+        Sum every user's chat buckets over a trailing window, the current day included.
+
+        Returns (numpy.ndarray): (users, 2) chat_events and characters_typed totals.
+        """
+        if today is None:
+            today = datetime.datetime.utcnow()
+
+        first_day = (today - datetime.timedelta(days=int(window_days))).strftime("%Y-%m-%d")
+        first_column = numpy.searchsorted(self.chat_days, first_day, side='left')
+
+        return self.daily_chat[:, first_column:].sum(axis=1)
+
+    def scores(self, window_days=None, today=None):
+        """
+        Clan activity score of every user over a trailing window.
+
+        Args:
+            window_days (int): days to score. None scores the statistics period with the chat counters on the records.
+            today (datetime.datetime): reference day, defaults to now (UTC).
+
+        Returns (numpy.ndarray): one score per user, in discord_ids order.
+        """
+        if window_days is None:
+            totals = self.window_totals(int(config.STATISTICS_PERIOD), today)
+            chat_events, characters_typed = self.chat_events, self.characters_typed
+        else:
+            totals = self.window_totals(window_days, today)
+            chat_totals = self.chat_window_totals(window_days, today)
+            chat_events, characters_typed = chat_totals[:, 0], chat_totals[:, 1]
+
+        total_seconds_played = totals[:, 0]
+        bonus_multiplier = totals[:, 1] + totals[:, 2]
+
+        return total_seconds_played + (chat_events * 60) + (characters_typed * 3) * bonus_multiplier
+
+
+def score_users(users, daily_chat, today=None):
+    """
+    Recompute clan_activity_score for every given user in one pass, along with the SCORE_WINDOWS alternatives.
+
+    The alternative scores are kept on each record as 'window_scores' ({"<days>": score}).
+
+    Args:
+        users (list): user records, updated in place.
+        daily_chat (dict): the ChatTracker buckets, to total chat over each window.
+        today (datetime.datetime): reference day, defaults to now (UTC).
+
+    Returns: None.
+
+    """
+    if len(users) == 0:
+        return
+
+    columns = ActivityColumns(users, daily_chat)
+
+    # Records hold kept_days() of activity, so the headline score is windowed to the STATISTICS_PERIOD too
+    clan_activity_scores = columns.scores(today=today)
+    window_scores = {str(window_days): columns.scores(window_days, today) for window_days in SCORE_WINDOWS}
+
+    for user_row, user_data in enumerate(users):
+        user_data['clan_activity_score'] = float(clan_activity_scores[user_row])
+        user_data['window_scores'] = {window_days: float(scores[user_row])
+                                      for window_days, scores in window_scores.items()}
+
+
+def activity_totals(user_data):
+    """
+    Total a single user's per-day stats over the statistics period.
+
+    Returns (dict): {'seconds_played': .., 'clan_members_played_with': .., 'unique_clan_members_played_with': ..}
+    """
+    totals = ActivityColumns([user_data]).window_totals(int(config.STATISTICS_PERIOD))[0]
+
+    return {stat: totals[stat_column].item() for stat_column, stat in enumerate(GAME_ACTIVITY_STATS)}
@@ -1,320 +1,390 @@
-# Just a utility script to update bungie-only stats manually
+# Headless runs of the activity engine: update members without the bot, or run activity job workers for the bot
 
+import argparse
+import cProfile
 import datetime
-import json
-import pydest
-import os
+import multiprocessing
+import pstats
 import config
 import asyncio
-import time
+import activity_engine
+import bungie_client
+import chat_tracker
+import history_cache
+import job_queue
+import pgcr_cache
+import roster_index
+import score_engine
+import storage
+import user_cache
+
+# Name this script's activity runs are checkpointed under
+ACTIVITY_RUN_SOURCE = 'stat_updater'
+
+# Seconds after the bot's last heartbeat (one per user record flush) it is taken to have stopped
+BOT_HEARTBEAT_TIMEOUT = 4 * user_cache.USER_CACHE_FLUSH_INTERVAL
 
 class ActivityUpdater():
-    
+
+    def __init__(self, database, bungie, pgcr_cache, roster_index, history_cache=None, daily_chat=None):
+        self.database = database
+        self.bungie = bungie
+        self.pgcr_cache = pgcr_cache
+        self.roster_index = roster_index
+
+        # The bot's chat buckets as last saved, for the score windows
+        self.daily_chat = daily_chat if daily_chat is not None else {}
+
+        self.engine = activity_engine.ActivityEngine(bungie, pgcr_cache, roster_index, history_cache)
+
+    ####################################################################################################################
     # Clan Activity Updater
 
-    async def clan_activity_update(self):
+    async def clan_activity_update(self, users=None, concurrency=activity_engine.ACTIVITY_UPDATE_WORKERS, since=None,
+                                   dry_run=False):
+        """
+        Update members' Bungie stats and scores, saving each member as soon as they are done.
+
+        Discord chat counters are left as the bot last saved them.
+
+        Args:
+            users (list): user records to update. None updates every registered user, checkpointed so an interrupted
+                          run picks up where it stopped.
+            concurrency (int): members updated at once.
+            since (datetime.datetime): pull every day from this one on again, even if it is on record.
+            dry_run (bool): pull and score, but save nothing.
+
+        Returns (list): the updated user records.
+        """
         print("[*] >>> Updating clan activity scores per background task...")
 
-        for user_file in os.listdir(config.BOT_DB):
-            if user_file.endswith(".json"):
-                with open(config.BOT_DB + user_file) as user_file_data:
-                    user_data = json.load(user_file_data)
+        # Only a plain run over everyone is checkpointed; subsets are quick to run again
+        activity_run = None
 
-                print("[*] >>> BACKGROUND: Updating to {}'s stats...".format(user_data['bungie_name']))
+        if users is None:
+            users = self.database.get_users()
 
-                # Calculate discord stats
-#                discord_stats = await activity_manager.get_user_discord_activity_stats(user_data['discord_id'])
+            if since is None and not dry_run:
+                activity_run = self.database.open_activity_run(ACTIVITY_RUN_SOURCE,
+                                                               [user_data['discord_id'] for user_data in users],
+                                                               self._timestamp())
+                if activity_run['resumed']:
+                    print("[*] >>> Resuming activity run {} from {}, {}/{} members done.".format(
+                        activity_run['run_id'], activity_run['started_at'], activity_run['completed'],
+                        activity_run['total']))
 
-                # Update the data in the user's record
-                user_data['chat_events'] = 0 # discord_stats['chat_events']
-                user_data['characters_typed'] = 0 #discord_stats['characters_typed']
-                user_data['vc_minutes'] = 0 # discord_stats['vc_minutes']
+                pending_ids = set(self.database.get_activity_run_pending(activity_run['run_id']))
+                users = [user_data for user_data in users if user_data['discord_id'] in pending_ids]
 
-                # Calculate bungie stats
-                daily_bungie_stats = {}
+        def member_done(user_data):
+            # Scores only depend on the member's own stats
+            score_engine.score_users([user_data], self.daily_chat)
 
-                today_utc = datetime.datetime.utcnow()
-                today_report = today_utc.strftime("%Y-%m-%d")
-                reporting_period = (today_utc - datetime.timedelta(days=(int(config.STATISTICS_PERIOD))))
+            if dry_run:
+                return
 
-                iter_date = reporting_period
+            self.database.save_user(user_data)
+            if activity_run is not None:
+                self.database.complete_activity_run_members([(activity_run['run_id'], user_data['discord_id'])],
+                                                            self._timestamp())
 
-                while iter_date < today_utc:
-                    print(">>> STATS FOR: {}".format(iter_date))
+        await self.engine.update_members(users, concurrency, since=since, on_member_done=member_done)
 
-                    # See if we have stats already for that date (we don't pull current day))
-                    if iter_date.strftime("%Y-%m-%d") in user_data['game_activity'].keys() and iter_date.strftime("%Y-%m-%d") != today_report:
-                        daily_bungie_stats.update(
-                            {
-                                iter_date.strftime("%Y-%m-%d"): user_data['game_activity'][iter_date.strftime("%Y-%m-%d")]
-                            }
-                        )
+        if activity_run is not None:
+            self.database.finish_activity_run(activity_run['run_id'], self._timestamp())
 
-                    # If we don't, get them
-                    else:
-                        bungie_stats = await self.get_user_bungie_activity_stats(user_data['bungie_id'], iter_date)
+        print("[*] >>> Updating clan activity scores updated in background complete!")
+        print("[*] >>> PGCR cache: {}".format(self.pgcr_cache.stats()))
 
-                        daily_bungie_stats.update(
-                            {
-                                iter_date.strftime("%Y-%m-%d"): {
-                                    "seconds_played": bungie_stats['seconds_played'],
-                                    "unique_clan_members_played_with": bungie_stats['unique_clan_members_played_with'],
-                                    "clan_members_played_with": bungie_stats['clan_members_played_with']
-                                }
-                            }
-                        )
+        return users
 
-                    iter_date = iter_date + datetime.timedelta(days=1)
+    @staticmethod
+    def _timestamp():
+        return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
 
-                # Update the data in the user's record.
-                user_data['game_activity'] = daily_bungie_stats
+    # End of Clan Activity Updater
+    ####################################################################################################################
 
+    ####################################################################################################################
+    # Activity Job Worker
 
-                total_seconds_played = 0
-                total_unique_members_played_with = 0
-                total_clan_members_played_with = 0
+    async def work(self, activity_jobs, worker, concurrency, exit_when_idle=False):
+        """
+        Pull the bot's queued activity jobs, run them and store their results, until told to stop.
 
-                for stat_day, stat_values in user_data['game_activity'].items():
-                    total_seconds_played += user_data['game_activity'][stat_day]['seconds_played']
-                    total_unique_members_played_with += user_data['game_activity'][stat_day]['unique_clan_members_played_with']
-                    total_clan_members_played_with += user_data['game_activity'][stat_day]['clan_members_played_with']
+        Args:
+            activity_jobs (job_queue.ActivityJobQueue): the bot's job queue.
+            worker (str): name this worker claims jobs under.
+            concurrency (int): jobs run at once.
+            exit_when_idle (bool): return once the queue is empty instead of waiting for more jobs.
 
-                bonus_multiplier = total_clan_members_played_with + total_unique_members_played_with
-                activity_score = total_seconds_played + (user_data['chat_events'] * 60) + \
-                                               (user_data['characters_typed'] * 3) * bonus_multiplier
+        """
+        progress = {'done': 0, 'failed': 0}
 
-                user_data['clan_activity_score'] = activity_score
+        await asyncio.gather(*[self._job_worker(activity_jobs, worker, exit_when_idle, progress)
+                               for _ in range(concurrency)])
 
-                with open(config.BOT_DB + user_file, 'w') as user_file_data:
-                    json.dump(user_data, user_file_data)
+        print("[*] {}: finished, {} jobs done, {} failed.".format(worker, progress['done'], progress['failed']))
 
-                print("[*] >>> BACKGROUND: Update to {}'s stats complete.".format(user_data['bungie_name']))
+    async def _job_worker(self, activity_jobs, worker, exit_when_idle, progress):
+        loop = asyncio.get_event_loop()
 
-        print("[*] >>> Updating clan activity scores updated in background complete!")
+        while True:
+            job = await loop.run_in_executor(None, activity_jobs.claim, worker)
 
+            if job is None:
+                if exit_when_idle:
+                    return
 
-    # End of Clan Roster Updater
-    ####################################################################################################################
+                # Pick up any roster changes while there's nothing else to do
+                self.roster_index.reload()
+                await asyncio.sleep(job_queue.ACTIVITY_JOB_POLL_INTERVAL)
+                continue
+
+            try:
+                job_result = await self.run_job(job['payload'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                print("[!] {}: job {} for {} failed (attempt {}): {}: {}".format(
+                    worker, job['job_id'], job['payload']['bungie_name'], job['attempts'], ex.__class__.__name__, ex))
+                await loop.run_in_executor(None, activity_jobs.fail, job['job_id'],
+                                           "{}: {}".format(ex.__class__.__name__, ex))
+                progress['failed'] += 1
+                continue
 
-    async def get_user_bungie_activity_stats(self, bungie_id, day_to_pull):
-            stat_results = {}
-            today_utc = datetime.datetime.utcnow()
-            days_before = config.STATISTICS_PERIOD
-
-            profile_types = [3, 2, 1, 5]
-            member_type = None
-
-            for profile_type in profile_types:
-                while True:
-                    try:
-                        destiny = pydest.Pydest(config.BUNGIE_API_KEY)
-
-                        profile_data = await destiny.api.get_profile(profile_type, bungie_id, components=['100'])
-                        self.debug_api_call(profile_data)
-
-                        await destiny.close()
-                    except:
-                       time.sleep(2)
-                       await destiny.close()
-                       print("Trying call again...")
-                       continue 
-
-                    break
-
-                if str(profile_data['ErrorCode']) == "1":
-
-                    member_type = profile_type
-
-                    character_ids = profile_data['Response']['profile']['data']['characterIds']
-
-                    seconds_played = 0
-                    clan_members_played_with = 0
-                    unique_clan_members_played_with = set()
-                    for character_id in character_ids:
-                        pull_more_reports = True
-                        report_page = 0
-
-                        while pull_more_reports:
-                            # Pull the first 25 activities for the characters
-                            while True:
-                                try:
-                                    destiny = pydest.Pydest(config.BUNGIE_API_KEY)
-
-                                    history_report = await destiny.api.get_activity_history(member_type, bungie_id, character_id, count=25, mode=None, page=report_page)
-                                    self.debug_api_call(history_report)
-
-                                    await destiny.close()
-
-                                except:
-                                   time.sleep(2)
-                                   await destiny.close()
-                                   print("Trying call again...")
-                                   continue 
-
-                                break
-
-                            # See if their profile is set to private
-                            if str(history_report['ErrorCode']) == "1665":
-                                pull_more_reports = False
-                                stat_results.update({"seconds_played": 0})
-                                stat_results.update({"clan_members_played_with": 0})
-                                stat_results.update({"unique_clan_members_played_with": 0})
-                                break
-
-                            # If we don't get a response, we're done
-                            if len(history_report['Response']) == 0:
-                                pull_more_reports = False
-                                break
-
-                            # See if it has any activities in it
-                            if 'activities' not in history_report['Response'].keys():
-                                break
-
-                            # Increment the page count if we loop back
-                            report_page += 1
-                            character_activities = history_report['Response']['activities']
-
-                            for character_activity in character_activities:
-                                activity_time = datetime.datetime.strptime(character_activity['period'],
-                                                                        '%Y-%m-%dT%H:%M:%SZ')
-
-                                # If the activity is within the reporting period; process it
-                                if activity_time.date() == day_to_pull.date():
-                                    # Calculate seconds played
-                                    seconds_played += character_activity['values']['timePlayedSeconds']['basic']['value']
-                                    
-                                    while True:
-                                        try:
-                                            destiny = pydest.Pydest(config.BUNGIE_API_KEY)
-
-                                            activity_info = await destiny.api.get_post_game_carnage_report(character_activity['activityDetails']['instanceId'])
-                                            self.debug_api_call(activity_info)
-
-                                            await destiny.close()
-                                        except:
-                                            time.sleep(2)
-                                            await destiny.close()
-                                            print("Trying call again...")
-                                            continue
-                                    
-                                        break
-
-                                    if len(history_report['Response']) == 0:
-                                        pull_more_reports = False
-                                        break
-
-                                    # See who they played with in that activity
-                                    activity_players = activity_info['Response']['entries']
-                                    activity_clan_player_count = 0
-
-                                    for activity_player in activity_players:
-
-                                        # Make sure it isn't the player getting stats pulled on
-                                        if str(activity_player['player']['destinyUserInfo']['membershipId']) != str(
-                                                bungie_id):
-
-                                            # Deal with fireteam members who may have private profile settings
-                                            if str(activity_player['player']['destinyUserInfo']['isPublic']) == "True":
-                                                player_name = activity_player['player']['destinyUserInfo']['displayName']
-                                            else:
-                                                player_name = "<PRIVATE>"
-
-                                            player_id = activity_player['player']['destinyUserInfo']['membershipId']
-                                            print("\t\t\tLOOKUP: {} : {}".format(player_name, player_id))
-                                            # Find out if the players were in our clans
-                                            clan_search_results = self.check_if_clan_member(bungie_id=player_id)
-
-                                            if clan_search_results['is_member']:
-                                                activity_clan_player_count += 1
-                                                unique_clan_members_played_with.add(player_id)
-
-                                    # Cap at 2.9 to not landslipe PvPers or Iron Banner participants out of control
-                                    if activity_clan_player_count > 2:
-                                        clan_members_played_with += 2.9
-                                    else:
-                                        clan_members_played_with += activity_clan_player_count
-
-                                elif activity_time.date() < day_to_pull.date():
-                                    pull_more_reports = False
-                                    break
-
-                    stat_results.update({"seconds_played": seconds_played})
-                    stat_results.update({"clan_members_played_with": clan_members_played_with})
-                    stat_results.update({"unique_clan_members_played_with": len(unique_clan_members_played_with)})
-
-                    break
-            
-                # If we get 1665 (private profile)
-                elif str(profile_data['ErrorCode']) == "1665":
-                    stat_results.update({"seconds_played": '0'})
-                    stat_results.update({"clan_members_played_with": '0'})
-                    stat_results.update({"unique_clan_members_played_with": '0'})
-                
-                # If we get some other error code
-                else:
-                    stat_results.update({"seconds_played": '0'})
-                    stat_results.update({"clan_members_played_with": '0'})
-                    stat_results.update({"unique_clan_members_played_with": '0'})
-
-            return stat_results
-
-    def check_if_clan_member(self, bungie_id=None, profile_name=None):
-        """Checks the cached roster if member is in the clans.
-
-            Returns (dict):
-                            return_results['bungie_id'] = member['id']
-                            return_results['bungie_name'] = member['name']
-                            return_results['is_member'] = True
+            await loop.run_in_executor(None, activity_jobs.complete, job['job_id'], job_result)
+            progress['done'] += 1
+
+            if progress['done'] % 25 == 0:
+                print("[*] {}: {} jobs done, {} failed, queue: {}".format(
+                    worker, progress['done'], progress['failed'],
+                    await loop.run_in_executor(None, activity_jobs.progress)))
+
+    async def run_job(self, payload):
         """
-        return_results = {}
-        return_results['is_member'] = False
-
-        for clan_roster in os.listdir("clans/"):
-            with open("clans/" + clan_roster) as clan_data_file:
-                clan_data = json.load(clan_data_file)
-
-            for member in clan_data['members']:
-                if bungie_id is not None:
-                    if str(member['id']) == str(bungie_id):
-                        return_results['bungie_id'] = member['id']
-                        return_results['bungie_name'] = member['name']
-                        return_results['is_member'] = True
-                        break
-
-                if profile_name is not None:
-                    if str(member['name']).lower() == str(profile_name).lower():
-                        return_results['bungie_id'] = member['id']
-                        return_results['bungie_name'] = member['name']
-                        return_results['is_member'] = True
-                        break
-            
-            # If we've found them, we don't need to keep searching
-            if return_results['is_member']:
-                break
-
-        return return_results
-
-    def debug_api_call(self, api_response):
-        # if api_response['ErrorCode'] != 1:
-        time_now = datetime.datetime.utcnow()
-        print("{}: ErrorCode: {}, ThrottleSeconds: {}, Message: {}, MessageData: {}".format(time_now,
-                                                                                            api_response['ErrorCode'],
-                                                                                            api_response[
-                                                                                                'ThrottleSeconds'],
-                                                                                            api_response['Message'],
-                                                                                            api_response[
-                                                                                                'MessageData']))
-        #if 'Response' in api_response.keys():
-            #print("\t\tRESPONSE: {}".format(api_response['Response']))
+        Pull the Bungie stats a queued job asks for.
+
+        Args:
+            payload (dict): the job as queued by the bot's clan_activity_update.
+
+        Returns (dict): {'game_activity': stats per day, 'membership_type': .., 'character_ids': ..,
+                         'profile_resolved_at': ..}
+        """
+        profile = {profile_field: payload.get(profile_field)
+                   for profile_field in ('membership_type', 'character_ids', 'profile_resolved_at')}
+        days_to_pull = [datetime.datetime.strptime(day, "%Y-%m-%d") for day in payload['days']]
+
+        # Unlike the in-bot update, a Bungie failure fails the job so it is retried
+        game_activity = await self.engine.get_user_bungie_activity_stats(payload['bungie_id'], days_to_pull, profile)
+
+        job_result = {'game_activity': game_activity}
+        job_result.update(profile)
+
+        return job_result
+
+    # End of Activity Job Worker
+    ####################################################################################################################
+
+
+def run_worker(worker_number, concurrency, exit_when_idle, rate_share):
+    """
+    Run one worker process.
+
+    Args:
+        worker_number (int): number of the process on this host.
+        concurrency (int): jobs run at once.
+        exit_when_idle (bool): stop once the queue is empty.
+        rate_share (float): share of the Bungie request budget this process gets.
+
+    """
+    database = storage.BrewDatabase()
+    activity_jobs = job_queue.ActivityJobQueue()
+    rate_limiter = bungie_client.RateLimiter(bungie_client.BUNGIE_RATE_LIMIT * rate_share,
+                                             max(1, bungie_client.BUNGIE_RATE_BURST * rate_share))
+    bungie = bungie_client.BungieClient(config.BUNGIE_API_KEY, rate_limiter=rate_limiter)
+    report_cache = pgcr_cache.PgcrCache(config.BOT_BASEDIR + "pgcr_cache.db")
+    character_histories = history_cache.HistoryCache(config.BOT_BASEDIR + "history_cache.db")
+    clan_rosters = roster_index.RosterIndex(database)
+    activity_manager = ActivityUpdater(database, bungie, report_cache, clan_rosters, character_histories)
+
+    worker = job_queue.worker_name(worker_number)
+    print("[*] {}: waiting for activity jobs...".format(worker))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        loop.run_until_complete(activity_manager.work(activity_jobs, worker, concurrency, exit_when_idle))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(bungie.close())
+        loop.close()
+        report_cache.close()
+        character_histories.close()
+        activity_jobs.close()
+        database.close()
+
+
+def select_users(database, user_names=None, clan_name=None):
+    """
+    Pick the registered users a run is limited to.
+
+    Args:
+        database (storage.BrewDatabase): the bot's database.
+        user_names (list): discord IDs, bungie IDs or bungie names; None for no limit.
+        clan_name (str): name or ID of one of config.BREW_CLANS; None for no limit.
+
+    Returns (list): user records, or None if the run isn't limited at all.
+    """
+    if user_names is None and clan_name is None:
+        return None
+
+    clan_id = None
+    if clan_name is not None:
+        clan = next((brew_clan for brew_clan in config.BREW_CLANS
+                     if str(clan_name).casefold() in (str(brew_clan['clan_name']).casefold(),
+                                                      str(brew_clan['clan_id']))), None)
+        if clan is None:
+            raise SystemExit("[!] I don't know a clan called {}.".format(clan_name))
+
+        clan_id = clan['clan_id']
+
+    users = database.get_users(clan_id)
+
+    if user_names is not None:
+        wanted = set(str(user_name).casefold() for user_name in user_names)
+        users = [user_data for user_data in users
+                 if wanted & {str(user_data['discord_id']), str(user_data['bungie_id']),
+                              str(user_data['bungie_name']).casefold()}]
+
+    return users
+
+
+def bot_is_running(database):
+    """
+    Whether a running bot holds the user records in its write-back cache, going by its heartbeat.
+
+    Returns (bool): True if it beat within the last BOT_HEARTBEAT_TIMEOUT seconds.
+    """
+    heartbeat = database.get_bot_heartbeat()
+    if heartbeat is None:
+        return False
+
+    beat_at = datetime.datetime.strptime(heartbeat, "%Y-%m-%d %H:%M:%S")
+
+    return (datetime.datetime.utcnow() - beat_at).total_seconds() < BOT_HEARTBEAT_TIMEOUT
+
+
+def parse_day(day):
+    return datetime.datetime.strptime(day, "%Y-%m-%d")
+
 
 def main():
-    activity_manager = ActivityUpdater()
-    
+    parser = argparse.ArgumentParser(description="Update members' bungie stats without the bot, or run activity job "
+                                                 "workers.")
+    parser.add_argument('--users', nargs='+', metavar='USER',
+                        help="only update these members (discord IDs, bungie IDs or bungie names)")
+    parser.add_argument('--clan', help="only update the members of this clan (name or ID)")
+    parser.add_argument('--since', type=parse_day, metavar='YYYY-MM-DD',
+                        help="pull every day from this one on again, even if it is on record")
+    parser.add_argument('--concurrency', type=int, default=activity_engine.ACTIVITY_UPDATE_WORKERS,
+                        help="members updated at once")
+    parser.add_argument('--dry-run', action='store_true', help="pull and score, but save nothing")
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                        help="profile the run; print the hot spots, or save the stats to FILE")
+
+    subcommands = parser.add_subparsers(dest='command')
+
+    worker_parser = subcommands.add_parser('worker', help="run workers for the jobs the bot queues "
+                                                          "(ACTIVITY_UPDATE_MODE = 'queue')")
+    worker_parser.add_argument('--processes', type=int, default=1, help="worker processes to start on this host")
+    worker_parser.add_argument('--concurrency', type=int, default=4, help="jobs each process runs at once")
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help="stop once the queue is empty")
+    worker_parser.add_argument('--rate-share', type=float, default=1.0,
+                               help="share of BUNGIE_RATE_LIMIT for this host, split evenly between its processes")
+
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        rate_share = args.rate_share / args.processes
+
+        if args.processes == 1:
+            run_worker(0, args.concurrency, args.exit_when_idle, rate_share)
+            return
+
+        worker_processes = [multiprocessing.Process(target=run_worker, name="activity-worker-{}".format(number),
+                                                    args=(number, args.concurrency, args.exit_when_idle, rate_share))
+                            for number in range(args.processes)]
+        for worker_process in worker_processes:
+            worker_process.start()
+        for worker_process in worker_processes:
+            worker_process.join()
+        return
+
+    database = storage.open_database()
+
+    # The bot never reloads user records, so its next flush would overwrite whatever this run saves
+    if not args.dry_run and bot_is_running(database):
+        database.close()
+        parser.exit(1, "[!] BrewBot is running and holds the user records. Stop it first, or use --dry-run.\n")
+
+    bungie = bungie_client.BungieClient(config.BUNGIE_API_KEY)
+    report_cache = pgcr_cache.PgcrCache(config.BOT_BASEDIR + "pgcr_cache.db")
+    character_histories = history_cache.HistoryCache(config.BOT_BASEDIR + "history_cache.db")
+    chat_activity = chat_tracker.ChatTracker(config.BOT_BASEDIR + "chat_activity.json")
+    clan_rosters = roster_index.RosterIndex(database)
+    activity_manager = ActivityUpdater(database, bungie, report_cache, clan_rosters, character_histories,
+                                       chat_activity.daily_chat)
+
+    users = select_users(database, args.users, args.clan)
+    if users is not None:
+        print("[*] >>> Updating {} selected members.".format(len(users)))
+
+    scores_before = {}
+    if args.dry_run:
+        scores_before = {user_data['discord_id']: user_data['clan_activity_score']
+                         for user_data in (users if users is not None else database.get_users())}
+
+    profiler = cProfile.Profile() if args.profile is not None else None
     loop = asyncio.get_event_loop()
 
-    loop.run_until_complete(activity_manager.clan_activity_update())
-    loop.close()
-
+    try:
+        if profiler is not None:
+            profiler.enable()
+
+        updated_users = loop.run_until_complete(activity_manager.clan_activity_update(
+            users, args.concurrency, args.since, args.dry_run))
+
+        if profiler is not None:
+            profiler.disable()
+    finally:
+        loop.run_until_complete(bungie.close())
+        loop.close()
+        report_cache.close()
+        character_histories.close()
+        database.close()
+
+    if args.dry_run:
+        print("[*] >>> Dry run, nothing saved. Scores would change as follows:")
+        for user_data in updated_users:
+            print("\t{}: {:,.0f} -> {:,.0f}".format(user_data['bungie_name'],
+                                                    scores_before.get(user_data['discord_id'], 0),
+                                                    user_data['clan_activity_score']))
+
+    if profiler is not None:
+        if args.profile == '-':
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+        else:
+            profiler.dump_stats(args.profile)
+            print("[*] >>> Profile saved to {}.".format(args.profile))
+
+        for endpoint, endpoint_metrics in sorted(bungie.metrics.endpoints.items()):
+            print("[*] >>> {}: {:,} requests, avg {:.0f}ms, {:,} retries, {:,} saved by sharing".format(
+                endpoint, endpoint_metrics.requests,
+                1000 * endpoint_metrics.latency_sum / max(1, endpoint_metrics.requests),
+                endpoint_metrics.retries, endpoint_metrics.coalesced))
 
 
 if __name__ == '__main__':
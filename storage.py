@@ -0,0 +1,503 @@
+import json
+import os
+import sqlite3
+import threading
+
+import config
+
+
+# Location of the bot's database. Can be overridden from config.py.
+BOT_DB_PATH = getattr(config, 'BOT_DB_PATH', config.BOT_BASEDIR + "brewbot.db")
+
+# Columns of the users table; anything else in a user record is kept in its 'extra' JSON blob
+USER_COLUMNS = ['discord_id', 'bungie_id', 'discord_name', 'bungie_name', 'clan_id', 'clan_name', 'created_at',
+                'clan_activity_score', 'chat_events', 'characters_typed', 'vc_minutes']
+
+GAME_ACTIVITY_COLUMNS = ['seconds_played', 'clan_members_played_with', 'unique_clan_members_played_with']
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS users ("
+    "discord_id TEXT PRIMARY KEY, "
+    "bungie_id TEXT NOT NULL, "
+    "discord_name TEXT, "
+    "bungie_name TEXT, "
+    "clan_id TEXT, "
+    "clan_name TEXT, "
+    "created_at TEXT, "
+    "clan_activity_score REAL NOT NULL DEFAULT 0, "
+    "chat_events INTEGER NOT NULL DEFAULT 0, "
+    "characters_typed INTEGER NOT NULL DEFAULT 0, "
+    "vc_minutes INTEGER NOT NULL DEFAULT 0, "
+    "extra TEXT NOT NULL DEFAULT '{}')",
+    "CREATE INDEX IF NOT EXISTS users_bungie_id ON users (bungie_id)",
+    "CREATE INDEX IF NOT EXISTS users_clan_id ON users (clan_id)",
+
+    "CREATE TABLE IF NOT EXISTS game_activity ("
+    "discord_id TEXT NOT NULL, "
+    "activity_day TEXT NOT NULL, "
+    "seconds_played INTEGER NOT NULL DEFAULT 0, "
+    "clan_members_played_with REAL NOT NULL DEFAULT 0, "
+    "unique_clan_members_played_with INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (discord_id, activity_day))",
+
+    "CREATE TABLE IF NOT EXISTS clans ("
+    "clan_id TEXT PRIMARY KEY, "
+    "last_updated TEXT)",
+
+    "CREATE TABLE IF NOT EXISTS clan_rosters ("
+    "clan_id TEXT NOT NULL, "
+    "bungie_id TEXT NOT NULL, "
+    "bungie_name TEXT, "
+    "date_joined TEXT, "
+    "PRIMARY KEY (clan_id, bungie_id))",
+    "CREATE INDEX IF NOT EXISTS clan_rosters_bungie_id ON clan_rosters (bungie_id)",
+
+    "CREATE TABLE IF NOT EXISTS roster_changes ("
+    "change_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "changed_at TEXT NOT NULL, "
+    "clan_id TEXT NOT NULL, "
+    "bungie_id TEXT NOT NULL, "
+    "bungie_name TEXT, "
+    "change TEXT NOT NULL)",
+
+    "CREATE TABLE IF NOT EXISTS activity_runs ("
+    "run_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "source TEXT NOT NULL, "
+    "started_at TEXT NOT NULL, "
+    "finished_at TEXT)",
+    "CREATE INDEX IF NOT EXISTS activity_runs_source ON activity_runs (source, run_id)",
+
+    "CREATE TABLE IF NOT EXISTS activity_run_members ("
+    "run_id INTEGER NOT NULL, "
+    "discord_id TEXT NOT NULL, "
+    "position INTEGER NOT NULL, "
+    "completed_at TEXT, "
+    "PRIMARY KEY (run_id, discord_id))",
+
+    "CREATE TABLE IF NOT EXISTS meta ("
+    "key TEXT PRIMARY KEY, "
+    "value TEXT)",
+]
+
+
+class BrewDatabase:
+    """
+    SQLite storage for registered users, their per-day activity and the cached clan rosters.
+
+    User records are handed out and taken back in the same dict shape the bot has always used, so callers don't
+    need to know how they are laid out in the tables.
+    """
+
+    def __init__(self, db_path=BOT_DB_PATH):
+        """
+        Open (or create) the database.
+
+        Args:
+            db_path (str): path of the SQLite database file.
+        """
+        self.db_path = db_path
+
+        # The connection is shared with executor threads (see UserCache.flush), so every use holds the lock
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
+
+        # WAL lets the bot and the headless updater read while the other one writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+
+        with self._db:
+            for statement in SCHEMA:
+                self._db.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    ####################################################################################################################
+    # Users
+
+    def get_user(self, discord_id):
+        """
+        Look up a registered user by discord ID.
+
+        Returns (dict): the user record, or None if they aren't registered.
+        """
+        users = self._load_users("WHERE discord_id = ?", (str(discord_id),))
+        return users[0] if len(users) > 0 else None
+
+    def find_user(self, discord_id=None, bungie_id=None):
+        """
+        Look up a registered user by discord ID or bungie ID.
+
+        Returns (dict): the first matching user record, or None.
+        """
+        users = self._load_users("WHERE discord_id = ? OR bungie_id = ? LIMIT 1", (str(discord_id), str(bungie_id)))
+        return users[0] if len(users) > 0 else None
+
+    def get_users(self, clan_id=None):
+        """
+        Load every registered user, optionally only those of one clan.
+
+        Returns (list): user records.
+        """
+        if clan_id is None:
+            return self._load_users("", ())
+
+        return self._load_users("WHERE clan_id = ?", (str(clan_id),))
+
+    def _load_users(self, where, params):
+        with self._lock:
+            return self._load_users_locked(where, params)
+
+    def _load_users_locked(self, where, params):
+        user_rows = self._db.execute("SELECT * FROM users " + where, params).fetchall()
+        if len(user_rows) == 0:
+            return []
+
+        # Pull the activity of just these users in one query
+        discord_ids = [user_row['discord_id'] for user_row in user_rows]
+        game_activity = {discord_id: {} for discord_id in discord_ids}
+
+        if len(user_rows) == 1:
+            activity_rows = self._db.execute("SELECT * FROM game_activity WHERE discord_id = ?", (discord_ids[0],))
+        else:
+            activity_rows = self._db.execute("SELECT * FROM game_activity WHERE discord_id IN "
+                                             "(SELECT discord_id FROM users " + where + ")", params)
+
+        for activity_row in activity_rows:
+            game_activity[activity_row['discord_id']][activity_row['activity_day']] = {
+                column: activity_row[column] for column in GAME_ACTIVITY_COLUMNS
+            }
+
+        users = []
+        for user_row in user_rows:
+            user_data = json.loads(user_row['extra'])
+            user_data.update({column: user_row[column] for column in USER_COLUMNS})
+            user_data['game_activity'] = game_activity[user_row['discord_id']]
+            users.append(user_data)
+
+        return users
+
+    def save_user(self, user_data):
+        """
+        Insert or update a user record along with its per-day activity.
+
+        Returns: None.
+
+        """
+        self.save_users([user_data])
+
+    def save_users(self, users):
+        """
+        Insert or update several user records in a single transaction.
+
+        Args:
+            users (list): user records.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            for user_data in users:
+                self._write_user(user_data)
+
+    def _write_user(self, user_data):
+        discord_id = str(user_data['discord_id'])
+
+        extra = {key: value for key, value in user_data.items() if key not in USER_COLUMNS and key != 'game_activity'}
+
+        user_row = {column: user_data.get(column) for column in USER_COLUMNS}
+        user_row['discord_id'] = discord_id
+        user_row['bungie_id'] = str(user_data['bungie_id'])
+        user_row['extra'] = json.dumps(extra)
+
+        if user_row['clan_id'] is not None:
+            user_row['clan_id'] = str(user_row['clan_id'])
+
+        for column in ('clan_activity_score', 'chat_events', 'characters_typed', 'vc_minutes'):
+            if user_row[column] is None:
+                user_row[column] = 0
+
+        self._db.execute("INSERT OR REPLACE INTO users ({}, extra) VALUES ({}, :extra)".format(
+            ", ".join(USER_COLUMNS), ", ".join(":" + column for column in USER_COLUMNS)), user_row)
+
+        self._db.execute("DELETE FROM game_activity WHERE discord_id = ?", (discord_id,))
+        self._db.executemany(
+            "INSERT INTO game_activity (discord_id, activity_day, {}) VALUES (?, ?, ?, ?, ?)".format(
+                ", ".join(GAME_ACTIVITY_COLUMNS)),
+            [[discord_id, activity_day] + [day_stats.get(column, 0) for column in GAME_ACTIVITY_COLUMNS]
+             for activity_day, day_stats in user_data.get('game_activity', {}).items()])
+
+    ####################################################################################################################
+    # Clan rosters
+
+    def get_clan_roster(self, clan_id):
+        """
+        Load a clan's cached roster.
+
+        Returns (dict): {'last_updated': .., 'members': [{'name': .., 'id': .., 'date_joined': ..}, ..]}, or None if
+                        the clan's roster has never been cached.
+        """
+        with self._lock:
+            clan_row = self._db.execute("SELECT * FROM clans WHERE clan_id = ?", (str(clan_id),)).fetchone()
+            if clan_row is None:
+                return None
+
+            member_rows = self._db.execute("SELECT * FROM clan_rosters WHERE clan_id = ?", (str(clan_id),)).fetchall()
+
+        return {
+            'last_updated': clan_row['last_updated'],
+            'members': [{'name': member_row['bungie_name'], 'id': member_row['bungie_id'],
+                         'date_joined': member_row['date_joined']} for member_row in member_rows]
+        }
+
+    def get_clan_rosters(self):
+        """
+        Load every cached roster.
+
+        Returns (dict): clan ID -> list of roster entries.
+        """
+        with self._lock:
+            clan_rows = self._db.execute("SELECT clan_id FROM clans").fetchall()
+            member_rows = self._db.execute("SELECT * FROM clan_rosters").fetchall()
+
+        rosters = {clan_row['clan_id']: [] for clan_row in clan_rows}
+
+        for member_row in member_rows:
+            rosters.setdefault(member_row['clan_id'], []).append(
+                {'name': member_row['bungie_name'], 'id': member_row['bungie_id'],
+                 'date_joined': member_row['date_joined']})
+
+        return rosters
+
+    def save_clan_roster(self, clan_id, members, last_updated, joined=(), left=()):
+        """
+        Replace a clan's cached roster, logging who joined and left in the same transaction.
+
+        Args:
+            clan_id (str): ID of the clan.
+            members (list): roster entries as built by bungie_api.generate_clan_list.
+            last_updated (str): when the roster was pulled.
+            joined (list): roster entries of the members who joined since the last save.
+            left (list): roster entries of the members who left since the last save.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            self._db.executemany("INSERT INTO roster_changes (changed_at, clan_id, bungie_id, bungie_name, change) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 [(last_updated, str(clan_id), str(member['id']), member['name'], change)
+                                  for change, changed_members in (('joined', joined), ('left', left))
+                                  for member in changed_members])
+            self._db.execute("INSERT OR REPLACE INTO clans (clan_id, last_updated) VALUES (?, ?)",
+                             (str(clan_id), last_updated))
+            self._db.execute("DELETE FROM clan_rosters WHERE clan_id = ?", (str(clan_id),))
+            self._db.executemany("INSERT OR REPLACE INTO clan_rosters (clan_id, bungie_id, bungie_name, date_joined) "
+                                 "VALUES (?, ?, ?, ?)",
+                                 [(str(clan_id), str(member['id']), member['name'], member.get('date_joined'))
+                                  for member in members])
+
+    def get_roster_changes(self, since_id=0):
+        """
+        Read the membership delta log.
+
+        Args:
+            since_id (int): only return changes logged after this change_id.
+
+        Returns (list): {'change_id', 'changed_at', 'clan_id', 'bungie_id', 'bungie_name', 'change'} dicts, oldest
+                        first, where change is 'joined' or 'left'.
+        """
+        with self._lock:
+            change_rows = self._db.execute("SELECT * FROM roster_changes WHERE change_id > ? ORDER BY change_id",
+                                           (since_id,)).fetchall()
+
+        return [dict(change_row) for change_row in change_rows]
+
+    ####################################################################################################################
+    # Activity runs
+
+    def open_activity_run(self, source, discord_ids, started_at):
+        """
+        Pick up the source's unfinished activity run, or start a new one over the given members.
+
+        Args:
+            source (str): what is running the update, e.g. 'bot' or 'stat_updater'.
+            discord_ids (list): members to cover if a new run is started, in the order they should be updated.
+            started_at (str): when a new run starts.
+
+        Returns (dict): the run (see get_activity_run) with 'resumed' set if it was already under way.
+        """
+        with self._lock, self._db:
+            run_row = self._db.execute("SELECT run_id FROM activity_runs WHERE source = ? AND finished_at IS NULL "
+                                       "ORDER BY run_id DESC LIMIT 1", (source,)).fetchone()
+            resumed = run_row is not None
+
+            if resumed:
+                run_id = run_row['run_id']
+            else:
+                run_id = self._db.execute("INSERT INTO activity_runs (source, started_at) VALUES (?, ?)",
+                                          (source, started_at)).lastrowid
+
+                # Only the current run's markers are worth keeping
+                self._db.execute("DELETE FROM activity_run_members WHERE run_id IN "
+                                 "(SELECT run_id FROM activity_runs WHERE source = ? AND run_id < ?)", (source, run_id))
+                self._db.executemany("INSERT OR IGNORE INTO activity_run_members (run_id, discord_id, position) "
+                                     "VALUES (?, ?, ?)",
+                                     [(run_id, str(discord_id), position)
+                                      for position, discord_id in enumerate(discord_ids)])
+
+            activity_run = self._activity_run_locked(run_id)
+
+        activity_run['resumed'] = resumed
+        return activity_run
+
+    def get_activity_run(self, source):
+        """
+        The source's latest activity run.
+
+        Returns (dict): {'run_id', 'source', 'started_at', 'finished_at', 'total', 'completed'}, or None if the source
+                        has never run. finished_at is None while the run is under way.
+        """
+        with self._lock:
+            run_row = self._db.execute("SELECT run_id FROM activity_runs WHERE source = ? ORDER BY run_id DESC LIMIT 1",
+                                       (source,)).fetchone()
+            if run_row is None:
+                return None
+
+            return self._activity_run_locked(run_row['run_id'])
+
+    def _activity_run_locked(self, run_id):
+        activity_run = dict(self._db.execute("SELECT * FROM activity_runs WHERE run_id = ?", (run_id,)).fetchone())
+        activity_run['total'], activity_run['completed'] = self._db.execute(
+            "SELECT COUNT(*), COUNT(completed_at) FROM activity_run_members WHERE run_id = ?", (run_id,)).fetchone()
+
+        return activity_run
+
+    def get_activity_run_pending(self, run_id):
+        """
+        Members of a run that haven't been completed yet.
+
+        Returns (list): discord IDs, in the run's order.
+        """
+        with self._lock:
+            member_rows = self._db.execute("SELECT discord_id FROM activity_run_members WHERE run_id = ? "
+                                           "AND completed_at IS NULL ORDER BY position", (run_id,)).fetchall()
+
+        return [member_row['discord_id'] for member_row in member_rows]
+
+    def complete_activity_run_members(self, completed, completed_at):
+        """
+        Mark members of a run as done, so a resumed run skips them.
+
+        Args:
+            completed (list): (run_id, discord_id) tuples.
+            completed_at (str): when they were done.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            self._db.executemany("UPDATE activity_run_members SET completed_at = ? WHERE run_id = ? AND discord_id = ?",
+                                 [(completed_at, run_id, str(discord_id)) for run_id, discord_id in completed])
+
+    def finish_activity_run(self, run_id, finished_at):
+        """
+        Close a run, so the next one starts from scratch.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE activity_runs SET finished_at = ? WHERE run_id = ?", (finished_at, run_id))
+
+    ####################################################################################################################
+    # Bot Heartbeat
+
+    def touch_bot_heartbeat(self, beat_at):
+        """
+        Record that a running bot holds the user records in its write-back cache.
+
+        Args:
+            beat_at (str): "%Y-%m-%d %H:%M:%S" UTC time of the heartbeat.
+
+        Returns: None.
+
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bot_heartbeat', ?)", (beat_at,))
+
+    def clear_bot_heartbeat(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM meta WHERE key = 'bot_heartbeat'")
+
+    def get_bot_heartbeat(self):
+        """
+        When a running bot last said it holds the user records.
+
+        Returns (str): "%Y-%m-%d %H:%M:%S" UTC, or None if the bot shut down cleanly or never ran.
+        """
+        with self._lock:
+            heartbeat_row = self._db.execute("SELECT value FROM meta WHERE key = 'bot_heartbeat'").fetchone()
+
+        return heartbeat_row['value'] if heartbeat_row is not None else None
+
+    ####################################################################################################################
+    # Migration
+
+    def migrate_from_json(self, user_dir, roster_dir):
+        """
+        One-shot import of the legacy per-user JSON files and clans/<id>.json rosters.
+
+        Only runs once per database; later calls do nothing.
+
+        Args:
+            user_dir (str): directory of the <discord_id>.json user records.
+            roster_dir (str): directory of the <clan_id>.json roster files.
+
+        Returns (bool): True if the import ran.
+        """
+        if self._db.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone() is not None:
+            return False
+
+        users = []
+        if os.path.isdir(user_dir):
+            for user_file in os.listdir(user_dir):
+                if user_file.endswith(".json"):
+                    with open(user_dir + user_file) as user_file_data:
+                        users.append(json.load(user_file_data))
+
+        self.save_users(users)
+
+        roster_count = 0
+        if os.path.isdir(roster_dir):
+            for clan_roster in os.listdir(roster_dir):
+                if clan_roster.endswith(".json"):
+                    with open(roster_dir + clan_roster) as clan_data_file:
+                        clan_data = json.load(clan_data_file)
+
+                    self.save_clan_roster(clan_roster[:-len(".json")], clan_data['members'],
+                                          clan_data.get('last_updated'))
+                    roster_count += 1
+
+        with self._db:
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)",
+                             ("{} users, {} rosters".format(len(users), roster_count),))
+
+        print("[*] Migrated {} users and {} clan rosters from JSON into {}.".format(len(users), roster_count,
+                                                                                  self.db_path))
+        return True
+
+
+def open_database():
+    """
+    Open the bot's database, importing the legacy JSON records the first time.
+
+    Returns: BrewDatabase
+
+    """
+    database = BrewDatabase()
+    database.migrate_from_json(config.BOT_DB, config.BOT_BASEDIR + "clans/")
+
+    return database
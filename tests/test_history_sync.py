@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import config
+except ImportError:
+    # config.py holds the bot's secrets and isn't part of the repo; the engine only needs the statistics period
+    config = types.ModuleType('config')
+    config.STATISTICS_PERIOD = 30
+    sys.modules['config'] = config
+
+import activity_engine
+import bungie_client
+import history_cache
+import pgcr_cache
+
+
+def history_activity(instance_id, period):
+    return {'period': period.strftime('%Y-%m-%dT%H:%M:%SZ'), 'activityDetails': {'instanceId': instance_id},
+            'values': {'timePlayedSeconds': {'basic': {'value': 60}}}}
+
+
+class FakeBungie:
+    """Serves one character's history, newest first, failing the pages listed in failing_pages."""
+
+    def __init__(self, activities):
+        self.activities = activities
+        self.failing_pages = set()
+        self.requests = 0
+
+    async def get_activity_history(self, membership_type, membership_id, character_id, count=1, mode=None, page=0):
+        self.requests += 1
+
+        if page in self.failing_pages:
+            return {'ErrorCode': 5, 'ErrorStatus': "SystemDisabled"}
+
+        history_page = self.activities[page * count:(page + 1) * count]
+        if len(history_page) == 0:
+            return {'ErrorCode': 1, 'Response': {}}
+
+        return {'ErrorCode': 1, 'Response': {'activities': [history_activity(instance_id, period)
+                                                            for instance_id, period in history_page]}}
+
+    async def get_post_game_carnage_report(self, activity_id):
+        self.requests += 1
+        return {'ErrorCode': 5, 'ErrorStatus': "SystemDisabled"}
+
+
+class HistorySyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.history = history_cache.HistoryCache(os.path.join(self.work_dir.name, "history_cache.db"))
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.oldest_day = (now - datetime.timedelta(days=5)).strftime("%Y-%m-%d")
+
+        # Three pages' worth of activity since the last sync, which stopped at instance 1
+        self.known = ("1", now - datetime.timedelta(days=3))
+        self.bungie = FakeBungie([(str(1000 - minutes), now - datetime.timedelta(minutes=minutes))
+                                  for minutes in range(2 * bungie_client.ACTIVITY_HISTORY_PAGE_SIZE + 50)] +
+                                 [self.known])
+
+        known_period = self.known[1].strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.history.record("character", [(self.known[0], known_period, 60)], (self.known[0], known_period),
+                            self.oldest_day, self.oldest_day)
+
+        self.engine = activity_engine.ActivityEngine(self.bungie, None, None, self.history)
+
+    def tearDown(self):
+        self.history.close()
+        self.work_dir.cleanup()
+
+    def sync(self):
+        return asyncio.get_event_loop().run_until_complete(
+            self.engine._sync_character_history("bungie", 3, "character", self.oldest_day))
+
+    def test_failed_page_leaves_cache_untouched(self):
+        watermark = self.history.watermark("character")
+        cached = self.history.activities("character", self.oldest_day)
+
+        self.bungie.failing_pages = {1}
+        with self.assertRaises(bungie_client.BungieApiError):
+            self.sync()
+
+        self.assertEqual(self.history.watermark("character"), watermark)
+        self.assertEqual(self.history.activities("character", self.oldest_day), cached)
+
+    def test_sync_after_failure_fetches_everything(self):
+        self.bungie.failing_pages = {1}
+        with self.assertRaises(bungie_client.BungieApiError):
+            self.sync()
+
+        self.bungie.failing_pages = set()
+        activities, platform_error = self.sync()
+
+        self.assertFalse(platform_error)
+        self.assertEqual(len(activities), len(self.bungie.activities))
+        self.assertEqual(self.history.watermark("character")['instance_id'], self.bungie.activities[0][0])
+
+
+class UpdateMemberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.history = history_cache.HistoryCache(os.path.join(self.work_dir.name, "history_cache.db"))
+        self.pgcr = pgcr_cache.PgcrCache(os.path.join(self.work_dir.name, "pgcr_cache.db"))
+
+        yesterday = datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(days=1)
+        self.bungie = FakeBungie([("1", yesterday)])
+
+        self.engine = activity_engine.ActivityEngine(self.bungie, self.pgcr, None, self.history)
+
+    def tearDown(self):
+        self.pgcr.close()
+        self.history.close()
+        self.work_dir.cleanup()
+
+    def test_failed_report_leaves_days_missing(self):
+        user_data = {'bungie_name': "Guardian#0001", 'bungie_id': "bungie", 'discord_id': "discord",
+                     'game_activity': {}, 'membership_type': 3, 'character_ids': ["character"],
+                     'profile_resolved_at': datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")}
+
+        pulled_days = asyncio.get_event_loop().run_until_complete(self.engine.update_member(user_data))
+
+        self.assertEqual(pulled_days, [])
+        self.assertEqual(user_data['game_activity'], {})
+        self.assertIsNone(self.pgcr.get("1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
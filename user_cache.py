@@ -0,0 +1,113 @@
+import asyncio
+import copy
+
+import config
+
+
+# Seconds between write-backs of changed user records. Can be overridden from config.py.
+USER_CACHE_FLUSH_INTERVAL = getattr(config, 'USER_CACHE_FLUSH_INTERVAL', 30)
+
+
+class UserCache:
+    """
+    Write-back, in-memory cache of every registered user's record.
+
+    Records are loaded once at startup and handed out directly, so commands and background tasks never touch the
+    database on the request path. Whoever changes a record marks it dirty, and flush() writes every dirty record in
+    one database transaction on an executor thread.
+    """
+
+    def __init__(self, database):
+        """
+        Load every user record from the database.
+
+        Args:
+            database (storage.BrewDatabase): the bot's database.
+        """
+        self.database = database
+
+        self._users = {}
+        self._bungie_ids = {}
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+
+        for user_data in database.get_users():
+            self._index(user_data)
+
+    def _index(self, user_data):
+        self._users[str(user_data['discord_id'])] = user_data
+        self._bungie_ids[str(user_data['bungie_id'])] = str(user_data['discord_id'])
+
+    def get(self, discord_id):
+        """
+        Look up a registered user by discord ID.
+
+        Returns (dict): the user record, or None if they aren't registered.
+        """
+        return self._users.get(str(discord_id))
+
+    def find(self, discord_id=None, bungie_id=None):
+        """
+        Look up a registered user by discord ID or bungie ID.
+
+        Returns (dict): the matching user record, or None.
+        """
+        user_data = self._users.get(str(discord_id))
+
+        if user_data is None and bungie_id is not None:
+            user_data = self._users.get(self._bungie_ids.get(str(bungie_id)))
+
+        return user_data
+
+    def all(self, clan_id=None):
+        """
+        Every registered user, optionally only those of one clan.
+
+        Returns (list): user records.
+        """
+        if clan_id is None:
+            return list(self._users.values())
+
+        return [user_data for user_data in self._users.values() if str(user_data.get('clan_id')) == str(clan_id)]
+
+    def add(self, user_data):
+        """
+        Add a newly registered user.
+
+        Returns: None.
+
+        """
+        self._index(user_data)
+        self.mark_dirty(user_data)
+
+    def mark_dirty(self, user_data):
+        """
+        Queue a changed record to be written on the next flush.
+
+        Returns: None.
+
+        """
+        self._dirty.add(str(user_data['discord_id']))
+
+    async def flush(self):
+        """
+        Write every dirty record to the database in a single transaction, off the event loop.
+
+        Returns (int): number of records written.
+        """
+        async with self._flush_lock:
+            if len(self._dirty) == 0:
+                return 0
+
+            # Snapshot the records so they can keep changing while the write is in flight
+            dirty_ids, self._dirty = self._dirty, set()
+            snapshot = [copy.deepcopy(self._users[discord_id]) for discord_id in dirty_ids]
+
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self.database.save_users, snapshot)
+            except Exception:
+                # Try them again next time
+                self._dirty.update(dirty_ids)
+                raise
+
+            return len(snapshot)